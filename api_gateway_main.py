@@ -1,17 +1,96 @@
+import time
+
+# Marca del inicio del arranque, para medir cuanto tarda el servicio en estar listo
+IMPORT_STARTED = time.perf_counter()
+
 from urllib import response
-from fastapi import FastAPI, Depends, HTTPException, status, Request
-from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, HTTPException, Query, status, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
 import httpx
 import jwt
+import jwks
+import idempotency
+import product_loader
+import profiling
+import logging_config
+import logging
+import hashlib
 import os
 from dotenv import load_dotenv
 import redis
 import json
+from fastapi.concurrency import run_in_threadpool
+
+# Logs en JSON, con request_id y escritos desde un hilo aparte (ver logging_config.py)
+logging_config.setup("api-gateway")
 
 
 load_dotenv()  # Cargar variables de entorno desde el archivo .env
-app = FastAPI()
+
+# --- Arranque ---
+# El gateway no tiene base de datos: el lifespan crea los clientes y verifica
+# Redis. Redis es una cache, si no responde el gateway arranca igual y lo
+# informa en /health/ready junto con la duracion de cada fase.
+#
+# Los clientes se crean en el lifespan y no al importar el modulo: con varios
+# workers (WEB_CONCURRENCY) cada proceso tiene su propio pool de conexiones a
+# Redis y a los microservicios, y las conexiones se reutilizan entre requests.
+startup_phases = {}
+ready = False
+http_client: httpx.AsyncClient | None = None
+redis_client: redis.Redis | None = None
+
+# Limites del pool de conexiones HTTP hacia los microservicios, por worker
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "10"))
+
+def record_phase(name: str, started: float):
+    startup_phases[name] = round((time.perf_counter() - started) * 1000, 1)
+
+async def check_redis() -> bool:
+    try:
+        return await run_in_threadpool(redis_client.ping)
+    except redis.RedisError:
+        return False
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global ready, http_client, redis_client
+    started = time.perf_counter()
+    # Reenvia el request_id a los servicios y mide las llamadas en las requests perfiladas
+    profiling_hooks = profiling.httpx_hooks()
+    http_client = httpx.AsyncClient(
+        timeout=UPSTREAM_TIMEOUT,
+        limits=httpx.Limits(max_connections=UPSTREAM_MAX_CONNECTIONS, max_keepalive_connections=UPSTREAM_MAX_CONNECTIONS),
+        event_hooks={
+            "request": logging_config.httpx_hooks()["request"] + profiling_hooks["request"],
+            "response": profiling_hooks["response"],
+        },
+    )
+    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT) # se crea una insancia del cliente de Redis
+    await check_redis()
+    record_phase("redis", started)
+
+    # Claves publicas de usuarios para verificar tokens, en segundo plano
+    jwks.start_refresh()
+
+    product_loader.bind(http_client, PRODUCTS_SERVICE_URL)
+
+    record_phase("total", IMPORT_STARTED)
+    ready = True
+    yield
+    ready = False
+    await http_client.aclose()
+    redis_client.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# Perfilado opcional por request (ver profiling.py). El gateway no tiene base:
+# el reporte muestra las llamadas a los microservicios
+profiling.install(app, jwks.decode)
+logging_config.install(app)
 
 # Para manejar la autenticación del token en los encabezados
 ''' Le indica a FastAPI que la aplicación usará un 
@@ -19,8 +98,6 @@ token de portador (Bearer Token) para la autenticación '''
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-SECRET_KEY = os.getenv("JWT_SECRET_KEY")
-ALGORITHM = "HS256"  # Algoritmo de encriptación para firmar los tokens JWT
 
 # URLs de los microservicios internos
 USERS_SERVICE_URL = "http://usuarios:8000"
@@ -38,12 +115,12 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
         detail="No se pudo validar el token",
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwks.decode(token)  # Verifica la firma con las claves publicas de usuarios (ver jwks.py)
         username: str = payload.get("sub")
         role: str = payload.get("role")
         if username is None or role is None:
             raise credentials_exception
-        return {"username": username, "role": role}
+        return {"username": username, "role": role, "user_id": payload.get("user_id")}
     except jwt.PyJWTError:
         raise credentials_exception
 
@@ -52,23 +129,92 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
 
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = int(os.getenv("REDIS_PORT"))
-redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT) # se crea una insancia del cliente de Redis
+# redis_client se crea en el lifespan (ver Arranque)
+
+# Primeras paginas del historial de pedidos, una clave hash por usuario.
+# Cada campo es una combinacion de filtros; al crear un pedido se borra el hash
+# entero, y pedidos lo borra cuando un pedido del usuario cambia de estado.
+ORDERS_CACHE_TTL = int(os.getenv("ORDERS_CACHE_TTL", "300"))
+
+def orders_cache_key(user_id) -> str:
+    return f"orders_first_page:{user_id}"
+
+# Productos individuales para /api/products/by-ids, una clave por producto.
+# Las modificaciones hechas por el gateway borran la clave; los descuentos de
+# stock de los pedidos no pasan por aca, por eso el TTL es corto.
+PRODUCT_CACHE_TTL = int(os.getenv("PRODUCT_CACHE_TTL", "60"))
+PRODUCTS_BY_IDS_MAX = int(os.getenv("PRODUCTS_BY_IDS_MAX", "500"))
+
+def product_cache_key(product_id) -> str:
+    return f"product:{product_id}"
 
 # --- Endpoints para la autenticación (redireccionan a usuarios) ---
 
 @app.post("/api/register")  
 async def register(request: Request): # recibe el request del cliente
                                      # reenvía la solicitud al microservicio de usuarios
-    async with httpx.AsyncClient() as client:  # crea un cliente HTTP asíncrono
-        response = await client.post(f"{USERS_SERVICE_URL}/register/", json=await request.json())  # reenvía la solicitud POST al microservicio de usuarios con el cuerpo JSON
-        return response.json()
+    response = await http_client.post(f"{USERS_SERVICE_URL}/register/", json=await request.json())  # reenvía la solicitud POST al microservicio de usuarios con el cuerpo JSON
+    return response.json()
+
+@app.post("/api/register/bulk")
+async def register_bulk(request: Request):
+    # Alta masiva de usuarios (solo administradores, lo valida usuarios)
+    headers = {"Authorization": request.headers.get("Authorization")}
+    response = await http_client.post(f"{USERS_SERVICE_URL}/register/bulk", json=await request.json(), headers=headers, timeout=120)
+    return JSONResponse(status_code=response.status_code, content=response.json())
+
+@app.get("/api/register/available")
+async def username_available(username: str):
+    response = await http_client.get(f"{USERS_SERVICE_URL}/register/available", params={"username": username})
+    return JSONResponse(status_code=response.status_code, content=response.json())
 
 @app.post("/api/token")
 async def login (request: Request): # recibe el request del cliente 
                                     # reenvía la solicitud al microservicio de usuarios
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f"{USERS_SERVICE_URL}/token/", data=await request.form()) # reenvía la solicitud POST al microservicio de usuarios con los datos del formulario
-        return response.json()  #respuesta es un JSON con access_token
+    response = await http_client.post(f"{USERS_SERVICE_URL}/token/", data=await request.form()) # reenvía la solicitud POST al microservicio de usuarios con los datos del formulario
+    return response.json()  #respuesta es un JSON con access_token
+
+@app.post("/api/token/refresh")
+async def refresh_token(request: Request):
+    # Access token nuevo a partir del refresh token, sin volver a enviar la contraseña
+    response = await http_client.post(f"{USERS_SERVICE_URL}/token/refresh", json=await request.json())
+    return JSONResponse(status_code=response.status_code, content=response.json())
+
+@app.post("/api/token/revoke")
+async def revoke_token(request: Request):
+    # Logout: revoca el refresh token en usuarios
+    response = await http_client.post(f"{USERS_SERVICE_URL}/token/revoke", json=await request.json())
+    if response.status_code == 204:
+        return Response(status_code=204)
+    return JSONResponse(status_code=response.status_code, content=response.json())
+
+# --- Idempotency-Key ---
+# Las escrituras aceptan el encabezado Idempotency-Key: un reintento con la
+# misma clave devuelve la respuesta guardada sin volver a llamar al
+# microservicio (ver idempotency.py). La clave tambien se reenvia, asi pedidos
+# y productos la respetan aunque el gateway no tenga Redis.
+
+def upstream_headers(request: Request) -> dict:
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": request.headers.get("Authorization")
+    }
+    if request.headers.get("Idempotency-Key"):
+        headers["Idempotency-Key"] = request.headers["Idempotency-Key"]
+    return headers
+
+def idempotency_user(request: Request) -> str:
+    # Los endpoints de productos no decodifican el token: se usa su hash para
+    # que dos clientes con la misma clave no compartan respuesta
+    return hashlib.sha256((request.headers.get("Authorization") or "").encode("utf-8")).hexdigest()
+
+async def idempotent(request: Request, scope: str, user: str, payload, handler):
+    body, replayed = await idempotency.run(
+        redis_client, scope, user, request.headers.get("Idempotency-Key"), payload, handler
+    )
+    if replayed:
+        return JSONResponse(content=body, headers={"Idempotent-Replayed": "true"})
+    return body
 
 # --- Endpoints para productos (protegidos con JWT) ---
 
@@ -81,65 +227,90 @@ async def create_product(request: Request):
         raise HTTPException(status_code=400, detail="Cuerpo de la petición no es un JSON válido")
     
     # Creamos un nuevo diccionario de encabezados con solo los necesarios
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": request.headers.get("Authorization")
-    }
+    headers = upstream_headers(request)
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
+    async def send():
+        response = await http_client.post(
             f"{PRODUCTS_SERVICE_URL}/products",
             json=data,
             headers=headers
         )
         response.raise_for_status() # Lanza un error si la respuesta HTTP es 4xx o 5xx
-        redis_client.delete("all_products")  # Invalidar caché
         return response.json() # Devolvemos la respuesta del microservicio de productos
 
+    return await idempotent(request, "products.create", idempotency_user(request), data, send)
+
 @app.get("/api/products/all")
 async def get_all_products():
     
-    cache_key = "all_products" # se define una clave unica para identificar los datos en la redis
-    
-    # Intenta obtener los datos del caché de Redis usando la clave "all_products"
-    # Si los datos existen redis lo devolvera como una cadena de bytes.
-    # Si no existe devuelve none
-    cached_data = redis_client.get(cache_key)
-    
-    if cached_data:
-        # Si los datos están en el caché, los devuelve inmediatamente
-        print("Datos obtenidos del caché de Redis.")
-        return json.loads(cached_data) # loads convierte la cadena de bytes JSON a un objeto de python
-
-    # Si los datos no están en el caché, hace la solicitud al microservicio
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{PRODUCTS_SERVICE_URL}/get/products")
-        
-    products_data = response.json()
-    
-    # Almacena los datos en el caché de Redis con un tiempo de expiración
-    # (por ejemplo, 3600 segundos = 1 hora)
-    redis_client.setex(cache_key, 3600, json.dumps(products_data))
-    
-    print("Datos obtenidos del microservicio y guardados en el caché.")
-    return products_data
+    # Snapshot del catalogo que publica productos en cada cambio (ver catalog.py en productos).
+    # Ya esta serializado: se devuelve tal cual, sin json.loads ni llamar al microservicio.
+    snapshot_version = redis_client.get("catalog:current")
+    if snapshot_version:
+        snapshot = redis_client.get(f"catalog:snapshot:{snapshot_version.decode()}")
+        if snapshot:
+            return Response(content=snapshot, media_type="application/json")
+
+    # Sin snapshot (Redis reiniciado o productos todavia arrancando) se le pide a
+    # productos, que lo reconstruye y lo publica para las siguientes requests.
+    response = await http_client.get(f"{PRODUCTS_SERVICE_URL}/catalog/snapshot")
+    response.raise_for_status()
+    logging.debug("Snapshot del catálogo reconstruido por productos.")
+    return Response(content=response.content, media_type="application/json")
+
+@app.get("/api/products/by-ids")
+async def get_products_by_ids(ids: str):
+    """
+    Productos con los ids indicados (separados por coma), en el orden pedido.
+    Los que estan en Redis se devuelven de ahi; el resto se consulta a
+    productos en una llamada compartida con las requests concurrentes (ver
+    product_loader.py). Los ids que no existen no aparecen en la respuesta.
+    """
+    try:
+        product_ids = list(dict.fromkeys(int(product_id) for product_id in ids.split(",") if product_id.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids debe ser una lista de enteros separados por coma")
+    if len(product_ids) > PRODUCTS_BY_IDS_MAX:
+        raise HTTPException(status_code=400, detail=f"Se admiten hasta {PRODUCTS_BY_IDS_MAX} ids por consulta")
+    if not product_ids:
+        return []
+
+    products = {}
+    cached = redis_client.mget([product_cache_key(product_id) for product_id in product_ids])
+    for product_id, data in zip(product_ids, cached):
+        if data is not None:
+            products[product_id] = json.loads(data)
+
+    missing = [product_id for product_id in product_ids if product_id not in products]
+    if missing:
+        try:
+            loaded = await product_loader.load_many(missing)
+        except Exception:
+            raise HTTPException(status_code=502, detail="No se pudieron consultar los productos")
+        if loaded:
+            pipe = redis_client.pipeline()
+            for product_id, product in loaded.items():
+                pipe.setex(product_cache_key(product_id), PRODUCT_CACHE_TTL, json.dumps(product))
+            pipe.execute()
+        products.update(loaded)
+
+    return [products[product_id] for product_id in product_ids if product_id in products]
 
 @app.delete("/api/products/{id}")
 async def delete_product(id: int, request: Request):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": request.headers.get("Authorization")
-    }
+    headers = upstream_headers(request)
 
-    async with httpx.AsyncClient() as client:
-        response = await client.delete(
+    async def send():
+        response = await http_client.delete(
             f"{PRODUCTS_SERVICE_URL}/products/{id}",
             headers=headers
         )
         response.raise_for_status()
-        redis_client.delete("all_products")  # Invalidar caché
+        redis_client.delete(product_cache_key(id))  # Invalidar caché
         return response.json()
 
+    return await idempotent(request, f"products.delete.{id}", idempotency_user(request), None, send)
+
 @app.put("/api/products/update/{id}")
 async def update_product(id: int, request: Request):
     
@@ -148,55 +319,149 @@ async def update_product(id: int, request: Request):
     except json.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Cuerpo de la petición no es un JSON válido")
     
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": request.headers.get("Authorization")
-    }
+    headers = upstream_headers(request)
 
-    async with httpx.AsyncClient() as client:
-        response = await client.put(
+    async def send():
+        response = await http_client.put(
             f"{PRODUCTS_SERVICE_URL}/products/update/{id}",
             json=data,
             headers=headers
         )
 
         if response.status_code >= 400:
-            return JSONResponse(
-                status_code=response.status_code,
-                content=response.json()
-            )
+            # Se lanza en lugar de devolverla para que la clave no guarde el error
+            raise HTTPException(status_code=response.status_code, detail=response.json().get("detail"))
 
-        redis_client.delete("all_products")  # Invalidar caché
+        redis_client.delete(product_cache_key(id))  # Invalidar caché
 
         return response.json()
 
+    return await idempotent(request, f"products.update.{id}", idempotency_user(request), data, send)
+
 @app.post("/api/orders/create")
 async def new_order(request: Request, user: dict = Depends(get_current_user)):
     
     try:
         data = await request.json()
-        print("Datos recibidos en Gateway:", data)
+        logging.debug("Datos recibidos en Gateway: %s", data)
     except json.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Cuerpo de la petición no es un JSON válido")
     
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": request.headers.get("Authorization")
-    }
+    headers = upstream_headers(request)
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
+    async def send():
+        response = await http_client.post(
             f"{ORDERS_SERVICE_URL}/orders/create",
             json=data,
             headers=headers
         )
-        print("📤 Datos enviados al microservicio pedidos:", data)
-        print("📥 Respuesta cruda de pedidos:", response.text)
+        logging.debug("Respuesta de pedidos (%s): %s", response.status_code, response.text)
 
         if response.status_code != 200:
             # devolvemos el detalle tal cual
             raise HTTPException(status_code=response.status_code, detail=response.text)
-        
-        return response.json()
 
-# Puedes agregar más rutas para usuarios y pedidos de la misma forma
\ No newline at end of file
+        order = response.json()
+        redis_client.delete(orders_cache_key(order.get("user_id")))  # Invalidar el historial cacheado
+        return order
+
+    return await idempotent(request, "orders.create", user["username"], data, send)
+
+@app.get("/api/orders")
+async def list_orders(request: Request, user: dict = Depends(get_current_user)):
+
+    params = dict(request.query_params)
+
+    # Un usuario normal solo puede ver sus pedidos: el user_id sale del token,
+    # no de la query. Un admin puede pedir el historial de cualquier usuario.
+    if user["role"] != "admin" or "user_id" not in params:
+        if user["user_id"] is None:
+            raise HTTPException(status_code=401, detail="El token no contiene el usuario, vuelve a iniciar sesión")
+        params["user_id"] = str(user["user_id"])
+
+    # Solo se cachea la primera pagina (sin cursor), que es la que mas se pide
+    cache_key = orders_cache_key(params["user_id"])
+    cache_field = None
+    if "cursor" not in params:
+        cache_field = "|".join(f"{k}={params[k]}" for k in sorted(params))
+        cached_page = redis_client.hget(cache_key, cache_field)
+        if cached_page:
+            return json.loads(cached_page)
+
+    headers = {"Authorization": request.headers.get("Authorization")}
+
+    response = await http_client.get(f"{ORDERS_SERVICE_URL}/orders", params=params, headers=headers)
+
+    if response.status_code != 200:
+        return JSONResponse(status_code=response.status_code, content=response.json())
+
+    page = response.json()
+    if cache_field:
+        redis_client.hset(cache_key, cache_field, json.dumps(page))
+        redis_client.expire(cache_key, ORDERS_CACHE_TTL)
+    return page
+
+@app.get("/api/orders/stats")
+async def order_stats(request: Request, user: dict = Depends(get_current_user)):
+    # Ventas acumuladas de pedidos; pedidos lee solo sus tablas de rollups
+    if user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="No tienes permiso para ver las estadísticas")
+    headers = {"Authorization": request.headers.get("Authorization")}
+    response = await http_client.get(f"{ORDERS_SERVICE_URL}/orders/stats", params=dict(request.query_params), headers=headers)
+    return JSONResponse(status_code=response.status_code, content=response.json())
+
+@app.get("/api/orders/{order_id}/status")
+async def wait_order_status(
+    order_id: int,
+    request: Request,
+    wait: float = Query(0, ge=0, le=60),  # mismo limite que pedidos
+    user: dict = Depends(get_current_user),
+):
+    # Long-poll: pedidos responde cuando cambia el estado o al vencer "wait"
+    params = dict(request.query_params)
+    headers = {"Authorization": request.headers.get("Authorization")}
+
+    response = await http_client.get(f"{ORDERS_SERVICE_URL}/orders/{order_id}/status", params=params, headers=headers, timeout=wait + 10)
+
+    return JSONResponse(status_code=response.status_code, content=response.json())
+
+@app.get("/api/orders/{order_id}/events")
+async def order_status_events(order_id: int, request: Request, user: dict = Depends(get_current_user)):
+    # Reenvia el stream SSE de pedidos tal cual llega, sin armarlo en memoria
+    headers = {"Authorization": request.headers.get("Authorization")}
+    upstream = await http_client.send(
+        http_client.build_request("GET", f"{ORDERS_SERVICE_URL}/orders/{order_id}/events", headers=headers, timeout=None),
+        stream=True
+    )
+
+    if upstream.status_code != 200:
+        body = await upstream.aread()
+        await upstream.aclose()
+        return JSONResponse(status_code=upstream.status_code, content=json.loads(body))
+
+    async def relay():
+        try:
+            async for chunk in upstream.aiter_raw():
+                yield chunk
+        finally:
+            await upstream.aclose()
+
+    return StreamingResponse(relay(), media_type="text/event-stream")
+
+# Puedes agregar más rutas para usuarios y pedidos de la misma forma
+
+# --- Sondeos de salud ---
+# /health/live solo indica que el proceso responde (no reiniciarlo);
+# /health/ready indica si puede recibir trafico.
+
+@app.get("/health/live")
+def liveness():
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness():
+    if not ready:
+        return JSONResponse(status_code=503, content={"status": "starting", "startup_ms": startup_phases})
+    return {"status": "ready", "redis": await check_redis(), "startup_ms": startup_phases}
+
+record_phase("imports", IMPORT_STARTED)
\ No newline at end of file
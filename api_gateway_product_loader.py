@@ -0,0 +1,100 @@
+import os
+import asyncio
+import logging
+
+# Agrupacion de consultas de productos por id (estilo dataloader).
+#
+# Las consultas que llegan dentro de una ventana de PRODUCT_BATCH_WINDOW_MS
+# milisegundos se juntan en una sola llamada a /products/by-ids de productos.
+# Un id pedido por varias requests a la vez se consulta una sola vez y todas
+# reciben el mismo resultado. Si se juntan PRODUCT_BATCH_MAX ids la llamada
+# sale sin esperar a que termine la ventana.
+#
+# El estado vive en el event loop del worker: no hace falta lock porque todo
+# corre en el mismo hilo.
+
+PRODUCT_BATCH_WINDOW = float(os.getenv("PRODUCT_BATCH_WINDOW_MS", "5")) / 1000
+# No debe superar PRODUCTS_BY_IDS_MAX de productos
+PRODUCT_BATCH_MAX = int(os.getenv("PRODUCT_BATCH_MAX", "500"))
+
+_http_client = None
+_products_url = None
+_pending: dict[int, asyncio.Future] = {}  # ids esperando la proxima llamada
+_flush_handle: asyncio.TimerHandle | None = None
+_tasks: set[asyncio.Task] = set()  # llamadas en curso; el event loop solo guarda referencias debiles
+
+
+def bind(http_client, products_url: str):
+    """Registra el cliente HTTP del worker (se llama en el lifespan)."""
+    global _http_client, _products_url
+    _http_client = http_client
+    _products_url = products_url
+
+
+async def fetch(batch: dict[int, asyncio.Future]):
+    product_ids = sorted(batch)
+    found = {}
+    try:
+        for start in range(0, len(product_ids), PRODUCT_BATCH_MAX):
+            chunk = product_ids[start:start + PRODUCT_BATCH_MAX]
+            response = await _http_client.get(
+                f"{_products_url}/products/by-ids",
+                params={"ids": ",".join(map(str, chunk))}
+            )
+            response.raise_for_status()
+            found.update({product["id"]: product for product in response.json()})
+    except Exception as e:
+        logging.error(f"No se pudieron consultar {len(product_ids)} productos en productos: {e}")
+        for future in batch.values():
+            if not future.done():
+                future.set_exception(e)
+                # El error ya quedo registrado: si todos los que esperaban se cancelaron, nadie lo lee
+                future.add_done_callback(lambda done: done.exception())
+        return
+    for product_id, future in batch.items():
+        if not future.done():
+            future.set_result(found.get(product_id))
+
+
+def fetch_done(task: asyncio.Task):
+    _tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Fallo inesperado al consultar productos: {task.exception()}")
+
+
+def flush():
+    """Envia los ids pendientes en una llamada y deja la cola vacia para la siguiente ventana."""
+    global _pending, _flush_handle
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = None
+    if not _pending:
+        return
+    batch, _pending = _pending, {}
+    task = asyncio.get_running_loop().create_task(fetch(batch))
+    _tasks.add(task)
+    task.add_done_callback(fetch_done)
+
+
+async def load_many(product_ids) -> dict[int, dict]:
+    """
+    Productos con los ids indicados. Los que no existen no aparecen en el
+    resultado. Lanza la excepcion de la llamada si productos no responde.
+    """
+    global _flush_handle
+    loop = asyncio.get_running_loop()
+    futures = {}
+    for product_id in dict.fromkeys(product_ids):
+        future = _pending.get(product_id)
+        if future is None:
+            future = _pending[product_id] = loop.create_future()
+        futures[product_id] = future
+
+    if len(_pending) >= PRODUCT_BATCH_MAX:
+        flush()
+    elif _pending and _flush_handle is None:
+        _flush_handle = loop.call_later(PRODUCT_BATCH_WINDOW, flush)
+
+    # shield: si esta request se cancela, las demas que esperan el mismo id siguen
+    results = await asyncio.gather(*(asyncio.shield(future) for future in futures.values()))
+    return {product_id: product for product_id, product in zip(futures, results) if product is not None}
\ No newline at end of file
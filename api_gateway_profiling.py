@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+
+# Perfilado opcional de requests.
+#
+# Una request se perfila si:
+#   - trae el encabezado X-Profile: 1 con un token de administrador, o
+#   - cae en la muestra aleatoria PROFILE_SAMPLE_RATE (0 = desactivado).
+# Mientras dura se registra:
+#   - un perfil estadistico: cada PROFILE_SAMPLE_INTERVAL segundos un hilo
+#     toma la pila de todos los hilos del proceso. Con trafico concurrente
+#     tambien aparece el trabajo de otras requests;
+#   - cada sentencia SQL con su duracion (eventos del engine);
+#   - las llamadas a otros servicios (hooks de httpx y timed()).
+# El reporte se guarda en PROFILE_DIR si la request se pidio por encabezado o
+# si tardo al menos PROFILE_SLOW_MS. Se conservan los PROFILE_MAX_REPORTS mas
+# recientes y la respuesta indica el archivo en X-Profile-Report.
+#
+# Es un middleware ASGI puro: sin perfilar, la request pasa directo a la app
+# y el costo es leer un encabezado y una variable de contexto por sentencia
+# SQL. La respuesta de una request perfilada se retiene hasta que termina,
+# para poder agregarle X-Profile-Report.
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "500"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+PROFILE_MAX_REPORTS = int(os.getenv("PROFILE_MAX_REPORTS", "200"))
+PROFILE_HEADER = "X-Profile"
+
+# Limites del reporte, para que una request con miles de consultas no genere un archivo enorme
+MAX_STATEMENTS = 500
+MAX_STACKS = 50
+MAX_STACK_DEPTH = 64
+# Pilas de hilos ociosos (esperando trabajo o E/S), no aportan al perfil
+IDLE_FILES = {"threading.py", "selectors.py", "queue.py"}
+
+_current = contextvars.ContextVar("profile", default=None)
+_active = []  # perfiles en curso, los recorre el hilo muestreador
+_active_lock = threading.Lock()
+_wakeup = threading.Event()
+_sampler = None
+
+
+def new_profile(trigger: str) -> dict:
+    return {"trigger": trigger, "sql": [], "upstream": [], "samples": Counter()}
+
+
+# --- Muestreo de pilas ---
+
+def folded_stack(frame) -> str | None:
+    """Pila en formato "archivo:funcion;archivo:funcion", de la raiz a la hoja."""
+    if os.path.basename(frame.f_code.co_filename) in IDLE_FILES:
+        return None
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        names.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def sampler_loop():
+    own = threading.get_ident()
+    while True:
+        _wakeup.wait()
+        stacks = [
+            stack for thread_id, frame in sys._current_frames().items()
+            if thread_id != own and (stack := folded_stack(frame)) is not None
+        ]
+        with _active_lock:
+            if not _active:
+                _wakeup.clear()
+                continue
+            for profile in _active:
+                profile["samples"].update(stacks)
+        time.sleep(PROFILE_SAMPLE_INTERVAL)
+
+
+def start_sampling(profile: dict):
+    global _sampler
+    with _active_lock:
+        _active.append(profile)
+        if _sampler is None:
+            _sampler = threading.Thread(target=sampler_loop, daemon=True, name="profiler")
+            _sampler.start()
+    _wakeup.set()
+
+
+def stop_sampling(profile: dict):
+    with _active_lock:
+        _active.remove(profile)
+
+
+# --- SQL y llamadas a otros servicios ---
+
+def instrument_engine(engine):
+    """Registra la duracion de cada sentencia del engine en el perfil de la request en curso."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _current.get() is not None:
+            conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = _current.get()
+        if profile is None or not conn.info.get("profile_started"):
+            return
+        elapsed = (time.perf_counter() - conn.info["profile_started"].pop()) * 1000
+        profile["sql"].append({"statement": statement, "ms": round(elapsed, 2)})
+
+
+def record_upstream(target: str, started: float, status=None):
+    profile = _current.get()
+    if profile is not None:
+        elapsed = (time.perf_counter() - started) * 1000
+        profile["upstream"].append({"target": target, "status": status, "ms": round(elapsed, 2)})
+
+
+@contextmanager
+def timed(target: str):
+    """Mide una llamada a otro servicio (RabbitMQ, HTTP sin httpx) si la request se esta perfilando."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_upstream(target, started)
+
+
+def httpx_hooks() -> dict:
+    """event_hooks para httpx.AsyncClient que miden cada llamada a otro servicio."""
+    async def on_request(request):
+        request.extensions["profile_started"] = time.perf_counter()
+
+    async def on_response(response):
+        started = response.request.extensions.get("profile_started")
+        if started is not None:
+            record_upstream(f"{response.request.method} {response.request.url.host}{response.request.url.path}", started, response.status_code)
+
+    return {"request": [on_request], "response": [on_response]}
+
+
+# --- Reportes ---
+
+def build_report(profile: dict, request, status_code: int, duration_ms: float) -> dict:
+    statements = sorted(profile["sql"], key=lambda item: item["ms"], reverse=True)
+    return {
+        "method": request.method,
+        "path": request.url.path,
+        "query": request.url.query,
+        "status": status_code,
+        "duration_ms": round(duration_ms, 2),
+        "trigger": profile["trigger"],
+        "pid": os.getpid(),
+        "started_at": time.time() - duration_ms / 1000,
+        "sql": {
+            "count": len(statements),
+            "total_ms": round(sum(item["ms"] for item in statements), 2),
+            "statements": statements[:MAX_STATEMENTS],
+        },
+        "upstream": profile["upstream"],
+        "samples": sum(profile["samples"].values()),
+        "stacks": [{"stack": stack, "samples": count} for stack, count in profile["samples"].most_common(MAX_STACKS)],
+    }
+
+
+def save_report(report: dict) -> str:
+    """Guarda el reporte y borra los mas viejos por encima de PROFILE_MAX_REPORTS. Devuelve el nombre del archivo."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path_name = report["path"].strip("/").replace("/", "_") or "root"
+    name = f"{time.time_ns()}-{os.getpid()}-{report['method']}-{path_name}.json"
+    with open(os.path.join(PROFILE_DIR, name), "w") as f:
+        json.dump(report, f, indent=2)
+
+    # El nombre empieza con el timestamp: el orden alfabetico es el cronologico
+    reports = sorted(entry for entry in os.listdir(PROFILE_DIR) if entry.endswith(".json"))
+    for old in reports[:-PROFILE_MAX_REPORTS]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, old))
+        except FileNotFoundError:
+            pass  # otro worker ya lo borro
+    return name
+
+
+# --- Middleware ---
+
+def requested_by_admin(request, decode) -> bool:
+    if request.headers.get(PROFILE_HEADER) != "1":
+        return False
+    authorization = request.headers.get("Authorization", "")
+    if not authorization.startswith("Bearer "):
+        return False
+    try:
+        return decode(authorization[len("Bearer "):]).get("role") == "admin"
+    except Exception:
+        return False
+
+
+def install(app, decode):
+    """
+    Agrega el middleware de perfilado. decode verifica un access token y
+    devuelve su payload; se usa solo si llega el encabezado X-Profile. Corre
+    en el threadpool: ante un kid desconocido puede descargar el JWKS, y eso
+    no debe frenar el event loop.
+    """
+    app.add_middleware(middleware, decode=decode)
+
+
+def middleware(app, decode):
+    async def profile_request(scope, receive, send):
+        if scope["type"] != "http":
+            return await app(scope, receive, send)
+        request = Request(scope)
+        if request.headers.get(PROFILE_HEADER) == "1" and await run_in_threadpool(requested_by_admin, request, decode):
+            profile = new_profile("header")
+        elif PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            profile = new_profile("sample")
+        else:
+            return await app(scope, receive, send)
+
+        messages = []
+        status_code = 500
+
+        async def hold(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            messages.append(message)
+
+        token = _current.set(profile)
+        start_sampling(profile)
+        started = time.perf_counter()
+        try:
+            await app(scope, receive, hold)
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            stop_sampling(profile)
+            _current.reset(token)
+
+        if messages and (profile["trigger"] == "header" or duration_ms >= PROFILE_SLOW_MS):
+            try:
+                name = await run_in_threadpool(save_report, build_report(profile, request, status_code, duration_ms))
+                messages[0]["headers"] = [*messages[0].get("headers", []), (b"x-profile-report", name.encode())]
+                logging.warning(f"Request perfilada {request.method} {request.url.path}: {duration_ms:.0f} ms, reporte {name}")
+            except Exception as e:
+                logging.error(f"No se pudo guardar el reporte de perfilado: {e}")
+        for message in messages:
+            await send(message)
+
+    return profile_request
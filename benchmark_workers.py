@@ -0,0 +1,204 @@
+import os
+import sys
+import glob
+import json
+import time
+import base64
+import shutil
+import socket
+import tempfile
+import asyncio
+import argparse
+import subprocess
+import multiprocessing
+
+import httpx
+
+# Benchmark de escalado por workers de Uvicorn.
+#
+# Levanta el servicio indicado con `uvicorn main:app --workers N` para cada N
+# pedido, espera a /health/ready, genera carga contra un endpoint durante unos
+# segundos desde varios procesos cliente y reporta requests por segundo,
+# latencias y la aceleracion respecto de la primera corrida. Se corre con las
+# mismas variables de entorno del servicio (base, Redis, RabbitMQ), por ejemplo:
+#
+#   python benchmark_workers.py --service productos --workers 1,2,4
+#   python benchmark_workers.py --service pedidos --token <jwt de un usuario>
+#
+# Con --service arma una carpeta temporal con los archivos del servicio sin
+# el prefijo (pedidos_main.py -> main.py), como quedan en su imagen. Con
+# --app-dir se usa una carpeta que ya tenga el main.py.
+#
+# La carga se genera desde la misma maquina: conviene que --clients mas el
+# mayor numero de workers no supere la cantidad de cores.
+
+# Endpoint por defecto de cada servicio: lecturas reales (base, Redis o
+# filtro en memoria) que no modifican datos. {user_id} sale de --user-id o
+# del token.
+DEFAULT_ENDPOINTS = {
+    "usuarios": "/register/available?username=benchmark-user",
+    "productos": "/products/by-ids?ids=" + ",".join(str(product_id) for product_id in range(1, 21)),
+    "pedidos": "/orders?user_id={user_id}&limit=20",
+    "apigateway": "/api/products/all",
+}
+
+# Prefijo de los archivos de cada servicio en el repositorio
+SERVICE_PREFIXES = {
+    "usuarios": "usuarios_",
+    "productos": "productos_",
+    "pedidos": "pedidos_",
+    "apigateway": "api_gateway_",
+}
+
+READY_TIMEOUT = 30
+
+
+def build_app_dir(service: str) -> str:
+    """Copia los archivos del servicio a una carpeta temporal con sus nombres de la imagen."""
+    prefix = SERVICE_PREFIXES[service]
+    app_dir = tempfile.mkdtemp(prefix=f"benchmark-{service}-")
+    for path in glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{prefix}*.py")):
+        shutil.copy(path, os.path.join(app_dir, os.path.basename(path)[len(prefix):]))
+    return app_dir
+
+
+def token_user_id(token: str):
+    """user_id del payload del JWT, sin verificar la firma: solo se usa para armar la URL."""
+    payload = token.split(".")[1]
+    return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))).get("user_id")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(app_dir: str, workers: int, port: int) -> subprocess.Popen:
+    # Las migraciones se aplican una vez con start.sh, no en cada corrida
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=app_dir,
+    )
+
+
+def wait_until_ready(base_url: str) -> float:
+    """Espera a que el servicio responda listo. Devuelve los segundos que tardo."""
+    started = time.perf_counter()
+    deadline = started + READY_TIMEOUT
+    while time.perf_counter() < deadline:
+        try:
+            if httpx.get(f"{base_url}/health/ready", timeout=1).status_code == 200:
+                return time.perf_counter() - started
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"El servicio no estuvo listo en {READY_TIMEOUT} segundos")
+
+
+async def generate_load(url: str, headers: dict, concurrency: int, duration: float) -> dict:
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def user(client: httpx.AsyncClient):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                response = await client.get(url, headers=headers)
+                if response.status_code >= 400:
+                    errors += 1
+                    continue
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=10) as client:
+        await asyncio.gather(*(user(client) for _ in range(concurrency)))
+    return {"latencies": latencies, "errors": errors}
+
+
+def load_process(args) -> dict:
+    return asyncio.run(generate_load(*args))
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(app_dir: str, workers: int, endpoint: str, headers: dict, clients: int, concurrency: int, duration: float) -> dict:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server = start_server(app_dir, workers, port)
+    try:
+        ready_seconds = wait_until_ready(base_url)
+        # Calentamiento corto para abrir los pools de conexiones de cada worker
+        with multiprocessing.Pool(clients) as pool:
+            pool.map(load_process, [(base_url + endpoint, headers, concurrency, 1.0)] * clients)
+            results = pool.map(load_process, [(base_url + endpoint, headers, concurrency, duration)] * clients)
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = [latency for result in results for latency in result["latencies"]]
+    return {
+        "workers": workers,
+        "ready_ms": round(ready_seconds * 1000, 1),
+        "requests": len(latencies),
+        "errors": sum(result["errors"] for result in results),
+        "rps": round(len(latencies) / duration, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput del servicio segun la cantidad de workers de Uvicorn")
+    parser.add_argument("--service", choices=sorted(DEFAULT_ENDPOINTS), help="Servicio a medir (define el endpoint por defecto)")
+    parser.add_argument("--app-dir", help="Carpeta con el main.py del servicio (por defecto se arma desde los archivos del repositorio)")
+    parser.add_argument("--endpoint", help="Endpoint GET a medir")
+    parser.add_argument("--token", default=os.getenv("BENCHMARK_TOKEN"), help="JWT para endpoints protegidos")
+    parser.add_argument("--user-id", type=int, help="Usuario para {user_id} en el endpoint (por defecto el del token)")
+    parser.add_argument("--workers", default=f"1,2,{os.cpu_count() or 4}", help="Lista de cantidades de workers, separadas por coma")
+    parser.add_argument("--clients", type=int, default=2, help="Procesos generadores de carga")
+    parser.add_argument("--concurrency", type=int, default=32, help="Requests simultaneos por proceso cliente")
+    parser.add_argument("--duration", type=float, default=10, help="Segundos de medicion por corrida")
+    args = parser.parse_args()
+
+    endpoint = args.endpoint or DEFAULT_ENDPOINTS.get(args.service)
+    if endpoint is None:
+        parser.error("Indica --service o --endpoint")
+    if args.app_dir is None and args.service is None:
+        parser.error("Indica --service o --app-dir")
+    if "{user_id}" in endpoint:
+        user_id = args.user_id if args.user_id is not None else (token_user_id(args.token) if args.token else None)
+        if user_id is None:
+            parser.error("El endpoint necesita --user-id o un --token con user_id")
+        endpoint = endpoint.replace("{user_id}", str(user_id))
+    headers = {"Authorization": f"Bearer {args.token}"} if args.token else {}
+
+    app_dir = args.app_dir or build_app_dir(args.service)
+    rows = []
+    try:
+        for workers in sorted({int(value) for value in args.workers.split(",")}):
+            row = run(app_dir, workers, endpoint, headers, args.clients, args.concurrency, args.duration)
+            row["speedup"] = round(row["rps"] / rows[0]["rps"], 2) if rows and rows[0]["rps"] else 1.0
+            rows.append(row)
+            print(f"workers={row['workers']:>3}  rps={row['rps']:>9}  x{row['speedup']:<5}  p50={row['p50_ms']} ms  "
+                  f"p99={row['p99_ms']} ms  errores={row['errors']}  listo en {row['ready_ms']} ms", file=sys.stderr)
+    finally:
+        if args.app_dir is None:
+            shutil.rmtree(app_dir, ignore_errors=True)
+
+    print(json.dumps({"endpoint": endpoint, "cpu_count": os.cpu_count(), "results": rows}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
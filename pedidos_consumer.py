@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import logging
+from collections import defaultdict
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import OperationalError
+
+from database import SessionLocal
+from models import Order
+import events
+import rollups
+import idempotency
+
+# Cola donde productos publica el resultado de cada pedido procesado
+ORDER_STATUS_QUEUE = "order_status_queue"
+# Eventos que no se pudieron aplicar tras STATUS_MAX_ATTEMPTS intentos
+ORDER_STATUS_DLQ = "order_status_queue.dlq"
+STATUS_MAX_ATTEMPTS = int(os.getenv("STATUS_MAX_ATTEMPTS", "5"))
+# Con la base caida el lote se reintenta sin gastar intentos, con espera creciente hasta este maximo
+STATUS_RETRY_MAX_DELAY = float(os.getenv("STATUS_RETRY_MAX_DELAY", "30"))
+
+# Los eventos se aplican en lotes: se acumulan hasta STATUS_BATCH_SIZE mensajes
+# o hasta que pasan STATUS_BATCH_TIMEOUT segundos desde el primero del lote.
+STATUS_BATCH_SIZE = int(os.getenv("STATUS_BATCH_SIZE", "100"))
+STATUS_BATCH_TIMEOUT = float(os.getenv("STATUS_BATCH_TIMEOUT", "0.5"))
+
+# Maquina de estados del pedido: solo un pedido pendiente puede cambiar,
+# confirmed y rejected son estados finales.
+ALLOWED_TRANSITIONS = {
+    "pending": {"confirmed", "rejected"},
+}
+FINAL_STATUSES = {"confirmed", "rejected"}
+
+
+def orders_cache_key(user_id) -> str:
+    """Primeras paginas del historial que cachea el gateway (mismo nombre que en el gateway)."""
+    return f"orders_first_page:{user_id}"
+
+
+def invalidate_cached_pages(user_ids: set[int]):
+    """Borra el historial cacheado de los usuarios cuyos pedidos cambiaron de estado."""
+    if not user_ids or not idempotency.REDIS_HOST:
+        return
+    try:
+        idempotency.get_redis().delete(*(orders_cache_key(user_id) for user_id in user_ids))
+    except Exception as e:
+        logging.error(f"No se pudo invalidar el historial cacheado de {len(user_ids)} usuarios: {e}")
+
+
+def apply_status_batch(batch: list[dict]) -> int:
+    """
+    Aplica un lote de eventos con un UPDATE por cada (estado, motivo).
+
+    El WHERE sobre el estado actual hace que las transiciones invalidas o
+    repetidas (por ejemplo un evento reentregado) no modifiquen nada. Las
+    ventas acumuladas se ajustan en la misma transaccion (ver rollups.py).
+    Despues del commit se invalida el historial que el gateway cachea de
+    cada usuario afectado. Devuelve la cantidad de pedidos actualizados.
+    """
+    groups = defaultdict(set)
+    for event in batch:
+        groups[(event["status"], event.get("reason"))].add(event["order_id"])
+
+    changed = []
+    transitions = []
+    user_ids = set()
+    db = SessionLocal()
+    try:
+        for (new_status, reason), order_ids in groups.items():
+            from_statuses = [s for s, targets in ALLOWED_TRANSITIONS.items() if new_status in targets]
+            if not from_statuses:
+                logging.warning(f"Estado de pedido desconocido: {new_status}")
+                continue
+            # La subconsulta bloquea las filas y conserva el estado anterior para RETURNING
+            previous = (
+                select(Order.id, Order.status.label("old_status"))
+                .where(Order.id.in_(order_ids), Order.status.in_(from_statuses))
+                .with_for_update()
+                .subquery()
+            )
+            result = db.execute(
+                update(Order)
+                .where(Order.id == previous.c.id)
+                .values(status=new_status, status_reason=reason)
+                .returning(Order.id, Order.product_id, Order.created_at, Order.quantity, Order.total_price, previous.c.old_status, Order.user_id)
+            )
+            for order_id, product_id, created_at, quantity, total_price, old_status, user_id in result:
+                changed.append((order_id, new_status, reason))
+                user_ids.add(user_id)
+                transitions.append((order_id, product_id, created_at, quantity, total_price, old_status, new_status))
+        rollups.apply_transitions(db, transitions)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    # Se notifica solo despues del commit, para que quien espere lea el estado nuevo
+    invalidate_cached_pages(user_ids)
+    for order_id, new_status, reason in changed:
+        events.publish(order_id, new_status, reason)
+    return len(changed)
+
+
+def parse_status_event(body: bytes) -> dict | None:
+    try:
+        event = json.loads(body)
+        return {"order_id": int(event["order_id"]), "status": str(event["status"]), "reason": event.get("reason")}
+    except (ValueError, KeyError, TypeError) as e:
+        logging.error(f"Evento de estado inválido descartado: {e}")
+        return None
+
+
+def apply_one_by_one(channel, batch: list[tuple]) -> int:
+    """
+    Aplica un lote que fallo evento por evento, para aislar al que falla.
+    Ese se vuelve a publicar al final de la cola con x-attempts incrementado
+    y al llegar a STATUS_MAX_ATTEMPTS va a la DLQ. Los errores de base
+    (OperationalError) se propagan: el lote entero se reintenta.
+    """
+    import pika
+
+    updated = 0
+    for event, properties, body in batch:
+        try:
+            updated += apply_status_batch([event])
+        except OperationalError:
+            raise
+        except Exception as e:
+            headers = dict(properties.headers or {})
+            attempts = int(headers.get("x-attempts", 0)) + 1
+            headers["x-attempts"] = attempts
+            if attempts >= STATUS_MAX_ATTEMPTS:
+                logging.error(f"Evento de estado del pedido {event['order_id']} enviado a la DLQ tras {attempts} intentos: {e}")
+                target = ORDER_STATUS_DLQ
+            else:
+                logging.warning(f"Error al aplicar el estado del pedido {event['order_id']} (intento {attempts}/{STATUS_MAX_ATTEMPTS}): {e}")
+                target = ORDER_STATUS_QUEUE
+            channel.basic_publish(
+                exchange="",
+                routing_key=target,
+                body=body,
+                properties=pika.BasicProperties(delivery_mode=2, headers=headers)
+            )
+    return updated
+
+
+def consume_status_events():
+    """
+    Consume la cola de resultados y aplica los cambios de estado en lotes.
+    Los mensajes se confirman con un solo basic_ack(multiple=True) por lote.
+    """
+    import pika  # diferido: main.py importa este modulo sin necesitar RabbitMQ
+
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=os.getenv("RABBITMQ_HOST")))
+    channel = connection.channel()
+    channel.queue_declare(queue=ORDER_STATUS_QUEUE, durable=True)
+    channel.queue_declare(queue=ORDER_STATUS_DLQ, durable=True)
+    channel.basic_qos(prefetch_count=STATUS_BATCH_SIZE)
+
+    batch = []  # (evento, propiedades, cuerpo)
+    last_tag = None
+    deadline = None
+    retry_delay = 1
+    for method, properties, body in channel.consume(ORDER_STATUS_QUEUE, inactivity_timeout=STATUS_BATCH_TIMEOUT):
+        if method is not None:
+            last_tag = method.delivery_tag
+            event = parse_status_event(body)
+            if event:
+                batch.append((event, properties, body))
+            if deadline is None:
+                deadline = time.monotonic() + STATUS_BATCH_TIMEOUT
+            if len(batch) < STATUS_BATCH_SIZE and time.monotonic() < deadline:
+                continue
+
+        if last_tag is None:
+            continue
+        try:
+            if batch:
+                try:
+                    updated = apply_status_batch([event for event, _, _ in batch])
+                except OperationalError:
+                    raise
+                except Exception as e:
+                    logging.error(f"Error al aplicar el lote de estados, se aplica evento por evento: {e}")
+                    updated = apply_one_by_one(channel, batch)
+                logging.info(f"Lote de estados aplicado: {len(batch)} eventos, {updated} pedidos actualizados")
+            channel.basic_ack(delivery_tag=last_tag, multiple=True)
+            retry_delay = 1
+        except OperationalError as e:
+            logging.error(f"Base de datos no disponible, se reintentará el lote en {retry_delay} s: {e}")
+            channel.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+            connection.sleep(retry_delay)  # atiende los heartbeats mientras espera
+            retry_delay = min(retry_delay * 2, STATUS_RETRY_MAX_DELAY)
+        batch = []
+        last_tag = None
+        deadline = None
+
+
+def start_status_consumer():
+    """
+    Bucle de reconexion del consumidor de estados. Pensado para correr en un hilo daemon.
+    """
+    import pika
+
+    while True:
+        try:
+            logging.info("Conectando el consumidor de estados a RabbitMQ...")
+            consume_status_events()
+        except pika.exceptions.AMQPConnectionError as e:
+            logging.error(f"No se pudo conectar a RabbitMQ: {e}. Reintentando en 5 segundos...")
+        except Exception as e:
+            logging.error(f"Error inesperado en el consumidor de estados: {e}. Reintentando en 5 segundos...")
+        time.sleep(5)
\ No newline at end of file
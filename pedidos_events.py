@@ -0,0 +1,45 @@
+import asyncio
+
+# Notificaciones en memoria de cambios de estado de pedidos.
+# El consumidor de estados corre en un hilo aparte y publica aqui cada
+# transicion; los endpoints de long-poll y SSE esperan en una asyncio.Queue
+# por pedido en lugar de consultar la base de datos en un bucle.
+
+_loop: asyncio.AbstractEventLoop | None = None
+_waiters: dict[int, set[asyncio.Queue]] = {}  # solo se modifica desde el hilo del event loop
+
+
+def bind_loop(loop: asyncio.AbstractEventLoop):
+    """Registra el event loop de la aplicacion (se llama en el arranque)."""
+    global _loop
+    _loop = loop
+
+
+def subscribe(order_id: int) -> asyncio.Queue:
+    queue: asyncio.Queue = asyncio.Queue()
+    _waiters.setdefault(order_id, set()).add(queue)
+    return queue
+
+
+def unsubscribe(order_id: int, queue: asyncio.Queue):
+    queues = _waiters.get(order_id)
+    if queues is None:
+        return
+    queues.discard(queue)
+    if not queues:
+        del _waiters[order_id]
+
+
+def _dispatch(order_id: int, event: dict):
+    for queue in _waiters.get(order_id, ()):
+        queue.put_nowait(event)
+
+
+def publish(order_id: int, status: str, reason: str | None = None):
+    """
+    Notifica un cambio de estado. Es seguro llamarla desde cualquier hilo.
+    """
+    if _loop is None or _loop.is_closed():
+        return
+    event = {"order_id": order_id, "status": status, "reason": reason}
+    _loop.call_soon_threadsafe(_dispatch, order_id, event)
\ No newline at end of file
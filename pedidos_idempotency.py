@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+from fastapi import HTTPException
+
+# Claves de idempotencia (encabezado Idempotency-Key).
+#
+# Si un cliente reintenta una escritura con la misma clave, se devuelve la
+# respuesta guardada de la primera ejecucion en lugar de repetirla. En Redis,
+# idem:<alcance>:<usuario>:<clave> pasa por dos estados:
+#   - in_flight: la primera solicitud se esta ejecutando. Se toma con SET NX y
+#     vence a los IDEMPOTENCY_LOCK_TTL segundos por si el proceso muere;
+#     mientras el handler corre se renueva cada IDEMPOTENCY_LOCK_TTL / 3
+#     segundos, asi un handler lento no pierde la clave.
+#     Los duplicados simultaneos esperan hasta IDEMPOTENCY_WAIT segundos.
+#   - done: respuesta guardada durante IDEMPOTENCY_TTL segundos.
+# Solo se guardan las respuestas exitosas; si la ejecucion falla se borra la
+# clave y el reintento vuelve a ejecutar. Reusar una clave con otro cuerpo
+# devuelve 422.
+#
+# Sin REDIS_HOST las solicitudes se ejecutan sin control de duplicados.
+
+REDIS_HOST = os.getenv("REDIS_HOST")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_LOCK_TTL = int(os.getenv("IDEMPOTENCY_LOCK_TTL", "30"))
+IDEMPOTENCY_WAIT = float(os.getenv("IDEMPOTENCY_WAIT", "10"))
+IDEMPOTENCY_POLL_INTERVAL = 0.05
+MAX_KEY_LENGTH = 255
+
+# Renueva el in_flight solo si sigue siendo el de esta solicitud
+EXTEND_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_redis = None
+
+
+def get_redis():
+    """Cliente de Redis del proceso, creado en el primer uso."""
+    global _redis
+    if _redis is None:
+        import redis
+        _redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+    return _redis
+
+
+def fingerprint(payload) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def storage_key(scope: str, user: str, key: str) -> str:
+    return f"idem:{scope}:{user}:{key}"
+
+
+def check_fingerprint(record: dict, request_fingerprint: str):
+    if record["fingerprint"] != request_fingerprint:
+        raise HTTPException(status_code=422, detail="La Idempotency-Key ya se usó con otro cuerpo de solicitud")
+
+
+@contextmanager
+def keep_claimed(redis_client, redis_key: str, in_flight: str):
+    """Renueva el in_flight desde un hilo aparte mientras corre el handler."""
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(IDEMPOTENCY_LOCK_TTL / 3):
+            try:
+                redis_client.eval(EXTEND_SCRIPT, 1, redis_key, in_flight, IDEMPOTENCY_LOCK_TTL)
+            except Exception as e:
+                logging.error(f"No se pudo renovar la Idempotency-Key: {e}")
+
+    threading.Thread(target=renew, daemon=True, name="idempotency-renew").start()
+    try:
+        yield
+    finally:
+        stop.set()
+
+
+def run(scope: str, user: str, key: str | None, payload, handler) -> tuple[dict, bool]:
+    """
+    Ejecuta handler() una sola vez por clave. Devuelve (respuesta, repetida),
+    donde repetida indica que la respuesta sale de la cache. handler debe
+    devolver un dict serializable a JSON.
+    """
+    if not key or not REDIS_HOST:
+        return handler(), False
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key admite hasta {MAX_KEY_LENGTH} caracteres")
+
+    redis_key = storage_key(scope, user, key)
+    request_fingerprint = fingerprint(payload)
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    # owner distingue esta solicitud de un reintento que tome la clave si vence
+    in_flight = json.dumps({"state": "in_flight", "fingerprint": request_fingerprint, "owner": uuid.uuid4().hex})
+    try:
+        redis_client = get_redis()
+        while True:
+            if redis_client.set(redis_key, in_flight, nx=True, ex=IDEMPOTENCY_LOCK_TTL):
+                break
+            stored = redis_client.get(redis_key)
+            if stored is not None:
+                record = json.loads(stored)
+                check_fingerprint(record, request_fingerprint)
+                if record["state"] == "done":
+                    return record["response"], True
+            if time.monotonic() >= deadline:
+                raise HTTPException(status_code=409, detail="Hay una solicitud con la misma Idempotency-Key en curso")
+            time.sleep(IDEMPOTENCY_POLL_INTERVAL)
+    except HTTPException:
+        raise
+    except Exception as e:
+        # Sin Redis se prefiere atender la solicitud antes que rechazarla
+        logging.error(f"Idempotencia no disponible, se ejecuta sin control de duplicados: {e}")
+        return handler(), False
+
+    try:
+        with keep_claimed(redis_client, redis_key, in_flight):
+            response = handler()
+    except BaseException:
+        try:
+            redis_client.delete(redis_key)  # el reintento vuelve a ejecutar
+        except Exception as e:
+            logging.error(f"No se pudo liberar la Idempotency-Key: {e}")
+        raise
+    done = {"state": "done", "fingerprint": request_fingerprint, "response": response}
+    try:
+        redis_client.set(redis_key, json.dumps(done, default=str), ex=IDEMPOTENCY_TTL)
+    except Exception as e:
+        logging.error(f"No se pudo guardar la respuesta de la Idempotency-Key: {e}")
+    return response, False
\ No newline at end of file
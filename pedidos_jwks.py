@@ -0,0 +1,124 @@
+import os
+import json
+import time
+from datetime import datetime, timezone
+import logging
+import threading
+import urllib.request
+
+import jwt
+
+# Verificacion local de los access tokens.
+#
+# usuarios firma los tokens con Ed25519 y publica las claves publicas en
+# JWKS_URL. Este modulo las descarga, las guarda por kid y las refresca en un
+# hilo cada JWKS_REFRESH_INTERVAL segundos; verificar un token no hace ninguna
+# llamada de red. Si llega un kid desconocido (usuarios roto la clave) se
+# fuerza una descarga, como mucho una cada JWKS_MIN_REFETCH_INTERVAL.
+#
+# Los tokens HS256 emitidos antes del cambio se aceptan solo si se pide
+# explicitamente: con JWT_SECRET_KEY y JWT_ACCEPT_HS256_UNTIL (fecha ISO 8601,
+# por ejemplo 2026-11-01T00:00:00Z). Pasada esa fecha se rechazan aunque el
+# secreto siga definido, y nunca se acepta uno que venza despues. Los access
+# tokens duran 15 minutos: alcanza con la hora del despliegue mas ese margen.
+
+JWKS_URL = os.getenv("JWKS_URL", "http://usuarios:8000/.well-known/jwks.json")
+JWKS_REFRESH_INTERVAL = float(os.getenv("JWKS_REFRESH_INTERVAL", "300"))
+JWKS_MIN_REFETCH_INTERVAL = float(os.getenv("JWKS_MIN_REFETCH_INTERVAL", "10"))
+LEGACY_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
+
+
+def parse_deadline(value: str | None) -> float | None:
+    """Fecha ISO 8601 como timestamp (UTC si no indica zona), o None si no esta definida."""
+    if not value:
+        return None
+    deadline = datetime.fromisoformat(value)
+    if deadline.tzinfo is None:
+        deadline = deadline.replace(tzinfo=timezone.utc)
+    return deadline.timestamp()
+
+
+ACCEPT_HS256_UNTIL = parse_deadline(os.getenv("JWT_ACCEPT_HS256_UNTIL"))
+
+ALGORITHM = "EdDSA"
+
+_keys = {}  # kid -> clave publica
+_fetched_at = 0.0
+_fetch_lock = threading.Lock()
+_refresher = None
+
+
+def fetch_keys():
+    """Descarga el JWKS y reemplaza las claves cacheadas."""
+    global _keys, _fetched_at
+    with urllib.request.urlopen(JWKS_URL, timeout=5) as response:
+        document = json.load(response)
+    keys = {}
+    for jwk in document.get("keys", []):
+        try:
+            keys[jwk["kid"]] = jwt.PyJWK(jwk).key
+        except (KeyError, jwt.PyJWTError) as e:
+            logging.warning(f"Clave del JWKS ignorada: {e}")
+    _keys = keys
+    _fetched_at = time.monotonic()
+
+
+def refetch_for_unknown_kid():
+    with _fetch_lock:
+        if time.monotonic() - _fetched_at < JWKS_MIN_REFETCH_INTERVAL:
+            return
+        try:
+            fetch_keys()
+        except Exception as e:
+            logging.error(f"No se pudo descargar el JWKS de {JWKS_URL}: {e}")
+
+
+def refresh_loop():
+    while True:
+        try:
+            with _fetch_lock:
+                fetch_keys()
+        except Exception as e:
+            logging.error(f"No se pudo descargar el JWKS de {JWKS_URL}: {e}")
+        time.sleep(JWKS_REFRESH_INTERVAL if _keys else JWKS_MIN_REFETCH_INTERVAL)
+
+
+def start_refresh():
+    """Lanza el hilo que mantiene las claves al dia. Se llama desde el lifespan."""
+    global _refresher
+    if _refresher is None:
+        _refresher = threading.Thread(target=refresh_loop, daemon=True, name="jwks-refresh")
+        _refresher.start()
+
+
+def accepts_legacy() -> bool:
+    return bool(LEGACY_SECRET_KEY) and ACCEPT_HS256_UNTIL is not None and time.time() < ACCEPT_HS256_UNTIL
+
+
+def decode_legacy(token: str) -> dict:
+    """Token HS256 anterior al cambio: solo dentro de la ventana de JWT_ACCEPT_HS256_UNTIL."""
+    if not accepts_legacy():
+        raise jwt.InvalidTokenError("Ya no se aceptan tokens HS256")
+    payload = jwt.decode(token, LEGACY_SECRET_KEY, algorithms=["HS256"], options={"require": ["exp"]})
+    if payload["exp"] > ACCEPT_HS256_UNTIL:
+        raise jwt.InvalidTokenError("Token HS256 con vencimiento posterior a JWT_ACCEPT_HS256_UNTIL")
+    return payload
+
+
+def decode(token: str) -> dict:
+    """
+    Verifica el token y devuelve su payload. Lanza jwt.PyJWTError si el token
+    no es valido o fue firmado con una clave que no esta en el JWKS.
+    """
+    header = jwt.get_unverified_header(token)
+    if header.get("alg") == "HS256":
+        return decode_legacy(token)
+
+    kid = header.get("kid")
+    key = _keys.get(kid)
+    if key is None:
+        refetch_for_unknown_kid()
+        key = _keys.get(kid)
+        if key is None:
+            raise jwt.InvalidTokenError(f"Clave de firma desconocida: {kid}")
+    return jwt.decode(token, key, algorithms=[ALGORITHM])
\ No newline at end of file
@@ -1,25 +1,123 @@
+import time
+
+# Marca del inicio del arranque, para medir cuanto tarda el servicio en estar listo
+IMPORT_STARTED = time.perf_counter()
+
 import os
+import base64
+import fcntl
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
 from fastapi.security import OAuth2PasswordBearer
 import jwt
-import pika  # para interactuar con RabbitMQ
-from fastapi import FastAPI, Depends, HTTPException, status
+import jwks
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Response, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy import func, select, text, tuple_
 from sqlalchemy.orm import Session
 from dotenv import load_dotenv
 import json
 
-from database import create_tables, get_db
-from models import Order as OrderModel
-from schemas import Order, OrderCreate
-from typing import Any
+from database import engine, get_db, SessionLocal
+from models import Order as OrderModel, OrderRollup, RollupState
+from schemas import Order, OrderCreate, OrderPage, OrderStats, OrderStatus
+from consumer import FINAL_STATUSES
+import events
+import idempotency
+import sharding
+import prices
+import rollups
+import profiling
+import logging_config
+from typing import Any, Optional
+
+# Logs en JSON, con request_id y escritos desde un hilo aparte (ver logging_config.py)
+logging_config.setup("pedidos")
+
+# --- Arranque ---
+# El esquema lo aplica migrations.py antes de levantar Uvicorn, aca no hay DDL.
+# El lifespan calienta el pool de conexiones y arranca el consumidor de
+# estados; /health/ready devuelve 503 hasta que termina y luego informa
+# cuanto tardo cada fase.
+startup_phases = {}
+ready = False
+
+def record_phase(name: str, started: float):
+    startup_phases[name] = round((time.perf_counter() - started) * 1000, 1)
+
+def check_database():
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+
+# --- Varios workers (WEB_CONCURRENCY) ---
+# Con `uvicorn --workers N` cada proceso ejecuta el lifespan. El consumidor de
+# estados debe correr una sola vez por contenedor: cada worker espera en un
+# hilo el lock de STATUS_CONSUMER_LOCK y el que lo obtiene consume. El sistema
+# operativo libera el lock si ese proceso muere, y otro worker lo reemplaza.
+# Los workers que no consumen ven los cambios al releer la base cada
+# STATUS_RECHECK_INTERVAL segundos en /orders/{id}/status y /events.
+STATUS_CONSUMER_LOCK = os.getenv("STATUS_CONSUMER_LOCK", "/tmp/pedidos-status-consumer.lock")
+
+def run_status_consumer_once():
+    from consumer import start_status_consumer
+
+    lock_file = open(STATUS_CONSUMER_LOCK, "w")
+    fcntl.flock(lock_file, fcntl.LOCK_EX)  # bloquea hasta ser el unico consumidor del contenedor
+    logging.info(f"El worker {os.getpid()} inicia el consumidor de estados.")
+    start_status_consumer()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global ready
+    started = time.perf_counter()
+    # Descarta conexiones heredadas si el proceso se creo con fork (gunicorn --preload):
+    # cada worker abre su propio pool
+    engine.dispose(close=False)
+    try:
+        await run_in_threadpool(check_database)
+    except Exception as e:
+        # No se aborta el arranque: /health/ready seguira respondiendo 503
+        logging.error(f"No se pudo conectar a la base de datos al iniciar: {e}")
+    record_phase("database", started)
+
+    # Claves publicas de usuarios para verificar tokens, en segundo plano
+    jwks.start_refresh()
+
+    # Cache de precios de productos: cada worker consume los eventos en su propia cola
+    prices.start()
+
+    # Ventas acumuladas para /orders/stats, en segundo plano
+    rollups.start()
+
+    # Lanza el consumidor de estados de pedidos en un hilo separado, en un solo worker por contenedor
+    started = time.perf_counter()
+    events.bind_loop(asyncio.get_running_loop())
+    consumer_thread = threading.Thread(target=run_status_consumer_once)
+    consumer_thread.daemon = True
+    consumer_thread.start()
+    record_phase("status_consumer", started)
 
+    record_phase("total", IMPORT_STARTED)
+    ready = True
+    logging.info(f"Servicio de pedidos listo en {startup_phases['total']} ms: {startup_phases}")
+    yield
+    ready = False
 
-create_tables()
+app = FastAPI(lifespan=lifespan)
 
-app = FastAPI()
+# Perfilado opcional por request (ver profiling.py)
+profiling.install(app, jwks.decode)
+profiling.instrument_engine(engine)
+logging_config.install(app)
 
+# Cada cuanto se vuelve a leer el estado de la base mientras se espera un cambio.
+# Cubre los eventos aplicados por otro proceso, que no llegan a la cola en memoria.
+STATUS_RECHECK_INTERVAL = float(os.getenv("STATUS_RECHECK_INTERVAL", "5"))
 
-SECRET_KEY = os.getenv("JWT_SECRET_KEY")
-ALGORITHM = "HS256"
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token")
 
@@ -30,66 +128,343 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
         detail="No se pudo validar el token",
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwks.decode(token)  # Verifica la firma con las claves publicas de usuarios (ver jwks.py)
         username: str = payload.get("sub")
         role: str = payload.get("role")
         if username is None or role is None:
             raise credentials_exception
-        return {"username": username, "role": role}
+        return {"username": username, "role": role, "user_id": payload.get("user_id")}
     except jwt.PyJWTError:
         raise credentials_exception
 
 # --- Función para publicar en RabbitMQ ---
+# Los pedidos se publican en order_exchange con el numero de shard como routing
+# key, calculado con un hash consistente sobre product_id. La cantidad de shards
+# y los argumentos de las colas deben coincidir con el consumidor de productos,
+# si no RabbitMQ rechaza el queue_declare.
+ORDER_EXCHANGE = "order_exchange"
+ORDER_QUEUE = "order_queue"
+ORDER_QUEUE_SHARDS = int(os.getenv("ORDER_QUEUE_SHARDS", "8"))
+SHARD_QUEUE_ARGS = {
+    "x-dead-letter-exchange": "order_dlx",
+    "x-dead-letter-routing-key": ORDER_QUEUE,
+    "x-single-active-consumer": True,
+}
+
 def publish_to_rabbitmq(message):
+    import pika  # para interactuar con RabbitMQ; se importa en el primer pedido y no al arrancar
+
+    shard = sharding.jump_hash(message["product_id"], ORDER_QUEUE_SHARDS)  # mismo reparto que productos
+    queue = f"{ORDER_QUEUE}.{shard}"
     connection = None
     try:
         connection = pika.BlockingConnection(pika.ConnectionParameters(host=os.getenv("RABBITMQ_HOST")))
         channel = connection.channel()
-        channel.queue_declare(queue='order_queue')
+        channel.exchange_declare(exchange=ORDER_EXCHANGE, exchange_type="direct", durable=True)
+        channel.queue_declare(queue=queue, durable=True, arguments=SHARD_QUEUE_ARGS)
+        channel.queue_bind(queue=queue, exchange=ORDER_EXCHANGE, routing_key=str(shard))
         channel.basic_publish(
-            exchange='',
-            routing_key='order_queue',
-            body=json.dumps(message)
+            exchange=ORDER_EXCHANGE,
+            routing_key=str(shard),
+            body=json.dumps(message),
+            properties=pika.BasicProperties(
+                delivery_mode=2,  # mensaje persistente
+                headers={"request_id": logging_config.request_id.get()}  # productos lo agrega a sus logs
+            )
         )
-        print(f" [x] Mensaje enviado a RabbitMQ: {message}")
+        logging.debug("Mensaje enviado a RabbitMQ (%s): %s", queue, message)
     finally:
         if connection and connection.is_open:
             connection.close()
 
+# --- Paginacion por keyset ---
+# El cursor codifica (created_at, id) del ultimo pedido devuelto, asi la
+# siguiente pagina continua desde ahi usando el indice (user_id, created_at, id)
+# en lugar de un OFFSET que recorre todas las filas anteriores.
+
+def encode_cursor(order: OrderModel) -> str:
+    raw = f"{order.created_at.isoformat()}|{order.id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        created_at, order_id = raw.split("|")
+        return datetime.fromisoformat(created_at), int(order_id)
+    except (ValueError, UnicodeError):
+        raise HTTPException(status_code=400, detail="Cursor de paginación inválido")
+
+# --- Total del pedido ---
+# El total se calcula con el precio de la cache local de productos (ver
+# prices.py), sin una llamada a productos por pedido salvo que el producto no
+# este en la cache.
+
+def price_order(order: OrderCreate) -> float:
+    if order.quantity <= 0:
+        raise HTTPException(status_code=400, detail="La cantidad debe ser mayor a cero")
+    try:
+        product = prices.lookup([order.product_id]).get(order.product_id)
+    except Exception as e:
+        logging.error(f"No se pudo obtener el precio del producto {order.product_id}: {e}")
+        raise HTTPException(status_code=503, detail="No se pudo obtener el precio del producto")
+    if product is None:
+        raise HTTPException(status_code=404, detail="Producto no encontrado")
+    price, stock = product
+    if stock < order.quantity:
+        raise HTTPException(status_code=409, detail="Stock insuficiente")
+    return round(price * order.quantity, 2)
+
 # --- Endpoints ---
 
 @app.post("/orders/create", response_model=OrderCreate)
-def create_order(order: OrderCreate, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)) -> Any:
+def create_order(
+    order: OrderCreate,
+    response: Response,
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+) -> Any:
 
-    print(f"Datos recibidos en el microservicio de pedidos: {order.model_dump()}")
+    logging.debug("Datos recibidos en el microservicio de pedidos: %s", order)
 
     if current_user["role"] != "user":
         raise HTTPException(status_code=403, detail="No tienes permiso para crear pedidos")
-    # Aquí puedes agregar lógica para verificar si el usuario tiene permiso
-    
-    db_order = OrderModel(
-        user_id=order.user_id,
-        product_id=order.product_id,
-        quantity=order.quantity,
-        total_price=order.total_price,
-        status="pending"
-    )
-    
-    db.add(db_order)
-    db.commit()
-    db.refresh(db_order)
+    # El pedido queda siempre a nombre del usuario del token, no del user_id que envia el cliente
+    if current_user.get("user_id") is None:
+        raise HTTPException(status_code=401, detail="El token no contiene el usuario, vuelve a iniciar sesión")
+    order = order.model_copy(update={"user_id": current_user["user_id"]})
+
+    def create() -> dict:
+        db_order = OrderModel(
+            user_id=order.user_id,
+            product_id=order.product_id,
+            quantity=order.quantity,
+            total_price=price_order(order),
+            status="pending"
+        )
+
+        db.add(db_order)
+        db.commit()
+        db.refresh(db_order)
+
+        # Publica un mensaje en RabbitMQ para que el servicio de productos actualice el stock
+        message = {
+            "order_id": db_order.id,
+            "product_id": order.product_id,
+            "quantity": order.quantity
+        }
+        with profiling.timed("rabbitmq order_exchange"):
+            publish_to_rabbitmq(message)
+
+        logging.info(f"Pedido {db_order.id} creado: producto {order.product_id}, cantidad {order.quantity}")
 
-    print("DB Order después de refresh:", db_order.__dict__)
+        return Order.model_validate(db_order).model_dump(mode="json")
 
+    # Con Idempotency-Key un reintento devuelve el pedido ya creado sin volver
+    # a insertarlo ni a publicar otro descuento de stock (ver idempotency.py)
+    body, replayed = idempotency.run("orders.create", current_user["username"], idempotency_key, order.model_dump(mode="json"), create)
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return body
 
-    # Publica un mensaje en RabbitMQ para que el servicio de productos actualice el stock
-    message = {
-        "order_id": db_order.id,
-        "product_id": order.product_id,
-        "quantity": order.quantity
+@app.get("/orders", response_model=OrderPage)
+def list_orders(
+    user_id: int,
+    status_filter: Optional[str] = Query(None, alias="status"),
+    since: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+) -> Any:
+    """
+    Historial de pedidos de un usuario, del mas reciente al mas antiguo.
+
+    Un usuario solo puede leer sus propios pedidos; los administradores pueden
+    consultar cualquier user_id.
+    """
+    if current_user["role"] != "admin" and current_user.get("user_id") != user_id:
+        raise HTTPException(status_code=403, detail="No tienes permiso para ver estos pedidos")
+
+    query = db.query(OrderModel).filter(OrderModel.user_id == user_id)
+    if status_filter:
+        query = query.filter(OrderModel.status == status_filter)
+    if since:
+        query = query.filter(OrderModel.created_at >= since)
+    if cursor:
+        last_created_at, last_id = decode_cursor(cursor)
+        query = query.filter(tuple_(OrderModel.created_at, OrderModel.id) < tuple_(last_created_at, last_id))
+
+    # Se pide una fila extra para saber si existe una pagina siguiente
+    orders = query.order_by(OrderModel.created_at.desc(), OrderModel.id.desc()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(orders) > limit:
+        orders = orders[:limit]
+        next_cursor = encode_cursor(orders[-1])
+
+    return {"items": orders, "next_cursor": next_cursor}
+
+# --- Reportes de ventas ---
+# Se leen solo de order_rollups (ver rollups.py), sin recorrer orders.
+STATS_GROUP_COLUMNS = {"day": OrderRollup.day, "product_id": OrderRollup.product_id, "status": OrderRollup.status}
+STATS_MAX_DAYS = int(os.getenv("STATS_MAX_DAYS", "366"))
+
+@app.get("/orders/stats", response_model=OrderStats)
+def order_stats(
+    since: Optional[date] = None,
+    until: Optional[date] = None,
+    product_id: Optional[int] = None,
+    status_filter: Optional[str] = Query(None, alias="status"),
+    group_by: str = "day,product_id,status",
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+) -> Any:
+    """
+    Pedidos, unidades e ingresos entre since y until (por defecto los ultimos
+    30 dias), agrupados por las columnas de group_by (day, product_id, status).
+    Solo administradores.
+    """
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="No tienes permiso para ver las estadísticas")
+
+    until = until or date.today()
+    since = since or until - timedelta(days=29)
+    if since > until or (until - since).days >= STATS_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"El rango debe ser de 1 a {STATS_MAX_DAYS} días")
+    group_names = [name.strip() for name in group_by.split(",") if name.strip()]
+    if any(name not in STATS_GROUP_COLUMNS for name in group_names):
+        raise HTTPException(status_code=400, detail=f"group_by admite: {', '.join(STATS_GROUP_COLUMNS)}")
+    group_columns = [STATS_GROUP_COLUMNS[name] for name in dict.fromkeys(group_names)]
+
+    filters = [OrderRollup.day >= since, OrderRollup.day <= until]
+    if product_id is not None:
+        filters.append(OrderRollup.product_id == product_id)
+    if status_filter:
+        filters.append(OrderRollup.status == status_filter)
+    measures = [
+        func.coalesce(func.sum(OrderRollup.orders), 0).label("orders"),
+        func.coalesce(func.sum(OrderRollup.units), 0).label("units"),
+        func.coalesce(func.sum(OrderRollup.revenue), 0).label("revenue"),
+    ]
+
+    rows = db.execute(
+        select(*group_columns, *measures).where(*filters).group_by(*group_columns).order_by(*group_columns)
+    ).mappings().all()
+    totals = db.execute(select(*measures).where(*filters)).mappings().one()
+    up_to_order_id = db.execute(
+        select(RollupState.last_order_id).where(RollupState.name == rollups.STATE_NAME)
+    ).scalar() or 0
+
+    return {
+        "since": since,
+        "until": until,
+        "up_to_order_id": up_to_order_id,
+        "items": [dict(row) for row in rows],
+        "totals": dict(totals),
     }
-    publish_to_rabbitmq(message)
 
-    print("Pedido guardado en la base de datos:", db_order.__dict__)
+# --- Seguimiento del estado de un pedido ---
+
+def load_order_status(order_id: int, current_user: dict) -> dict:
+    db = SessionLocal()
+    try:
+        order = db.query(OrderModel).filter(OrderModel.id == order_id).first()
+        if not order:
+            raise HTTPException(status_code=404, detail="Pedido no encontrado")
+        if current_user["role"] != "admin" and current_user.get("user_id") != order.user_id:
+            raise HTTPException(status_code=403, detail="No tienes permiso para ver este pedido")
+        return {"order_id": order.id, "status": order.status, "reason": order.status_reason}
+    finally:
+        db.close()
+
+async def next_status_change(queue: asyncio.Queue, timeout: float) -> dict | None:
+    """
+    Espera hasta timeout segundos un evento en la cola del pedido.
+    Devuelve None si no llega ninguno; el llamador relee entonces la base
+    por si el cambio lo aplico otro proceso.
+    """
+    try:
+        return await asyncio.wait_for(queue.get(), timeout=timeout)
+    except asyncio.TimeoutError:
+        return None
+
+@app.get("/orders/{order_id}/status", response_model=OrderStatus)
+async def wait_order_status(
+    order_id: int,
+    wait: float = Query(0, ge=0, le=60),
+    known: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+) -> Any:
+    """
+    Long-poll del estado de un pedido.
+
+    Devuelve enseguida si el pedido ya esta en un estado final o si su estado
+    es distinto de `known`; si no, espera hasta `wait` segundos un cambio.
+    """
+    # Se suscribe antes de leer la base para no perder un evento entre ambos pasos
+    queue = events.subscribe(order_id)
+    try:
+        current = await run_in_threadpool(load_order_status, order_id, current_user)
+        known = known or current["status"]
+        deadline = time.monotonic() + wait
+
+        while current["status"] == known and current["status"] not in FINAL_STATUSES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            event = await next_status_change(queue, min(remaining, STATUS_RECHECK_INTERVAL))
+            current = event or await run_in_threadpool(load_order_status, order_id, current_user)
+        return current
+    finally:
+        events.unsubscribe(order_id, queue)
+
+@app.get("/orders/{order_id}/events")
+async def order_status_events(order_id: int, current_user: dict = Depends(get_current_user)):
+    """
+    Stream SSE con el estado del pedido. Envia el estado actual y luego cada
+    cambio; se cierra cuando el pedido llega a un estado final.
+    """
+    queue = events.subscribe(order_id)
+    try:
+        current = await run_in_threadpool(load_order_status, order_id, current_user)
+    except HTTPException:
+        events.unsubscribe(order_id, queue)
+        raise
+
+    async def stream():
+        nonlocal current
+        try:
+            yield f"event: status\ndata: {json.dumps(current)}\n\n"
+            while current["status"] not in FINAL_STATUSES:
+                event = await next_status_change(queue, STATUS_RECHECK_INTERVAL)
+                latest = event or await run_in_threadpool(load_order_status, order_id, current_user)
+                if latest["status"] != current["status"]:
+                    current = latest
+                    yield f"event: status\ndata: {json.dumps(current)}\n\n"
+                else:
+                    yield ": keepalive\n\n"  # comentario SSE para mantener viva la conexion
+        finally:
+            events.unsubscribe(order_id, queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+# --- Sondeos de salud ---
+# /health/live solo indica que el proceso responde (no reiniciarlo);
+# /health/ready indica si puede recibir trafico.
+
+@app.get("/health/live")
+def liveness():
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness():
+    if not ready:
+        return JSONResponse(status_code=503, content={"status": "starting", "startup_ms": startup_phases})
+    try:
+        await run_in_threadpool(check_database)
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"status": "unavailable", "detail": f"Base de datos: {e}"})
+    return {"status": "ready", "startup_ms": startup_phases}
 
-    return db_order
\ No newline at end of file
+record_phase("imports", IMPORT_STARTED)
\ No newline at end of file
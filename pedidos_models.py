@@ -1,5 +1,5 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, Date, DateTime, ForeignKey, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 
@@ -14,4 +14,39 @@ class Order(Base):
     quantity = Column(Integer)
     total_price = Column(Float)
     created_at = Column(DateTime, server_default=func.now())
-    status = Column(String, default="pending")
\ No newline at end of file
+    status = Column(String, default="pending")
+    status_reason = Column(String, nullable=True)  # motivo del rechazo informado por productos
+
+    # Indices compuestos para el historial de pedidos.
+    # (user_id, created_at, id) soporta la paginacion por keyset de GET /orders,
+    # el resto cubre los filtros por estado y las busquedas por producto.
+    __table_args__ = (
+        Index("ix_orders_user_id_created_at", "user_id", "created_at", "id"),
+        Index("ix_orders_user_id_status_created_at", "user_id", "status", "created_at"),
+        Index("ix_orders_status_created_at", "status", "created_at"),
+        Index("ix_orders_product_id", "product_id"),
+    )
+
+# Ventas acumuladas por producto, dia y estado (ver rollups.py). Los reportes
+# leen esta tabla en lugar de agregar orders.
+class OrderRollup(Base):
+    __tablename__ = "order_rollups"
+
+    product_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    status = Column(String, primary_key=True)
+    orders = Column(Integer, nullable=False, default=0)
+    units = Column(Integer, nullable=False, default=0)
+    revenue = Column(Float, nullable=False, default=0)
+
+    __table_args__ = (
+        Index("ix_order_rollups_day", "day"),
+    )
+
+# Hasta que pedido (orders.id) estan incluidos los pedidos en order_rollups.
+class RollupState(Base):
+    __tablename__ = "rollup_state"
+
+    name = Column(String, primary_key=True)
+    last_order_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
\ No newline at end of file
@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import logging
+import threading
+import urllib.request
+from collections import OrderedDict
+
+import profiling
+
+# Cache local de precios y stock de productos.
+#
+# pedidos calcula el total de cada pedido con el precio de esta cache en lugar
+# de confiar en el total_price que envia el cliente. La cache se alimenta de
+# los eventos que productos publica en el exchange fanout product_events al
+# crear, modificar o eliminar un producto: cada proceso tiene su propia cola
+# exclusiva y su propia cache, asi crear un pedido no llama a productos.
+#
+# Solo si un producto no esta en la cache (o su entrada vencio) se consulta
+# /products/by-ids, en lotes. La cache guarda hasta PRICE_CACHE_SIZE productos
+# (descarta los menos usados) y cada entrada vence a los PRICE_CACHE_TTL
+# segundos, por si se perdio algun evento. Al reconectar a RabbitMQ la cache
+# se vacia: los eventos publicados mientras no habia cola no llegan.
+#
+# El stock es el del ultimo cambio del producto; los pedidos lo descuentan sin
+# publicar eventos, asi que solo sirve para rechazar pedidos que seguro no
+# alcanzan. El descuento real lo sigue decidiendo productos.
+
+PRODUCTS_SERVICE_URL = os.getenv("PRODUCTS_SERVICE_URL", "http://productos:8000")
+PRICE_CACHE_SIZE = int(os.getenv("PRICE_CACHE_SIZE", "10000"))
+PRICE_CACHE_TTL = float(os.getenv("PRICE_CACHE_TTL", "300"))
+PRODUCTS_FETCH_TIMEOUT = float(os.getenv("PRODUCTS_FETCH_TIMEOUT", "2"))
+# Ids por consulta a /products/by-ids; no debe superar PRODUCTS_BY_IDS_MAX de productos
+PRODUCTS_FETCH_BATCH = int(os.getenv("PRODUCTS_FETCH_BATCH", "500"))
+
+PRODUCT_EVENTS_EXCHANGE = "product_events"
+
+_cache = OrderedDict()  # product_id -> (precio, stock, time.monotonic() al guardarlo)
+_lock = threading.Lock()
+_consumer = None
+
+
+def store(product_id: int, price: float, stock: int):
+    with _lock:
+        _cache[product_id] = (price, stock, time.monotonic())
+        _cache.move_to_end(product_id)
+        while len(_cache) > PRICE_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def forget(product_id: int):
+    with _lock:
+        _cache.pop(product_id, None)
+
+
+def clear():
+    with _lock:
+        _cache.clear()
+
+
+def cached(product_id: int) -> tuple[float, int] | None:
+    with _lock:
+        entry = _cache.get(product_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[2] > PRICE_CACHE_TTL:
+            del _cache[product_id]
+            return None
+        _cache.move_to_end(product_id)
+        return entry[0], entry[1]
+
+
+def fetch(product_ids: list[int]) -> dict[int, tuple[float, int]]:
+    """Consulta los productos en productos, en lotes, y los guarda en la cache."""
+    found = {}
+    for start in range(0, len(product_ids), PRODUCTS_FETCH_BATCH):
+        batch = product_ids[start:start + PRODUCTS_FETCH_BATCH]
+        url = f"{PRODUCTS_SERVICE_URL}/products/by-ids?ids={','.join(map(str, batch))}"
+        with profiling.timed("GET productos/products/by-ids"):
+            with urllib.request.urlopen(url, timeout=PRODUCTS_FETCH_TIMEOUT) as response:
+                products = json.load(response)
+        for product in products:
+            store(product["id"], product["price"], product["stock"])
+            found[product["id"]] = (product["price"], product["stock"])
+    return found
+
+
+def lookup(product_ids) -> dict[int, tuple[float, int]]:
+    """
+    Precio y stock de los productos indicados: primero la cache, los que faltan
+    en una consulta por lotes. Los productos que no existen no aparecen en el
+    resultado. Lanza la excepcion de red si productos no responde.
+    """
+    result = {}
+    missing = []
+    for product_id in dict.fromkeys(product_ids):
+        entry = cached(product_id)
+        if entry is None:
+            missing.append(product_id)
+        else:
+            result[product_id] = entry
+    if missing:
+        result.update(fetch(missing))
+    return result
+
+
+def apply_event(body: bytes):
+    try:
+        event = json.loads(body)
+        if event["type"] == "delete":
+            forget(int(event["id"]))
+        else:
+            store(int(event["id"]), float(event["price"]), int(event["stock"]))
+    except (ValueError, KeyError, TypeError) as e:
+        logging.error(f"Evento de producto inválido descartado: {e}")
+
+
+def consume_product_events():
+    import pika  # diferido: main.py importa este modulo sin necesitar RabbitMQ
+
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=os.getenv("RABBITMQ_HOST")))
+    channel = connection.channel()
+    channel.exchange_declare(exchange=PRODUCT_EVENTS_EXCHANGE, exchange_type="fanout", durable=True)
+    # Cola exclusiva de este proceso: RabbitMQ la borra al cerrarse la conexion
+    queue = channel.queue_declare(queue="", exclusive=True).method.queue
+    channel.queue_bind(queue=queue, exchange=PRODUCT_EVENTS_EXCHANGE)
+    # Mientras no habia cola se pudo perder algun evento: se descarta lo cacheado
+    clear()
+    for method, properties, body in channel.consume(queue, auto_ack=True):
+        apply_event(body)
+
+
+def consume_loop():
+    import pika
+
+    while True:
+        try:
+            consume_product_events()
+        except pika.exceptions.AMQPConnectionError as e:
+            logging.error(f"No se pudo conectar a RabbitMQ para los eventos de productos: {e}. Reintentando en 5 segundos...")
+        except Exception as e:
+            logging.error(f"Error inesperado en el consumidor de eventos de productos: {e}. Reintentando en 5 segundos...")
+        time.sleep(5)
+
+
+def start():
+    """Lanza el consumidor de eventos de productos. Se llama desde el lifespan, una vez por worker."""
+    global _consumer
+    if _consumer is None:
+        _consumer = threading.Thread(target=consume_loop, daemon=True, name="product-events")
+        _consumer.start()
\ No newline at end of file
@@ -0,0 +1,188 @@
+import os
+import sys
+import time
+import logging
+import threading
+from collections import defaultdict
+
+from sqlalchemy import select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from database import SessionLocal
+from models import OrderRollup, RollupState
+
+# Ventas acumuladas por producto, dia y estado.
+#
+# order_rollups guarda pedidos, unidades e ingresos por (product_id, dia,
+# estado) y rollup_state.last_order_id marca hasta que pedido estan incluidos.
+# /orders/stats lee solo order_rollups, nunca agrega orders.
+#
+# - Ingesta: cada ROLLUP_INTERVAL segundos se agregan, en lotes de hasta
+#   ROLLUP_BATCH_SIZE, los pedidos con id mayor a la marca, con el estado que
+#   tienen en ese momento. El lote se corta antes del primer id creado hace
+#   menos de ROLLUP_DELAY segundos: los ids siguientes no se toman aunque
+#   sean viejos, asi la marca nunca pasa por encima de un id cuya
+#   transaccion todavia no confirmo.
+# - Cambios de estado: el consumidor de estados llama a apply_transitions en
+#   la misma transaccion que actualiza orders. Para los pedidos ya incluidos
+#   (id <= marca) mueve la fila del estado anterior al nuevo. Los posteriores
+#   entran mas tarde ya con el estado nuevo.
+# Ambos toman la fila de rollup_state con FOR UPDATE, asi ningun pedido se
+# cuenta dos veces ni en el estado equivocado.
+#
+# `python rollups.py backfill` vacia order_rollups y la reconstruye desde
+# orders en lotes de ROLLUP_BACKFILL_CHUNK, confirmando cada lote para no
+# bloquear al consumidor de estados durante toda la reconstruccion.
+
+ROLLUP_INTERVAL = float(os.getenv("ROLLUP_INTERVAL", "5"))
+ROLLUP_BATCH_SIZE = int(os.getenv("ROLLUP_BATCH_SIZE", "5000"))
+ROLLUP_DELAY = float(os.getenv("ROLLUP_DELAY", "5"))
+ROLLUP_BACKFILL_CHUNK = int(os.getenv("ROLLUP_BACKFILL_CHUNK", "50000"))
+
+STATE_NAME = "orders"
+
+# Un lote: agrega los pedidos en una sola sentencia y devuelve el ultimo id incluido
+INGEST_SQL = text("""
+    WITH too_new AS (
+        SELECT min(id) AS id
+        FROM orders
+        WHERE id > :last_order_id AND created_at > now() - make_interval(secs => :delay)
+    ), batch AS (
+        SELECT orders.id, product_id, created_at, status, quantity, total_price
+        FROM orders, too_new
+        WHERE orders.id > :last_order_id AND (too_new.id IS NULL OR orders.id < too_new.id)
+        ORDER BY orders.id
+        LIMIT :limit
+    ), merged AS (
+        INSERT INTO order_rollups (product_id, day, status, orders, units, revenue)
+        SELECT product_id, created_at::date, status, count(*), sum(quantity), coalesce(sum(total_price), 0)
+        FROM batch
+        GROUP BY product_id, created_at::date, status
+        ON CONFLICT (product_id, day, status) DO UPDATE SET
+            orders = order_rollups.orders + excluded.orders,
+            units = order_rollups.units + excluded.units,
+            revenue = order_rollups.revenue + excluded.revenue
+    )
+    SELECT max(id), count(*) FROM batch
+""")
+
+_worker = None
+
+
+def lock_state(db, skip_locked: bool = False) -> RollupState | None:
+    """Toma la fila de rollup_state. Con skip_locked devuelve None si otro proceso la tiene."""
+    return db.execute(
+        select(RollupState).where(RollupState.name == STATE_NAME).with_for_update(skip_locked=skip_locked)
+    ).scalar_one_or_none()
+
+
+def ingest_batch(limit: int = ROLLUP_BATCH_SIZE, wait: bool = False) -> int:
+    """
+    Agrega el siguiente lote de pedidos a order_rollups. Devuelve cuantos
+    pedidos incorporo. Sin wait devuelve 0 si otro proceso esta ingiriendo.
+    """
+    db = SessionLocal()
+    try:
+        state = lock_state(db, skip_locked=not wait)
+        if state is None:
+            return 0
+        last_order_id, count = db.execute(
+            INGEST_SQL, {"last_order_id": state.last_order_id, "delay": ROLLUP_DELAY, "limit": limit}
+        ).one()
+        if count:
+            state.last_order_id = last_order_id
+        db.commit()
+        return count
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def apply_transitions(db, transitions: list[tuple]):
+    """
+    Mueve a su estado nuevo los pedidos ya incluidos en order_rollups.
+    transitions son tuplas (order_id, product_id, created_at, quantity,
+    total_price, estado anterior, estado nuevo). No confirma la transaccion.
+    """
+    if not transitions:
+        return
+    state = lock_state(db)
+    if state is None:
+        return
+    deltas = defaultdict(lambda: [0, 0, 0.0])
+    for order_id, product_id, created_at, quantity, total_price, old_status, new_status in transitions:
+        if order_id > state.last_order_id:
+            continue  # la ingesta lo tomara con el estado nuevo
+        for status, sign in ((old_status, -1), (new_status, 1)):
+            delta = deltas[(product_id, created_at.date(), status)]
+            delta[0] += sign
+            delta[1] += sign * (quantity or 0)
+            delta[2] += sign * (total_price or 0)
+    if not deltas:
+        return
+    rows = [
+        {"product_id": product_id, "day": day, "status": status, "orders": orders, "units": units, "revenue": revenue}
+        for (product_id, day, status), (orders, units, revenue) in deltas.items()
+    ]
+    statement = insert(OrderRollup).values(rows)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=["product_id", "day", "status"],
+        set_={
+            "orders": OrderRollup.orders + statement.excluded.orders,
+            "units": OrderRollup.units + statement.excluded.units,
+            "revenue": OrderRollup.revenue + statement.excluded.revenue,
+        },
+    ))
+
+
+def ingest_loop():
+    while True:
+        try:
+            # Se sigue sin esperar mientras haya lotes completos pendientes
+            while ingest_batch() >= ROLLUP_BATCH_SIZE:
+                pass
+        except Exception as e:
+            logging.error(f"No se pudieron actualizar las ventas acumuladas: {e}")
+        time.sleep(ROLLUP_INTERVAL)
+
+
+def start():
+    """Lanza la ingesta en un hilo. Se llama desde el lifespan; si hay varios workers, uno ingiere y los demas saltean el lote."""
+    global _worker
+    if _worker is None:
+        _worker = threading.Thread(target=ingest_loop, daemon=True, name="order-rollups")
+        _worker.start()
+
+
+def backfill():
+    """Reconstruye order_rollups desde todo el historial de orders."""
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        state = lock_state(db)
+        db.execute(text("DELETE FROM order_rollups"))
+        state.last_order_id = 0
+        db.commit()
+    finally:
+        db.close()
+
+    total = 0
+    while True:
+        # Los pedidos de los ultimos ROLLUP_DELAY segundos los completa la ingesta normal
+        count = ingest_batch(limit=ROLLUP_BACKFILL_CHUNK, wait=True)
+        total += count
+        if count < ROLLUP_BACKFILL_CHUNK:
+            break
+        logging.info(f"Backfill de ventas acumuladas: {total} pedidos")
+    logging.info(f"Backfill de ventas acumuladas terminado: {total} pedidos en {(time.perf_counter() - started):.1f} s")
+
+
+if __name__ == "__main__":
+    import logging_config
+
+    logging_config.setup("pedidos-rollups")
+    if sys.argv[1:] != ["backfill"]:
+        sys.exit("Uso: python rollups.py backfill")
+    backfill()
\ No newline at end of file
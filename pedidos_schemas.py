@@ -1,6 +1,6 @@
 from pydantic import BaseModel, ConfigDict
-from typing import Optional
-from datetime import datetime
+from typing import List, Optional
+from datetime import date, datetime
 
 class OrderBase(BaseModel):
     user_id: int
@@ -8,8 +8,14 @@ class OrderBase(BaseModel):
     quantity: int
     total_price: float
 
-class OrderCreate(OrderBase):
-    pass
+# user_id y total_price se aceptan por compatibilidad pero se ignoran: el
+# usuario sale del token y pedidos calcula el total con el precio del
+# producto (ver prices.py).
+class OrderCreate(BaseModel):
+    user_id: Optional[int] = None
+    product_id: int
+    quantity: int
+    total_price: Optional[float] = None
 
 class OrderUpdate(BaseModel):
     status: Optional[str] = None
@@ -17,6 +23,7 @@ class OrderUpdate(BaseModel):
 class Order(OrderBase):
     id: int
     status: str
+    status_reason: Optional[str] = None
     created_at: datetime
 
     class Config:
@@ -24,4 +31,31 @@ class Order(OrderBase):
 
     #model_config = ConfigDict(from_attributes=True)
 
-    
\ No newline at end of file
+# Pagina de resultados del historial de pedidos.
+# next_cursor es None cuando no hay mas pedidos que leer.
+class OrderPage(BaseModel):
+    items: List[Order]
+    next_cursor: Optional[str] = None
+
+# Estado actual de un pedido, usado por el long-poll y los eventos SSE.
+class OrderStatus(BaseModel):
+    order_id: int
+    status: str
+    reason: Optional[str] = None
+
+# Fila de /orders/stats. Las columnas que no estan en group_by quedan en None.
+class OrderStatsRow(BaseModel):
+    day: Optional[date] = None
+    product_id: Optional[int] = None
+    status: Optional[str] = None
+    orders: int
+    units: int
+    revenue: float
+
+# up_to_order_id indica hasta que pedido estan incluidas las ventas acumuladas.
+class OrderStats(BaseModel):
+    since: date
+    until: date
+    up_to_order_id: int
+    items: List[OrderStatsRow]
+    totals: OrderStatsRow
\ No newline at end of file
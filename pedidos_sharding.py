@@ -0,0 +1,45 @@
+# Reparto de pedidos entre las colas order_queue.<shard>.
+#
+# pedidos publica cada pedido en el shard de su product_id y los workers de
+# productos consumen cada shard por separado, asi los pedidos de un producto
+# se procesan en orden. Los dos servicios tienen una copia de este archivo
+# (pedidos_sharding.py y productos_sharding.py, sharding.py en cada imagen)
+# y deben ser identicas: si calculan shards distintos los pedidos caen en
+# colas que el worker dueño del producto no espera.
+#
+# REFERENCE fija la salida para algunas claves: al importar el modulo se
+# comprueba, asi una copia modificada falla al arrancar en lugar de repartir
+# mal en silencio.
+
+# (clave, buckets) -> bucket
+REFERENCE = {
+    (1, 8): 6,
+    (2, 8): 6,
+    (3, 8): 3,
+    (42, 8): 2,
+    (1000, 8): 5,
+    (123456789, 8): 7,
+    (123456789, 1000): 294,
+}
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """
+    Jump consistent hash (Lamping y Veach): asigna key a un bucket en
+    [0, buckets) moviendo el minimo de claves cuando cambia la cantidad.
+    """
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def check_reference():
+    for (key, buckets), expected in REFERENCE.items():
+        if jump_hash(key, buckets) != expected:
+            raise RuntimeError(f"jump_hash({key}, {buckets}) no coincide con la referencia {expected}: revisar la copia de sharding.py")
+
+
+check_reference()
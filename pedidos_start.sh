@@ -1,17 +1,15 @@
 #!/bin/bash
 
-# Este comando espera a que la base de datos esté lista
-# Se conecta al host de la base de datos y se asegura de que esté escuchando
-echo "Esperando a que la base de datos de PostgreSQL esté lista..."
-until pg_isready -h db_pedidos -p 5432 -U postgres; do
-  echo "Todavía esperando la base de datos..."
-  sleep 2
-done
-
-# Este comando ejecuta tu script de Python para crear las tablas
-echo "Creando las tablas de la base de datos..."
-python database.py
+# Aplica las migraciones pendientes del esquema. migrations.py espera a que la
+# base acepte conexiones y toma un lock, asi varias replicas pueden arrancar a
+# la vez. Con SKIP_MIGRATIONS=1 se omite (por ejemplo si las corre un job aparte)
+if [ "$SKIP_MIGRATIONS" != "1" ]; then
+  echo "Aplicando las migraciones de la base de datos..."
+  python migrations.py || exit 1
+fi
 
 # Este comando inicia tu aplicación principal
-echo "Iniciando el servidor de Uvicorn..."
-exec uvicorn main:app --host 0.0.0.0 --port 8000
\ No newline at end of file
+# WEB_CONCURRENCY define cuantos procesos worker de Uvicorn atienden requests
+# (uno por core disponible es un buen punto de partida)
+echo "Iniciando el servidor de Uvicorn con ${WEB_CONCURRENCY:-1} worker(s)..."
+exec uvicorn main:app --host 0.0.0.0 --port 8000 --workers "${WEB_CONCURRENCY:-1}"
\ No newline at end of file
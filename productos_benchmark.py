@@ -0,0 +1,345 @@
+import sys
+import json
+import time
+import queue
+import random
+import logging
+import argparse
+import threading
+from types import SimpleNamespace
+
+from sqlalchemy import func, text
+
+from database import engine, SessionLocal
+from models import Product, ProcessedMessage
+import consumer
+
+# Benchmark de la cadena pedido -> descuento de stock.
+#
+# Reproduce en un solo proceso el recorrido publish_to_rabbitmq ->
+# order_queue.<shard> -> consumer.callback -> update_product_stock contra la
+# base de productos real, con un broker local en memoria en lugar de
+# RabbitMQ. El broker reparte los mensajes por shard con el mismo hash
+# consistente que pedidos y cada hilo consumidor es dueño de un subconjunto
+# fijo de shards, como los procesos de worker.py. Mide:
+#   - tasa de publicacion y de consumo (pedidos por segundo);
+#   - latencia de punta a punta (publicacion -> resultado publicado), p50/p90/p99;
+#   - profundidad de las colas durante la corrida;
+#   - espera por locks en la base (sesiones con wait_event_type = 'Lock');
+#   - consistencia final: stock inicial - unidades confirmadas = stock en la base.
+#
+# Crea sus propios productos ("bench-N") y los borra al terminar junto con sus
+# processed_messages (salvo --keep). Los pedidos de prueba usan ids negativos
+# para no ocupar los ids de pedidos reales. Se corre con las variables de entorno de
+# productos, por ejemplo:
+#
+#   python benchmark.py --orders 20000 --consumers 4 --skew hot --output hot.json
+
+SAMPLE_INTERVAL = 0.1
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class LocalBroker:
+    """
+    Sustituto de RabbitMQ: una cola en memoria por consumidor y un canal que
+    implementa lo que usa consumer.callback (ack, reject, nack y publish).
+    """
+
+    def __init__(self, consumers: int):
+        self.queues = [queue.Queue() for _ in range(consumers)]
+        self.lock = threading.Lock()
+        self.published_at = {}  # order_id -> time.perf_counter() de la primera publicacion
+        self.results = {}  # order_id -> resultado publicado para pedidos
+        self.latencies = []
+        self.acked = 0
+        self.rejected = 0
+        self.retries = 0
+        self.last_result_at = None
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    def publish_order(self, message: dict, headers: dict | None = None):
+        """Lo mismo que publish_to_rabbitmq en pedidos: el shard sale del product_id."""
+        shard = consumer.shard_for_product(message["product_id"])
+        with self.lock:
+            self.published_at.setdefault(message["order_id"], time.perf_counter())
+        self.queues[shard % len(self.queues)].put((shard, json.dumps(message).encode(), headers or {}))
+
+    def channel(self):
+        broker = self
+
+        class LocalChannel:
+            def basic_ack(self, delivery_tag, multiple=False):
+                with broker.lock:
+                    broker.acked += 1
+
+            def basic_reject(self, delivery_tag, requeue=True):
+                with broker.lock:
+                    broker.rejected += 1
+
+            def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+                with broker.lock:
+                    broker.rejected += 1
+
+            def basic_publish(self, exchange, routing_key, body, properties=None):
+                if routing_key == consumer.ORDER_STATUS_QUEUE:
+                    broker.record_result(json.loads(body))
+                else:
+                    # Reintento de retry_or_dead_letter en order_queue.<shard>.retry:
+                    # vuelve al final de su shard cuando vence la espera
+                    with broker.lock:
+                        broker.retries += 1
+                    shard = int(routing_key.split(".")[1])
+                    item = (shard, body, dict(properties.headers or {}))
+                    timer = threading.Timer(int(properties.expiration) / 1000, broker.queues[shard % len(broker.queues)].put, (item,))
+                    timer.daemon = True
+                    timer.start()
+
+        return LocalChannel()
+
+    def record_result(self, result: dict):
+        now = time.perf_counter()
+        with self.lock:
+            self.results[result["order_id"]] = result
+            self.latencies.append(now - self.published_at[result["order_id"]])
+            self.last_result_at = now
+
+
+def consume(broker: LocalBroker, index: int, stop_event: threading.Event):
+    channel = broker.channel()
+    delivery_tag = 0
+    while not stop_event.is_set():
+        try:
+            shard, body, headers = broker.queues[index].get(timeout=0.2)
+        except queue.Empty:
+            continue
+        delivery_tag += 1
+        method = SimpleNamespace(delivery_tag=delivery_tag, exchange=consumer.ORDER_EXCHANGE, routing_key=str(shard))
+        consumer.callback(channel, method, SimpleNamespace(headers=headers), body)
+
+
+def sample_metrics(broker: LocalBroker, stop_event: threading.Event, samples: dict):
+    """Profundidad de las colas y sesiones esperando un lock, cada SAMPLE_INTERVAL segundos."""
+    query = text(
+        "SELECT count(*) FROM pg_stat_activity "
+        "WHERE wait_event_type = 'Lock' AND datname = current_database()"
+    )
+    with engine.connect() as connection:
+        while not stop_event.is_set():
+            samples["depth"].append(broker.depth())
+            samples["lock_waiting"].append(connection.execute(query).scalar())
+            connection.commit()  # cada muestra en su propia transaccion
+            stop_event.wait(SAMPLE_INTERVAL)
+
+
+def create_products(count: int, stock: int) -> dict[int, int]:
+    db = SessionLocal()
+    try:
+        products = [Product(name=f"bench-{index}", price=1.0, stock=stock) for index in range(count)]
+        db.add_all(products)
+        db.commit()
+        return {product.id: stock for product in products}
+    finally:
+        db.close()
+
+
+def order_id_base(orders: int) -> int:
+    """
+    Primer id de los pedidos de prueba. Son negativos, por debajo de los de
+    corridas anteriores: los ids reales de pedidos empiezan en 1 y nunca
+    chocan con ellos en processed_messages.
+    """
+    db = SessionLocal()
+    try:
+        lowest = db.query(func.min(ProcessedMessage.order_id)).scalar() or 0
+        return min(lowest, 0) - orders
+    finally:
+        db.close()
+
+
+def choose_product(product_ids: list[int], skew: str, hot_products: int, hot_fraction: float) -> int:
+    if skew == "hot" and random.random() < hot_fraction:
+        return random.choice(product_ids[:hot_products])
+    return random.choice(product_ids)
+
+
+def publish_orders(broker: LocalBroker, product_ids: list[int], args, first_order_id: int) -> float:
+    """Publica los pedidos respetando --rate (0 = lo mas rapido posible). Devuelve los segundos que tardo."""
+    started = time.perf_counter()
+    for index in range(args.orders):
+        if args.rate:
+            delay = started + index / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        broker.publish_order({
+            "order_id": first_order_id + index,
+            "product_id": choose_product(product_ids, args.skew, args.hot_products, args.hot_fraction),
+            "quantity": random.randint(1, args.max_quantity),
+        })
+    return time.perf_counter() - started
+
+
+def check_consistency(initial: dict[int, int], broker: LocalBroker, first_order_id: int, orders: int) -> dict:
+    """Compara el stock final con el inicial menos lo confirmado y revisa processed_messages."""
+    db = SessionLocal()
+    try:
+        stock = dict(db.query(Product.id, Product.stock).filter(Product.id.in_(initial)).all())
+        processed = db.query(
+            ProcessedMessage.order_id, ProcessedMessage.product_id, ProcessedMessage.quantity, ProcessedMessage.status
+        ).filter(
+            ProcessedMessage.order_id >= first_order_id, ProcessedMessage.order_id < first_order_id + orders
+        ).all()
+    finally:
+        db.close()
+
+    expected = dict(initial)
+    for row in processed:
+        if row.status == "confirmed":
+            expected[row.product_id] -= row.quantity
+    mismatches = [
+        {"product_id": product_id, "expected": expected[product_id], "actual": stock.get(product_id)}
+        for product_id in initial
+        if stock.get(product_id) != expected[product_id]
+    ]
+    statuses = {row.order_id: row.status for row in processed}
+    status_mismatches = sum(1 for order_id, result in broker.results.items() if statuses.get(order_id) != result["status"])
+    negative = [product_id for product_id, value in stock.items() if value < 0]
+    return {
+        "ok": not mismatches and not negative and status_mismatches == 0 and len(processed) == orders,
+        "processed_messages": len(processed),
+        "stock_mismatches": mismatches,
+        "status_mismatches": status_mismatches,
+        "negative_stock": negative,
+    }
+
+
+def cleanup(product_ids, first_order_id: int, orders: int):
+    db = SessionLocal()
+    try:
+        db.query(ProcessedMessage).filter(
+            ProcessedMessage.order_id >= first_order_id, ProcessedMessage.order_id < first_order_id + orders
+        ).delete(synchronize_session=False)
+        db.query(Product).filter(Product.id.in_(product_ids)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def run(args) -> dict:
+    initial = create_products(args.products, args.stock)
+    product_ids = sorted(initial)
+    first_id = order_id_base(args.orders)
+    broker = LocalBroker(args.consumers)
+    stop_consumers = threading.Event()
+    stop_sampler = threading.Event()
+    samples = {"depth": [], "lock_waiting": []}
+
+    consumers = [
+        threading.Thread(target=consume, args=(broker, index, stop_consumers), daemon=True)
+        for index in range(args.consumers)
+    ]
+    sampler = threading.Thread(target=sample_metrics, args=(broker, stop_sampler, samples), daemon=True)
+    try:
+        sampler.start()
+        for thread in consumers:
+            thread.start()
+        started = time.perf_counter()
+        publish_seconds = publish_orders(broker, product_ids, args, first_id)
+
+        # Espera a que cada pedido tenga su resultado (los enviados a la DLQ quedan rechazados) o a --timeout
+        deadline = time.perf_counter() + args.timeout
+        while len(broker.results) < args.orders and time.perf_counter() < deadline:
+            time.sleep(0.05)
+        stop_consumers.set()
+        stop_sampler.set()
+        for thread in consumers + [sampler]:
+            thread.join()
+
+        elapsed = (broker.last_result_at or time.perf_counter()) - started
+        statuses = [result["status"] for result in broker.results.values()]
+        lock_waiting = samples["lock_waiting"]
+        report = {
+            "config": vars(args),
+            "shards": consumer.ORDER_QUEUE_SHARDS,
+            "published": args.orders,
+            "publish_rate": round(args.orders / publish_seconds, 1) if publish_seconds else None,
+            "consumed": len(broker.results),
+            "consume_rate": round(len(broker.results) / elapsed, 1) if elapsed else None,
+            "duration_s": round(elapsed, 3),
+            "latency_ms": {
+                name: round(percentile(broker.latencies, fraction) * 1000, 2)
+                for name, fraction in (("p50", 0.50), ("p90", 0.90), ("p99", 0.99), ("max", 1.0))
+            },
+            "queue_depth": {
+                "max": max(samples["depth"], default=0),
+                "mean": round(sum(samples["depth"]) / len(samples["depth"]), 1) if samples["depth"] else 0,
+            },
+            "lock_wait": {
+                "max_waiting_sessions": max(lock_waiting, default=0),
+                "mean_waiting_sessions": round(sum(lock_waiting) / len(lock_waiting), 2) if lock_waiting else 0,
+                # Aproximacion por muestreo: sesiones esperando x intervalo
+                "waiting_session_seconds": round(sum(lock_waiting) * SAMPLE_INTERVAL, 2),
+            },
+            "results": {
+                "confirmed": statuses.count("confirmed"),
+                "rejected": statuses.count("rejected"),
+                "retries": broker.retries,
+                "dead_lettered": broker.rejected,
+                "missing": args.orders - len(broker.results),
+            },
+        }
+        report["consistency"] = check_consistency(initial, broker, first_id, args.orders)
+        return report
+    finally:
+        stop_consumers.set()
+        stop_sampler.set()
+        if not args.keep:
+            cleanup(product_ids, first_id, args.orders)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput de la cadena pedido -> descuento de stock con un broker local")
+    parser.add_argument("--orders", type=int, default=10000, help="Pedidos a publicar")
+    parser.add_argument("--rate", type=float, default=0, help="Pedidos por segundo (0 = lo mas rapido posible)")
+    parser.add_argument("--consumers", type=int, default=2, help="Hilos consumidores (como CONSUMER_WORKERS)")
+    parser.add_argument("--products", type=int, default=100, help="Productos de prueba")
+    parser.add_argument("--stock", type=int, default=1000, help="Stock inicial de cada producto")
+    parser.add_argument("--max-quantity", type=int, default=3, help="Cantidad maxima por pedido")
+    parser.add_argument("--skew", choices=["uniform", "hot"], default="uniform", help="Reparto de pedidos entre productos")
+    parser.add_argument("--hot-products", type=int, default=1, help="Productos calientes con --skew hot")
+    parser.add_argument("--hot-fraction", type=float, default=0.8, help="Fraccion de pedidos a los productos calientes")
+    parser.add_argument("--timeout", type=float, default=120, help="Segundos maximos de espera de los resultados")
+    parser.add_argument("--seed", type=int, help="Semilla para repetir la misma secuencia de pedidos")
+    parser.add_argument("--keep", action="store_true", help="No borrar los productos y mensajes de prueba")
+    parser.add_argument("--output", help="Archivo JSON de resultados (por defecto stdout)")
+    args = parser.parse_args()
+    if args.hot_products > args.products:
+        parser.error("--hot-products no puede superar --products")
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    # Los avisos por pedido rechazado distorsionan la medicion; los errores se siguen viendo
+    logging.getLogger().setLevel(logging.ERROR)
+
+    report = run(args)
+    print(f"publicados={report['published']} ({report['publish_rate']}/s)  consumidos={report['consumed']} "
+          f"({report['consume_rate']}/s)  p50={report['latency_ms']['p50']} ms  p99={report['latency_ms']['p99']} ms  "
+          f"max cola={report['queue_depth']['max']}  consistente={report['consistency']['ok']}", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,177 @@
+import os
+import time
+import logging
+
+from models import Product as ProductModel
+from schemas import Product
+from stock import get_redis, enabled
+
+# Snapshot pre-serializado del catalogo en Redis.
+#
+# Cada producto se guarda ya serializado en el hash catalog:products. Despues
+# de cada escritura se actualizan solo los productos afectados y se arma el
+# snapshot concatenando esos JSON (sin base de datos ni Pydantic). El
+# snapshot se guarda en catalog:snapshot:<version> y catalog:current apunta a
+# la ultima version; el gateway lo devuelve tal cual sin llegar a productos.
+#
+# El consumidor no publica un snapshot por mensaje: marca los productos en
+# catalog:dirty y el proceso reconciliador los publica en cada ciclo.
+
+ITEMS_KEY = "catalog:products"
+VERSION_KEY = "catalog:version"
+CURRENT_KEY = "catalog:current"
+META_KEY = "catalog:meta"
+DIRTY_KEY = "catalog:dirty"
+
+# Tiempo que se conserva la version anterior para lectores que ya leyeron el puntero
+SNAPSHOT_GRACE_SECONDS = int(os.getenv("CATALOG_SNAPSHOT_GRACE", "60"))
+
+# Mueve el puntero solo hacia adelante, por si dos publicaciones terminan en desorden
+ADVANCE_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tonumber(ARGV[1]) > current then
+    redis.call('SET', KEYS[1], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+
+def snapshot_key(version: int) -> str:
+    return f"catalog:snapshot:{version}"
+
+
+def serialize(product: ProductModel) -> str:
+    return Product.model_validate(product).model_dump_json()
+
+
+def publish_snapshot() -> dict:
+    """
+    Arma el snapshot desde el hash de productos y lo publica con una version nueva.
+    """
+    redis_client = get_redis()
+    started = time.perf_counter()
+
+    # La version se toma antes de leer el hash: una version mayor siempre
+    # incluye todos los cambios de las versiones menores.
+    version = redis_client.incr(VERSION_KEY)
+    items = redis_client.hgetall(ITEMS_KEY)
+    body = b"[" + b",".join(items[key] for key in sorted(items, key=int)) + b"]"
+
+    pipe = redis_client.pipeline()
+    pipe.set(snapshot_key(version), body)
+    pipe.expire(snapshot_key(version - 1), SNAPSHOT_GRACE_SECONDS)
+    pipe.execute()
+    advanced = redis_client.eval(ADVANCE_SCRIPT, 1, CURRENT_KEY, version)
+    if not advanced:
+        redis_client.expire(snapshot_key(version), SNAPSHOT_GRACE_SECONDS)
+
+    meta = {
+        "version": version,
+        "products": len(items),
+        "size_bytes": len(body),
+        "build_ms": round((time.perf_counter() - started) * 1000, 2),
+        "built_at": time.time(),
+    }
+    redis_client.hset(META_KEY, mapping=meta)
+    logging.info(f"Snapshot del catálogo v{version}: {meta['products']} productos, {meta['size_bytes']} bytes, {meta['build_ms']} ms")
+    return meta
+
+
+def refresh_products(db, product_ids) -> dict:
+    """
+    Actualiza en el hash los productos indicados (borra los que ya no existen)
+    y publica un snapshot nuevo.
+    """
+    product_ids = {int(product_id) for product_id in product_ids}
+    products = db.query(ProductModel).filter(ProductModel.id.in_(product_ids)).all()
+    found = {product.id for product in products}
+
+    pipe = get_redis().pipeline()
+    if products:
+        pipe.hset(ITEMS_KEY, mapping={product.id: serialize(product) for product in products})
+    missing = product_ids - found
+    if missing:
+        pipe.hdel(ITEMS_KEY, *missing)
+    pipe.execute()
+    return publish_snapshot()
+
+
+def rebuild(db) -> dict:
+    """Reconstruye el hash completo desde la base (arranque o Redis vacio)."""
+    items = {product.id: serialize(product) for product in db.query(ProductModel).all()}
+    pipe = get_redis().pipeline()
+    pipe.delete(ITEMS_KEY)
+    if items:
+        pipe.hset(ITEMS_KEY, mapping=items)
+    pipe.execute()
+    return publish_snapshot()
+
+
+def current_snapshot() -> bytes | None:
+    """El snapshot al que apunta catalog:current, o None si no hay."""
+    redis_client = get_redis()
+    current = redis_client.get(CURRENT_KEY)
+    if current is None:
+        return None
+    return redis_client.get(snapshot_key(int(current)))
+
+
+def ensure_snapshot(db):
+    """Publica el catalogo completo si todavia no hay snapshot en Redis."""
+    if current_snapshot() is None:
+        rebuild(db)
+
+
+def publish_full(db) -> bytes:
+    """
+    Devuelve el snapshot vigente y, si falta, lo reconstruye desde la base.
+    Lo usa el gateway cuando no encuentra el snapshot en Redis.
+    """
+    snapshot = current_snapshot()
+    if snapshot is None:
+        version = rebuild(db)["version"]
+        snapshot = get_redis().get(snapshot_key(version))
+    return snapshot
+
+
+def safe_refresh(db, product_ids):
+    """
+    refresh_products para los endpoints de escritura: la escritura ya esta
+    confirmada, un fallo de Redis solo se registra.
+    """
+    if not enabled():
+        return
+    try:
+        refresh_products(db, product_ids)
+    except Exception as e:
+        logging.error(f"No se pudo actualizar el snapshot del catálogo: {e}")
+
+
+def mark_dirty(*product_ids):
+    """Marca productos cuyo stock cambio, para publicarlos en el siguiente ciclo."""
+    if not enabled() or not product_ids:
+        return
+    try:
+        get_redis().sadd(DIRTY_KEY, *product_ids)
+    except Exception as e:
+        logging.error(f"No se pudo marcar el catálogo para actualizar: {e}")
+
+
+def publish_dirty(db) -> int:
+    """Publica los productos marcados por el consumidor. Devuelve cuantos eran."""
+    product_ids = get_redis().spop(DIRTY_KEY, 10000)
+    if product_ids:
+        try:
+            refresh_products(db, product_ids)
+        except Exception:
+            get_redis().sadd(DIRTY_KEY, *product_ids)  # se reintentan en el siguiente ciclo
+            raise
+    else:
+        ensure_snapshot(db)
+    return len(product_ids or ())
+
+
+def stats() -> dict:
+    meta = get_redis().hgetall(META_KEY)
+    return {key.decode(): value.decode() for key, value in meta.items()}
\ No newline at end of file
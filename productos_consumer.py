@@ -1,112 +1,387 @@
-import pika
 import os
 import json
 import logging
-import time # Añadir importación de time
-import threading
-from dotenv import load_dotenv
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from models import Product  # Importa el modelo de producto
+import time
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.postgresql import insert
+from database import SessionLocal  # mismo motor y pool que el resto del servicio
+from models import Product, ProcessedMessage  # Importa los modelos
+import stock
+import catalog
+import sharding
+import logging_config
 
+# Los logs los configura worker.py en cada proceso (ver logging_config.py)
 
-# Configuración de logging
-logging.basicConfig(level=logging.INFO)
+# --- Topologia de RabbitMQ ---
+# Los pedidos se reparten por product_id entre ORDER_QUEUE_SHARDS colas
+# (order_queue.0, order_queue.1, ...) con un hash consistente. Cada cola
+# tiene un unico consumidor activo (x-single-active-consumer), asi los
+# descuentos de un mismo producto se procesan en serie y dos workers nunca
+# compiten por el mismo lock de fila.
+#
+# Las colas tienen un dead-letter exchange: los mensajes rechazados sin
+# reencolar (mal formados o que agotaron sus reintentos) terminan en
+# order_queue.dlq en lugar de bloquear la cola. Los argumentos y la
+# cantidad de shards deben coincidir con el publicador en pedidos.
+ORDER_EXCHANGE = "order_exchange"
+ORDER_QUEUE = "order_queue"  # cola anterior al particionado, se sigue drenando
+ORDER_QUEUE_SHARDS = int(os.getenv("ORDER_QUEUE_SHARDS", "8"))
+ORDER_DLX = "order_dlx"
+ORDER_DLQ = "order_queue.dlq"
+ORDER_QUEUE_ARGS = {
+    "x-dead-letter-exchange": ORDER_DLX,
+    "x-dead-letter-routing-key": ORDER_QUEUE,
+}
+SHARD_QUEUE_ARGS = {**ORDER_QUEUE_ARGS, "x-single-active-consumer": True}
 
-# Configuración de la base de datos
-DB_USER = os.getenv("DB_USER")
-DB_PASSWORD = os.getenv("DB_PASSWORD")
-DB_HOST = os.getenv("DB_HOST")
-DB_NAME = os.getenv("DB_NAME")
+# Cola donde se publica el resultado de cada pedido para el servicio de pedidos
+ORDER_STATUS_QUEUE = "order_status_queue"
 
-# Construye la URL de la base de datos
-DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
-logging.info(f"Conectando a la base de datos con URL: {DATABASE_URL}")
+# Intentos de procesamiento antes de mandar un mensaje a la DLQ
+MAX_DELIVERY_ATTEMPTS = int(os.getenv("MAX_DELIVERY_ATTEMPTS", "5"))
+# Espera antes de cada reintento: RETRY_DELAY_MS, duplicandose hasta RETRY_MAX_DELAY_MS.
+# El mensaje espera en <cola>.retry y al vencer RabbitMQ lo devuelve a su cola.
+RETRY_DELAY_MS = int(os.getenv("RETRY_DELAY_MS", "1000"))
+RETRY_MAX_DELAY_MS = int(os.getenv("RETRY_MAX_DELAY_MS", "60000"))
 
+# Errores de infraestructura (base o Redis caidos, failover): no son culpa del
+# mensaje, se reintenta sin gastar intentos hasta que el servicio vuelva
+TRANSIENT_ERRORS = (OperationalError,)
 try:
-    engine = create_engine(DATABASE_URL)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-except Exception as e:
-    logging.error(f"No se pudo crear el motor de la base de datos: {e}")
-    engine = None
-    SessionLocal = None
+    import redis
+    TRANSIENT_ERRORS += (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+except ImportError:
+    pass
+# Mensajes sin confirmar que RabbitMQ entrega a la vez a este consumidor
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", "10"))
 
 
-def update_product_stock(order_data: dict):
+class PoisonMessage(Exception):
+    """Mensaje que nunca podra procesarse, no tiene sentido reintentarlo."""
+
+
+def shard_for_product(product_id: int) -> int:
+    return sharding.jump_hash(product_id, ORDER_QUEUE_SHARDS)
+
+
+def shard_queue(shard: int) -> str:
+    return f"{ORDER_QUEUE}.{shard}"
+
+
+def retry_queue(queue: str) -> str:
+    return f"{queue}.retry"
+
+
+def declare_topology(channel):
+    channel.exchange_declare(exchange=ORDER_DLX, exchange_type="direct", durable=True)
+    channel.queue_declare(queue=ORDER_DLQ, durable=True)
+    channel.queue_bind(queue=ORDER_DLQ, exchange=ORDER_DLX, routing_key=ORDER_QUEUE)
+    channel.queue_declare(queue=ORDER_QUEUE, durable=True, arguments=ORDER_QUEUE_ARGS)
+
+    # Colas de espera de los reintentos: sin consumidores, al vencer el TTL del
+    # mensaje lo devuelven a su cola por el exchange por defecto
+    for queue in all_order_queues():
+        channel.queue_declare(queue=retry_queue(queue), durable=True, arguments={
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": queue,
+        })
+
+    channel.exchange_declare(exchange=ORDER_EXCHANGE, exchange_type="direct", durable=True)
+    for shard in range(ORDER_QUEUE_SHARDS):
+        channel.queue_declare(queue=shard_queue(shard), durable=True, arguments=SHARD_QUEUE_ARGS)
+        channel.queue_bind(queue=shard_queue(shard), exchange=ORDER_EXCHANGE, routing_key=str(shard))
+
+    channel.queue_declare(queue=ORDER_STATUS_QUEUE, durable=True)
+
+
+def parse_order_message(body: bytes) -> dict:
+    """
+    Valida el mensaje de pedido. Lanza PoisonMessage si esta mal formado.
+    """
+    try:
+        order_data = json.loads(body)
+        order = {
+            "order_id": int(order_data["order_id"]),
+            "product_id": int(order_data["product_id"]),
+            "quantity": int(order_data["quantity"]),
+        }
+    except (ValueError, KeyError, TypeError) as e:
+        raise PoisonMessage(f"Mensaje de pedido inválido: {e}")
+    if order["quantity"] <= 0:
+        raise PoisonMessage(f"Cantidad inválida en el pedido {order['order_id']}")
+    return order
+
+
+def decrement_in_database(db, order_id: int, product_id: int, quantity: int) -> dict:
+    """
+    Descuenta el stock en un solo UPDATE condicional, sin leer y escribir la fila por separado.
+    """
+    updated = db.query(Product).filter(
+        Product.id == product_id, Product.stock >= quantity
+    ).update({Product.stock: Product.stock - quantity}, synchronize_session=False)
+
+    if updated:
+        logging.debug(f"Stock actualizado para el producto ID: {product_id} (pedido {order_id}).")
+        return {"order_id": order_id, "status": "confirmed", "reason": None}
+    if db.query(Product.id).filter(Product.id == product_id).first():
+        logging.warning(f"No hay suficiente stock para el producto ID: {product_id}.")
+        return {"order_id": order_id, "status": "rejected", "reason": "Stock insuficiente"}
+    logging.warning(f"Producto con ID {product_id} no encontrado.")
+    return {"order_id": order_id, "status": "rejected", "reason": "Producto no encontrado"}
+
+def reserve_in_redis(db, order_id: int, product_id: int, quantity: int):
+    """
+    Reserva el stock de un producto en alta concurrencia con el contador de
+    Redis. Devuelve el resultado, o None si el producto dejo de estar en ese
+    modo y hay que descontar en la base.
+    """
+    remaining = stock.reserve(product_id, quantity)
+    if remaining == stock.COUNTER_MISSING:
+        # Redis perdio el contador: se reconstruye desde la base y se reintenta
+        if not stock.rebuild_counter(db, product_id):
+            return None
+        remaining = stock.reserve(product_id, quantity)
+
+    if remaining >= 0:
+        logging.debug(f"Stock reservado en Redis para el producto ID: {product_id} (pedido {order_id}), quedan {remaining}.")
+        return {"order_id": order_id, "status": "confirmed", "reason": None}
+    logging.warning(f"No hay suficiente stock para el producto ID: {product_id}.")
+    return {"order_id": order_id, "status": "rejected", "reason": "Stock insuficiente"}
+
+def update_product_stock(order_data: dict) -> dict:
     """
     Actualiza el stock del producto en la base de datos.
+
+    Devuelve el evento de resultado del pedido ("confirmed" o "rejected" con
+    su motivo). Cada order_id se procesa una sola vez: el registro en
+    processed_messages y el descuento de stock se confirman en la misma
+    transaccion, asi una reentrega devuelve el resultado ya guardado sin
+    volver a descontar. Los errores transitorios se propagan para reintentar.
+
+    Los productos en modo de alta concurrencia se reservan en Redis y quedan
+    con stock_applied = false hasta que el reconciliador los aplica (ver stock.py).
+    """
+    order_id = order_data["order_id"]
+    product_id = order_data["product_id"]
+    quantity = order_data["quantity"]
+
+    db = SessionLocal()
+    reserved = False
+    try:
+        # Reserva el order_id; si otra entrega ya lo registro no se inserta nada
+        inserted = db.execute(
+            insert(ProcessedMessage)
+            .values(order_id=order_id, product_id=product_id, quantity=quantity, status="processing")
+            .on_conflict_do_nothing(index_elements=["order_id"])
+        ).rowcount
+
+        if not inserted:
+            previous = db.get(ProcessedMessage, order_id)
+            db.rollback()
+            logging.info(f"Pedido {order_id} ya procesado, se omite la reentrega.")
+            return {"order_id": order_id, "status": previous.status, "reason": previous.reason}
+
+        result = None
+        if stock.is_hot(db, product_id):
+            result = reserve_in_redis(db, order_id, product_id, quantity)
+            reserved = result is not None and result["status"] == "confirmed"
+        if result is None:
+            result = decrement_in_database(db, order_id, product_id, quantity)
+
+        db.query(ProcessedMessage).filter(ProcessedMessage.order_id == order_id).update(
+            {
+                ProcessedMessage.status: result["status"],
+                ProcessedMessage.reason: result["reason"],
+                ProcessedMessage.stock_applied: not reserved,
+            },
+            synchronize_session=False
+        )
+        db.commit()
+        if result["status"] == "confirmed" and not reserved:
+            catalog.mark_dirty(product_id)  # el reconciliador publica el stock nuevo en el catalogo
+        return result
+    except Exception:
+        # Se devuelven las unidades antes del rollback, mientras se mantiene el
+        # lock del producto: un cambio de modo no puede recalcular el contador en el medio
+        if reserved:
+            stock.release(product_id, quantity)
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def publish_order_result(ch, result: dict):
+    """
+    Publica el resultado del pedido en la cola de respuesta.
     """
-    if SessionLocal is None:
-        logging.error("No se pudo conectar a la base de datos. Saltando la actualización del stock.")
-        return
+    import pika  # diferido: solo lo cargan los procesos que hablan con RabbitMQ
+
+    ch.basic_publish(
+        exchange='',
+        routing_key=ORDER_STATUS_QUEUE,
+        body=json.dumps(result),
+        properties=pika.BasicProperties(delivery_mode=2)  # mensaje persistente
+    )
+
+def source_queue(method) -> str:
+    """Cola de la que llego el mensaje: por ORDER_EXCHANGE la del shard, por el exchange por defecto la de su routing key."""
+    if method.exchange == ORDER_EXCHANGE:
+        return shard_queue(int(method.routing_key))
+    return method.routing_key
 
+def retry_delay(attempt: int) -> int:
+    return min(RETRY_DELAY_MS * 2 ** (attempt - 1), RETRY_MAX_DELAY_MS)
+
+def reject_dead_lettered(ch, body: bytes, reason: str):
+    """
+    Avisa a pedidos que el pedido no se pudo procesar, para que no quede
+    pendiente. Registra el rechazo en processed_messages: una reentrega ya no
+    descuenta stock. Si el pedido ya tenia resultado se reenvia ese.
+    """
+    try:
+        order_id = int(json.loads(body)["order_id"])
+    except (ValueError, KeyError, TypeError):
+        return  # sin order_id no hay pedido a quien avisar
+
+    result = {"order_id": order_id, "status": "rejected", "reason": reason}
     db = SessionLocal()
     try:
-        product_id = order_data["id"]
-        quantity = order_data["stock"]
-
-        # 1. Obtiene el producto de la base de datos
-        product = db.query(Product).filter(Product.id == product_id).first()
-        if product:
-            # 2. Actualiza el stock
-            if product.stock >= quantity:
-                product.stock -= quantity
-                db.commit()
-                logging.info(f"Stock actualizado para el producto ID: {product_id}. Nuevo stock: {product.stock}")
-            else:
-                logging.warning(f"No hay suficiente stock para el producto ID: {product_id}.")
-        else:
-            logging.warning(f"Producto con ID {product_id} no encontrado.")
+        db.execute(
+            insert(ProcessedMessage)
+            .values(order_id=order_id, status="rejected", reason=reason)
+            .on_conflict_do_nothing(index_elements=["order_id"])
+        )
+        stored = db.get(ProcessedMessage, order_id)
+        db.commit()
+        result["status"], result["reason"] = stored.status, stored.reason
     except Exception as e:
         db.rollback()
-        logging.error(f"Error al procesar el mensaje de la orden: {e}")
+        logging.error(f"No se pudo registrar el rechazo del pedido {order_id}: {e}")
     finally:
         db.close()
+    publish_order_result(ch, result)
+
+def retry_or_dead_letter(ch, method, properties, body, error: Exception):
+    """
+    Reintenta un mensaje que fallo: lo publica en la cola de espera de su cola
+    con un TTL creciente y RabbitMQ lo devuelve al vencer. Los errores de
+    infraestructura (TRANSIENT_ERRORS) se reintentan sin limite; el resto
+    cuenta intentos y al llegar a MAX_DELIVERY_ATTEMPTS el mensaje se rechaza
+    sin reencolar (va a la DLQ) y el pedido queda rechazado.
+    """
+    headers = dict(properties.headers or {})
+
+    if isinstance(error, TRANSIENT_ERRORS):
+        retries = int(headers.get("x-transient-retries", 0)) + 1
+        headers["x-transient-retries"] = retries
+        delay = retry_delay(retries)
+        logging.warning(f"Error de infraestructura al procesar el mensaje, se reintenta en {delay} ms: {error}")
+    else:
+        attempts = int(headers.get("x-attempts", 0)) + 1
+        if attempts >= MAX_DELIVERY_ATTEMPTS:
+            logging.error(f"Mensaje enviado a la DLQ tras {attempts} intentos: {error}")
+            reject_dead_lettered(ch, body, "No se pudo procesar el pedido")
+            ch.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+            return
+        headers["x-attempts"] = attempts
+        delay = retry_delay(attempts)
+        logging.warning(f"Error al procesar el mensaje (intento {attempts}/{MAX_DELIVERY_ATTEMPTS}), se reintenta en {delay} ms: {error}")
+
+    import pika
+
+    ch.basic_publish(
+        exchange='',
+        routing_key=retry_queue(source_queue(method)),
+        body=body,
+        properties=pika.BasicProperties(delivery_mode=2, headers=headers, expiration=str(delay))
+    )
+    ch.basic_ack(delivery_tag=method.delivery_tag)
 
 def callback(ch, method, properties, body):
     """
     Función que se llama cada vez que se recibe un mensaje.
+
+    Cada mensaje termina siempre confirmado, reintentado o en la DLQ, de modo
+    que un mensaje roto nunca queda sin ack frenando la cola.
     """
-    logging.info(f" [x] Mensaje recibido: {body.decode()}")
-    order_data = json.loads(body.decode())
-    
-    # Procesa la orden y actualiza el stock
-    update_product_stock(order_data)
-    
-    # Confirma el procesamiento del mensaje
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+    import pika
+
+    # El request_id de la request que creo el pedido, para seguirlo en los logs
+    token = logging_config.request_id.set((properties.headers or {}).get("request_id"))
+    logging.debug("Mensaje recibido: %r", body)
+    try:
+        order_data = parse_order_message(body)
 
-def start_consumer():
+        # Procesa la orden, actualiza el stock y avisa el resultado a pedidos
+        result = update_product_stock(order_data)
+        publish_order_result(ch, result)
+
+        # Confirma el procesamiento del mensaje
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+    except PoisonMessage as e:
+        logging.error(f"{e}. Enviando a la DLQ.")
+        reject_dead_lettered(ch, body, str(e))
+        ch.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+    except pika.exceptions.AMQPError:
+        raise  # el canal se cayo: se reconecta y RabbitMQ reentrega el mensaje
+    except Exception as e:
+        retry_or_dead_letter(ch, method, properties, body, e)
+    finally:
+        logging_config.request_id.reset(token)
+
+def all_order_queues() -> list[str]:
+    return [ORDER_QUEUE] + [shard_queue(shard) for shard in range(ORDER_QUEUE_SHARDS)]
+
+def sleep_unless(should_stop, seconds: float):
+    deadline = time.monotonic() + seconds
+    while not should_stop() and time.monotonic() < deadline:
+        time.sleep(0.2)
+
+def start_consumer(queues=None, on_message=callback, should_stop=lambda: False, on_tick=None):
     """
-    Se conecta a RabbitMQ y comienza a consumir mensajes.
+    Se conecta a RabbitMQ y comienza a consumir mensajes de las colas indicadas
+    (por defecto todas). Ante cualquier error se reconecta con espera creciente.
+
+    Cuando should_stop() devuelve True deja de pedir mensajes y cierra la
+    conexion: el mensaje en curso termina de procesarse y los prefetch sin
+    confirmar vuelven a la cola para otro consumidor.
     """
-    retries = 5
-    while retries > 0:
+    import pika
+
+    queues = queues or all_order_queues()
+    delay = 1
+    while not should_stop():
+        connection = None
         try:
             logging.info("Intentando conectar a RabbitMQ...")
             connection = pika.BlockingConnection(pika.ConnectionParameters(host=os.getenv("RABBITMQ_HOST")))
             channel = connection.channel()
 
-            # Asegura que la cola existe
-            channel.queue_declare(queue='order_queue')
-            logging.info(' [*] Esperando mensajes. Para salir presiona CTRL+C')
+            # Asegura que las colas existen y limita los mensajes en vuelo
+            declare_topology(channel)
+            channel.basic_qos(prefetch_count=CONSUMER_PREFETCH)
+            for queue in queues:
+                channel.basic_consume(queue=queue, on_message_callback=on_message)
+            logging.info(f" [*] Esperando mensajes de {', '.join(queues)}")
+            delay = 1
 
-            # Empieza a consumir mensajes de la cola
-            channel.basic_consume(
-                queue='order_queue', 
-                on_message_callback=callback
-            )
-            
-            # Inicia el bucle de consumo. Esto es bloqueante.
-            channel.start_consuming()
+            # Bucle de consumo: se revisa la señal de parada al menos una vez por segundo
+            while not should_stop():
+                connection.process_data_events(time_limit=1)
+                if on_tick:
+                    on_tick()
+            logging.info("Consumidor detenido, cerrando la conexión.")
 
         except pika.exceptions.AMQPConnectionError as e:
-            retries -= 1
-            logging.error(f"No se pudo conectar a RabbitMQ: {e}. Reintentando en 5 segundos... (intentos restantes: {retries})")
-            time.sleep(5)
+            logging.error(f"No se pudo conectar a RabbitMQ: {e}. Reintentando en {delay} segundos...")
         except Exception as e:
-            logging.error(f"Error inesperado en el consumidor de RabbitMQ: {e}")
-            break
+            logging.error(f"Error inesperado en el consumidor de RabbitMQ: {e}. Reintentando en {delay} segundos...")
+        finally:
+            if connection and connection.is_open:
+                connection.close()
+        sleep_unless(should_stop, delay)
+        delay = min(delay * 2, 30)
 
 if __name__ == "__main__":
     start_consumer()
\ No newline at end of file
@@ -1,11 +1,14 @@
 # Archivo en la carpeta de productos
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
 import os
+import time
+import logging
 # Importa la base de tus modelos
 from models import Base
+import stock  # cliente de Redis del servicio
 
 
 
@@ -24,11 +27,108 @@ def get_db():
     finally:
         db.close()
 
-# Función para crear las tablas
-def create_tables():
-    print("Creando tablas...")
-    Base.metadata.create_all(bind=engine)
-    print("¡Tablas creadas exitosamente!")
+# --- Replica de solo lectura ---
+# Si DB_READ_HOST esta definido, los endpoints de solo lectura usan get_read_db
+# y consultan la replica, asi los listados del catalogo no compiten con las
+# transacciones que descuentan stock. Sin replica, read_engine es el primario.
+#
+# Se vuelve al primario cuando:
+#   - algun proceso de productos (web o consumidor) confirmo una escritura hace
+#     menos de READ_AFTER_WRITE_WINDOW segundos (lectura despues de escritura), o
+#   - la replica esta mas de REPLICA_MAX_LAG segundos atrasada.
+# Cada escritura deja en Redis la clave WRITE_MARKER_KEY, que vence a los
+# READ_AFTER_WRITE_WINDOW segundos, asi una lectura que llega a otro worker
+# tambien ve la escritura. Sin Redis la garantia es solo dentro del proceso.
+READ_DB_HOST = os.getenv("DB_READ_HOST")
+READ_AFTER_WRITE_WINDOW = float(os.getenv("READ_AFTER_WRITE_WINDOW", "5"))
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "10"))
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("REPLICA_LAG_CHECK_INTERVAL", "5"))
+WRITE_MARKER_KEY = "productos:recent_write"
 
-if __name__ == "__main__":
-    create_tables()
\ No newline at end of file
+if READ_DB_HOST:
+    READ_DATABASE_URL = (
+        f"postgresql://{os.getenv('DB_READ_USER', os.getenv('DB_USER'))}:{os.getenv('DB_READ_PASSWORD', os.getenv('DB_PASSWORD'))}@"
+        f"{READ_DB_HOST}:{os.getenv('DB_READ_PORT', os.getenv('DB_PORT'))}/{os.getenv('DB_NAME')}"
+    )
+    read_engine = create_engine(READ_DATABASE_URL)
+else:
+    read_engine = engine
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+_last_write_at = 0.0
+_replica_lag = 0.0
+_replica_lag_checked_at = 0.0
+
+# Marca las sesiones del primario que escriben, tanto por flush como por
+# UPDATE/DELETE masivos (query.update), y registra la escritura al confirmar.
+@event.listens_for(SessionLocal, "after_flush")
+def _mark_flush(session, flush_context):
+    session.info["wrote"] = True
+
+@event.listens_for(SessionLocal, "do_orm_execute")
+def _mark_bulk_write(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info["wrote"] = True
+
+@event.listens_for(SessionLocal, "after_commit")
+def _record_write(session):
+    global _last_write_at
+    if not session.info.pop("wrote", False) or read_engine is engine:
+        return
+    _last_write_at = time.monotonic()
+    if stock.enabled():
+        try:
+            stock.get_redis().set(WRITE_MARKER_KEY, 1, px=int(READ_AFTER_WRITE_WINDOW * 1000))
+        except Exception as e:
+            logging.warning(f"No se pudo registrar la escritura para las lecturas de la replica: {e}")
+
+def replica_lag() -> float:
+    """
+    Atraso de la replica en segundos, consultado como mucho una vez cada
+    REPLICA_LAG_CHECK_INTERVAL. Si no se puede medir se considera infinito.
+    """
+    global _replica_lag, _replica_lag_checked_at
+    now = time.monotonic()
+    if now - _replica_lag_checked_at < REPLICA_LAG_CHECK_INTERVAL:
+        return _replica_lag
+    try:
+        with read_engine.connect() as connection:
+            # Con todo el WAL recibido ya aplicado la replica esta al dia aunque no haya escrituras recientes
+            lag = connection.execute(text("""
+                SELECT CASE
+                    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                END
+            """)).scalar()
+        _replica_lag = float(lag or 0)
+    except Exception as e:
+        logging.warning(f"No se pudo medir el atraso de la replica: {e}")
+        _replica_lag = float("inf")
+    _replica_lag_checked_at = now
+    return _replica_lag
+
+def recent_write() -> bool:
+    """True si algun proceso confirmo una escritura dentro de READ_AFTER_WRITE_WINDOW."""
+    if time.monotonic() - _last_write_at < READ_AFTER_WRITE_WINDOW:
+        return True
+    if not stock.enabled():
+        return False
+    try:
+        return bool(stock.get_redis().exists(WRITE_MARKER_KEY))
+    except Exception as e:
+        logging.warning(f"No se pudo consultar la ultima escritura, se lee del primario: {e}")
+        return True
+
+def use_replica() -> bool:
+    if read_engine is engine:
+        return False
+    if recent_write():
+        return False
+    return replica_lag() <= REPLICA_MAX_LAG
+
+def get_read_db():
+    db = ReadSessionLocal() if use_replica() else SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
\ No newline at end of file
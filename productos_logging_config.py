@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+import queue
+import uuid
+import atexit
+import logging
+import threading
+import contextvars
+import logging.handlers
+
+# Configuracion de logs del servicio.
+#
+# - No bloqueantes: los modulos siguen usando logging.info(...), pero el
+#   handler del logger raiz solo encola el registro; un hilo (QueueListener)
+#   lo formatea y lo escribe. Si la cola se llena (LOG_QUEUE_SIZE) el
+#   registro se descarta en lugar de frenar la request.
+# - Estructurados: con LOG_FORMAT=json (por defecto) cada linea es un JSON con
+#   nivel, logger, mensaje, servicio y request_id.
+# - request_id: el middleware toma X-Request-ID o genera uno, lo devuelve en
+#   la respuesta y lo agrega a cada log de la request. El gateway lo reenvia a
+#   los servicios y pedidos lo pasa a productos en los mensajes de RabbitMQ.
+# - Limitados: cada linea de codigo que loguea puede emitir hasta
+#   LOG_RATE_LIMIT registros por segundo; el resto se descarta y el siguiente
+#   registro emitido informa cuantos se omitieron (campo "suppressed").
+#   Los errores no se limitan.
+#
+# Los datos completos de productos, pedidos y mensajes se loguean en DEBUG,
+# desactivado por defecto (LOG_LEVEL=INFO).
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", "20"))  # 0 = sin limite
+REQUEST_ID_HEADER = "X-Request-ID"
+
+request_id = contextvars.ContextVar("request_id", default=None)
+
+_service = None
+_listener = None
+_pid = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "service": _service,
+            "pid": record.process,
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RequestIdFilter(logging.Filter):
+    """Agrega el request_id del contexto; se aplica antes de encolar, en el hilo de la request."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Hasta LOG_RATE_LIMIT registros por segundo por cada linea de codigo que loguea."""
+
+    def __init__(self, limit: int):
+        super().__init__()
+        self.limit = limit
+        self.windows = {}  # (archivo, linea) -> [segundo, emitidos, descartados]
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.limit <= 0 or record.levelno >= logging.ERROR:
+            return True
+        key = (record.pathname, record.lineno)
+        second = int(record.created)
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or window[0] != second:
+                suppressed = window[2] if window else 0
+                self.windows[key] = [second, 1, 0]
+                record.suppressed = suppressed
+                return True
+            if window[1] < self.limit:
+                window[1] += 1
+                record.suppressed = 0
+                return True
+            window[2] += 1
+            return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que descarta el registro si la cola esta llena en vez de bloquear."""
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def setup(service: str):
+    """
+    Configura el logger raiz del proceso. Se llama al importar main.py y al
+    comienzo de cada proceso hijo. Los hijos creados con spawn empiezan sin
+    configurar, y en los creados con fork el hilo que escribe no sobrevive;
+    por eso solo se omite si ya se configuro en este mismo pid.
+    """
+    global _service, _listener, _pid
+    if _pid == os.getpid():
+        return
+    _service, _pid = service, os.getpid()
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(
+        "%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"
+    ))
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(RequestIdFilter())
+    handler.addFilter(RateLimitFilter(LOG_RATE_LIMIT))
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+    # Los logs de uvicorn (incluido el access log) pasan por la misma cola y el mismo limite
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        logging.getLogger(name).handlers = []
+        logging.getLogger(name).propagate = True
+
+    _listener = logging.handlers.QueueListener(log_queue, stream)
+    _listener.start()
+    atexit.register(_listener.stop)  # escribe lo que quede en la cola al salir
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex
+
+
+def install(app):
+    """Middleware que asigna el request_id de cada request y lo devuelve en X-Request-ID."""
+    @app.middleware("http")
+    async def assign_request_id(request, call_next):
+        token = request_id.set(request.headers.get(REQUEST_ID_HEADER) or new_request_id())
+        try:
+            response = await call_next(request)
+            response.headers[REQUEST_ID_HEADER] = request_id.get()
+            return response
+        finally:
+            request_id.reset(token)
+
+
+def httpx_hooks() -> dict:
+    """event_hooks para httpx.AsyncClient que reenvian el request_id a los servicios."""
+    async def forward_request_id(request):
+        current = request_id.get()
+        if current:
+            request.headers[REQUEST_ID_HEADER] = current
+
+    return {"request": [forward_request_id]}
\ No newline at end of file
@@ -1,25 +1,101 @@
+import time
+
+# Marca del inicio del arranque, para medir cuanto tarda el servicio en estar listo
+IMPORT_STARTED = time.perf_counter()
+
 import os
 import threading
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 import jwt
+import jwks
+from sqlalchemy import Integer, any_, bindparam, text
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import Session
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Response, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from database import create_tables, get_db
-from models import Product as ProductModel
-from schemas import Product, ProductCreate, ProductUpdate, ProductBase
-from typing import Any, List
+from database import engine, read_engine, get_db, get_read_db, SessionLocal
+from models import Product as ProductModel, ProcessedMessage as ProcessedMessageModel
+from schemas import Product, ProductCreate, ProductUpdate, ProductBase, HighContentionUpdate
+from typing import Any, List, Optional
 import logging
-from consumer import start_consumer  # Importa la función del consumidor
+import stock
+import catalog
+import idempotency
+import product_events
+import profiling
+import logging_config
+
+# Logs en JSON, con request_id y escritos desde un hilo aparte (ver logging_config.py)
+logging_config.setup("productos")
+
+# --- Arranque ---
+# El esquema lo aplica migrations.py antes de levantar Uvicorn, aca no hay DDL.
+# El lifespan calienta el pool de conexiones; el snapshot del catalogo se
+# publica en segundo plano porque el gateway puede leer de la base mientras
+# tanto. /health/ready devuelve 503 hasta que termina el lifespan y luego
+# informa cuanto tardo cada fase.
+startup_phases = {}
+ready = False
 
-logging.basicConfig(level=logging.INFO)
+def record_phase(name: str, started: float):
+    startup_phases[name] = round((time.perf_counter() - started) * 1000, 1)
 
-create_tables()  # Aseguramos que las tablas estén creadas
+def check_database():
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
 
-app = FastAPI()  # Instancia de FastAPI
+# Publica el snapshot del catalogo si Redis no tiene uno (primer arranque o Redis reiniciado)
+def ensure_catalog_snapshot():
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        catalog.ensure_snapshot(db)
+    except Exception as e:
+        logging.error(f"No se pudo publicar el snapshot del catálogo: {e}")
+    finally:
+        db.close()
+    record_phase("catalog_snapshot", started)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global ready
+    started = time.perf_counter()
+    # Descarta conexiones heredadas si el proceso se creo con fork (gunicorn --preload):
+    # cada worker abre su propio pool
+    engine.dispose(close=False)
+    if read_engine is not engine:
+        read_engine.dispose(close=False)
+    try:
+        await run_in_threadpool(check_database)
+    except Exception as e:
+        # No se aborta el arranque: /health/ready seguira respondiendo 503
+        logging.error(f"No se pudo conectar a la base de datos al iniciar: {e}")
+    record_phase("database", started)
+
+    # Claves publicas de usuarios para verificar tokens, en segundo plano
+    jwks.start_refresh()
+
+    if stock.enabled():
+        threading.Thread(target=ensure_catalog_snapshot, daemon=True).start()
+
+    record_phase("total", IMPORT_STARTED)
+    ready = True
+    logging.info(f"Servicio de productos listo en {startup_phases['total']} ms: {startup_phases}")
+    yield
+    ready = False
+
+app = FastAPI(lifespan=lifespan)  # Instancia de FastAPI
+
+# Perfilado opcional por request (ver profiling.py)
+profiling.install(app, jwks.decode)
+profiling.instrument_engine(engine)
+if read_engine is not engine:
+    profiling.instrument_engine(read_engine)
+logging_config.install(app)
 
-SECRET_KEY = os.getenv("JWT_SECRET_KEY")
-ALGORITHM = "HS256"
 
 oauth2_scheme = HTTPBearer() # Esquema de seguridad HTTP Bearer. Instancia de HTTPBearer que maneja la autenticación mediante tokens Bearer.
                              # Se utiliza para proteger los endpoints y asegurar que solo usuarios autenticados puedan acceder a ellos.
@@ -37,7 +113,7 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(oauth2_
         detail="No se pudo validar el token",
     )
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])  # Decodifica el token JWT usando la clave secreta y el algoritmo especificado
+        payload = jwks.decode(credentials.credentials)  # Verifica la firma con las claves publicas de usuarios (ver jwks.py)
         username: str = payload.get("sub")
         role: str = payload.get("role")
         if username is None or role is None:
@@ -47,108 +123,252 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(oauth2_
         raise credentials_exception
 
 # --- Endpoints ---
+# Las escrituras aceptan el encabezado Idempotency-Key: un reintento con la
+# misma clave devuelve la respuesta de la primera ejecucion (ver idempotency.py).
+# Cada endpoint valida permisos y delega el trabajo en una funcion que
+# devuelve la respuesta ya serializable, para poder guardarla.
+
+def idempotent(response: Response, scope: str, current_user: dict, idempotency_key: Optional[str], payload, handler) -> dict:
+    body, replayed = idempotency.run(scope, current_user["username"], idempotency_key, payload, handler)
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return body
+
 @app.post("/products", response_model=Product)
-def create_product(product: ProductCreate, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)) -> Any:
+def create_product(
+    product: ProductCreate,
+    response: Response,
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+) -> Any:
 
-    logging.info(f"Usuario actual intentando crear producto: {current_user}")
-    logging.info(f"Datos del producto recibido: {product}")
+    logging.debug("Usuario %s crea un producto: %s", current_user["username"], product)
 
     # Solo los administradores pueden crear productos
     if current_user["role"] != "admin":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No tienes permisos de administrador")
-    
+
+    return idempotent(response, "products.create", current_user, idempotency_key, product.model_dump(mode="json"), lambda: insert_product(product, db))
+
+def insert_product(product: ProductCreate, db: Session) -> dict:
     try:
         try:
-         logging.info("Intentando crear ProductModel usando product.model_dump()")
          db_product = ProductModel(**product.model_dump())  # ** desempaqueta el diccionario devuelto por model_dump() en sus pares clave-valor
         except AttributeError:
-            logging.info("model_dump() falló, usando product.dict()")
+            logging.debug("model_dump() falló, usando product.dict()")
             db_product = ProductModel(**product.dict())
 
-        logging.info("Agregando producto a la base de datos")
-
         db.add(db_product)
         db.commit()
         db.refresh(db_product)
-        logging.info(f"Producto creado exitosamente: {db_product}")
-        return db_product
+        catalog.safe_refresh(db, [db_product.id])
+        product_events.safe_publish(db, [db_product.id])
+        logging.info(f"Producto {db_product.id} creado")
+        return Product.model_validate(db_product).model_dump(mode="json")
     
     except Exception as e:
-        logging.error(f"Error interno al crear el producto: {str(e)}")
-        import traceback   # Para imprimir el traceback completo del error
-        traceback.print_exc()
-
+        logging.exception(f"Error interno al crear el producto: {str(e)}")
         raise HTTPException(
             status_code=500,
             detail=f"Error interno al crear el producto: {str(e)}"
         )
     
 @app.get("/get/products", response_model=List[Product])
-def get_products(db: Session = Depends(get_db)):
+def get_products(db: Session = Depends(get_read_db)):
     """
     Obtiene y devuelve una lista de todos los productos de la base de datos.
     
     Este endpoint es el que tu API Gateway está esperando.
     """
-    logging.info("Solicitud GET para obtener todos los productos.")
     products = db.query(ProductModel).all()
     return products
+
+# Maximo de ids por consulta en /products/by-ids
+PRODUCTS_BY_IDS_MAX = int(os.getenv("PRODUCTS_BY_IDS_MAX", "500"))
+
+@app.get("/products/by-ids", response_model=List[Product])
+def get_products_by_ids(ids: str = Query(..., description="ids separados por coma"), db: Session = Depends(get_read_db)):
+    """
+    Productos con los ids indicados, en una sola consulta. Los ids que no
+    existen no aparecen en la respuesta.
+    """
+    try:
+        product_ids = sorted({int(product_id) for product_id in ids.split(",") if product_id.strip()})
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="ids debe ser una lista de enteros separados por coma")
+    if len(product_ids) > PRODUCTS_BY_IDS_MAX:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Se admiten hasta {PRODUCTS_BY_IDS_MAX} ids por consulta")
+    if not product_ids:
+        return []
+    # = ANY(:ids) envia la lista como un unico parametro de tipo array, asi la
+    # sentencia es la misma sin importar cuantos ids lleguen
+    ids_param = bindparam("ids", product_ids, type_=ARRAY(Integer))
+    return db.query(ProductModel).filter(ProductModel.id == any_(ids_param)).all()
     
 @app.delete("/products/{id}") 
-def delete_product(id: int, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)) -> Any:
-    logging.info(f"Usuario actual intentando eliminar producto: {current_user}")
+def delete_product(
+    id: int,
+    response: Response,
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+) -> Any:
+    logging.debug("Usuario %s elimina el producto %s", current_user["username"], id)
 
     # Solo los administradores pueden eliminar productos
     if current_user["role"] != "admin":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No tienes permisos de administrador")
-    
-    product = db.query(ProductModel).filter(ProductModel.id == id).first()
+
+    return idempotent(response, f"products.delete.{id}", current_user, idempotency_key, None, lambda: remove_product(id, db))
+
+def remove_product(id: int, db: Session) -> dict:
+    product = db.query(ProductModel).filter(ProductModel.id == id).with_for_update().first()
     if not product:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Producto no encontrado")
     
+    if product.high_contention:
+        # Sin el producto el reconciliador ya no tomaria estas reservas
+        db.query(ProcessedMessageModel).filter(
+            ProcessedMessageModel.product_id == id, ProcessedMessageModel.stock_applied.is_(False)
+        ).update({ProcessedMessageModel.stock_applied: True}, synchronize_session=False)
     db.delete(product)
     db.commit()
+    if product.high_contention:
+        stock.get_redis().delete(stock.counter_key(id))
+    catalog.safe_refresh(db, [id])
+    product_events.safe_publish(db, [id])
     logging.info(f"Producto con ID {id} eliminado exitosamente.")
     return {"detail": "Producto eliminado exitosamente"}
 
 @app.put("/products/update/{id}", response_model=Product)
-def update_product(id: int, product_data: ProductUpdate, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)) -> Any:
-    logging.info(f"Usuario actual intentando actualizar producto: {current_user}")
-    logging.info(f"Datos del producto recibido para actualización: {product_data}")
+def update_product(
+    id: int,
+    product_data: ProductUpdate,
+    response: Response,
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+) -> Any:
+    logging.debug("Usuario %s actualiza el producto %s: %s", current_user["username"], id, product_data)
 
     # Solo los administradores pueden actualizar productos
     if current_user["role"] != "admin":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No tienes permisos de administrador")
 
-    db_product = db.query(ProductModel).filter(ProductModel.id == id).first()
+    return idempotent(response, f"products.update.{id}", current_user, idempotency_key, product_data.model_dump(mode="json"), lambda: apply_product_update(id, product_data, db))
+
+def apply_product_update(id: int, product_data: ProductUpdate, db: Session) -> dict:
+    # FOR UPDATE: con el producto en alta concurrencia no debe haber reservas en curso al recalcular el contador
+    db_product = db.query(ProductModel).filter(ProductModel.id == id).with_for_update().first()
 
     if not db_product:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Producto no encontrado")
     
     try:
-        for key, value in product_data.model_dump().items():
+        # Solo los campos enviados con valor: un campo omitido o en null no se modifica
+        changes = product_data.model_dump(exclude_unset=True, exclude_none=True)
+        for key, value in changes.items():
             setattr(db_product, key, value)
 
+        if db_product.high_contention and "stock" in changes:
+            # El contador de Redis toma el nuevo stock menos lo reservado sin aplicar
+            db.flush()
+            stock.rebuild_counter(db, id, force=True)
         db.commit()
         db.refresh(db_product)
-        logging.info(f"Producto actualizado exitosamente: {db_product}")
-        return db_product
+        catalog.safe_refresh(db, [id])
+        product_events.safe_publish(db, [id])
+        logging.info(f"Producto {id} actualizado")
+        return Product.model_validate(db_product).model_dump(mode="json")
     
     except Exception as e:
         db.rollback()
-        logging.error(f"Error interno al actualizar el producto: {str(e)}")
-        import traceback
-        traceback.print_exc()
-
+        logging.exception(f"Error interno al actualizar el producto: {str(e)}")
         raise HTTPException(
             status_code=500,
             detail=f"Error interno al actualizar el producto: {str(e)}"
         )
-    
-# Lanza el consumidor de RabbitMQ en un hilo separado al inicio
-@app.lifespan("startup")
-def startup_event():
-    # Inicia el consumidor en un hilo separado
-    consumer_thread = threading.Thread(target=start_consumer)
-    consumer_thread.daemon = True
-    consumer_thread.start()
\ No newline at end of file
+
+@app.put("/products/{id}/high-contention", response_model=Product)
+def set_high_contention(id: int, data: HighContentionUpdate, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)) -> Any:
+    """
+    Activa o desactiva el modo de alta concurrencia (stock en Redis) de un producto.
+    """
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No tienes permisos de administrador")
+    if not stock.enabled():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Redis no está configurado en productos")
+
+    # FOR UPDATE: espera a los pedidos en curso del producto y frena los nuevos hasta confirmar (ver stock.py)
+    db_product = db.query(ProductModel).filter(ProductModel.id == id).with_for_update().first()
+    if not db_product:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Producto no encontrado")
+
+    try:
+        if data.enabled:
+            db_product.high_contention = True
+            db.flush()
+            stock.rebuild_counter(db, id, force=True)
+            db.commit()
+        else:
+            # Las reservas pendientes se aplican antes de volver al descuento directo en la base
+            applied = stock.apply_pending(db, id)
+            db_product.high_contention = False
+            db.commit()
+            stock.get_redis().delete(stock.counter_key(id))
+            logging.info(f"Aplicados {applied} pedidos pendientes del producto {id}")
+    except ValueError as e:
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except Exception:
+        db.rollback()
+        raise
+
+    db.refresh(db_product)
+    catalog.safe_refresh(db, [id])
+    logging.info(f"Modo de alta concurrencia del producto {id}: {data.enabled}")
+    return db_product
+
+@app.get("/catalog/snapshot")
+def catalog_snapshot(db: Session = Depends(get_db)):
+    """
+    El catalogo completo ya serializado. Si Redis perdio el snapshot lo
+    reconstruye y lo publica, asi el gateway lo vuelve a encontrar ahi.
+    """
+    if not stock.enabled():
+        products = db.query(ProductModel).all()
+        return Response(content="[" + ",".join(catalog.serialize(product) for product in products) + "]", media_type="application/json")
+    return Response(content=catalog.publish_full(db), media_type="application/json")
+
+@app.get("/catalog/stats")
+def catalog_stats() -> Any:
+    """
+    Version, cantidad de productos, tamaño y tiempo de armado del ultimo snapshot.
+    """
+    if not stock.enabled():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Redis no está configurado en productos")
+    return catalog.stats()
+
+# --- Sondeos de salud ---
+# /health/live solo indica que el proceso responde (no reiniciarlo);
+# /health/ready indica si puede recibir trafico.
+
+@app.get("/health/live")
+def liveness():
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness():
+    if not ready:
+        return JSONResponse(status_code=503, content={"status": "starting", "startup_ms": startup_phases})
+    try:
+        await run_in_threadpool(check_database)
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"status": "unavailable", "detail": f"Base de datos: {e}"})
+    return {"status": "ready", "startup_ms": startup_phases}
+
+# El consumidor de RabbitMQ ya no corre dentro de este proceso web:
+# se lanza aparte con `python worker.py` (ver worker.py y start.sh).
+
+record_phase("imports", IMPORT_STARTED)
\ No newline at end of file
@@ -1,5 +1,6 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Float
+from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, Index
+from sqlalchemy.sql import func
 
 Base = declarative_base()
 
@@ -8,4 +9,23 @@ class Product(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
     price = Column(Float)
-    stock = Column(Integer)
\ No newline at end of file
+    stock = Column(Integer)
+    # En modo de alta concurrencia el stock se reserva en Redis (ver stock.py)
+    high_contention = Column(Boolean, nullable=False, default=False, server_default="false")
+
+# Pedidos ya procesados por el consumidor. La clave primaria order_id
+# evita descontar stock dos veces cuando RabbitMQ reentrega un mensaje.
+class ProcessedMessage(Base):
+    __tablename__ = "processed_messages"
+    order_id = Column(Integer, primary_key=True)
+    product_id = Column(Integer)
+    quantity = Column(Integer)
+    status = Column(String)
+    reason = Column(String, nullable=True)
+    processed_at = Column(DateTime, server_default=func.now())
+    # False mientras el descuento solo se hizo en Redis y falta aplicarlo a products
+    stock_applied = Column(Boolean, nullable=False, default=True, server_default="true")
+
+    __table_args__ = (
+        Index("ix_processed_messages_pending", "product_id", postgresql_where=(stock_applied.is_(False))),
+    )
\ No newline at end of file
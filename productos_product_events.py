@@ -0,0 +1,55 @@
+import os
+import json
+import logging
+
+from models import Product as ProductModel
+import profiling
+
+# Eventos de cambios de productos.
+#
+# Despues de crear, modificar o eliminar un producto se publica su estado
+# actual (precio y stock) en el exchange fanout product_events. pedidos
+# mantiene con ellos una cache local de precios (ver prices.py en pedidos) y
+# calcula el total de cada pedido sin llamar a productos.
+#
+# Se publica lo que hay en la base despues del commit y no el cambio en si:
+# si dos eventos del mismo producto llegan en desorden, el siguiente cambio
+# (o el vencimiento de la cache en pedidos) lo corrige. Los productos que ya no
+# existen se publican como "delete".
+
+PRODUCT_EVENTS_EXCHANGE = "product_events"
+
+
+def product_event(product: ProductModel) -> dict:
+    return {"type": "upsert", "id": product.id, "price": product.price, "stock": product.stock}
+
+
+def publish(events: list[dict]):
+    import pika  # diferido: el proceso web solo lo necesita al modificar productos
+
+    connection = None
+    try:
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=os.getenv("RABBITMQ_HOST")))
+        channel = connection.channel()
+        channel.exchange_declare(exchange=PRODUCT_EVENTS_EXCHANGE, exchange_type="fanout", durable=True)
+        for event in events:
+            channel.basic_publish(exchange=PRODUCT_EVENTS_EXCHANGE, routing_key="", body=json.dumps(event))
+    finally:
+        if connection and connection.is_open:
+            connection.close()
+
+
+def safe_publish(db, product_ids):
+    """
+    Publica el estado actual de los productos indicados. La escritura ya esta
+    confirmada: un fallo solo se registra, pedidos lo corrige al vencer su cache.
+    """
+    product_ids = {int(product_id) for product_id in product_ids}
+    try:
+        products = db.query(ProductModel).filter(ProductModel.id.in_(product_ids)).all()
+        events = [product_event(product) for product in products]
+        events += [{"type": "delete", "id": product_id} for product_id in product_ids - {product.id for product in products}]
+        with profiling.timed("rabbitmq product_events"):
+            publish(events)
+    except Exception as e:
+        logging.error(f"No se pudieron publicar los cambios de productos {sorted(product_ids)}: {e}")
\ No newline at end of file
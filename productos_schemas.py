@@ -20,8 +20,13 @@ class ProductUpdate(ProductBase):
 # Schema para la representación de un producto en la API.
 class Product(ProductBase):
     id: int
+    high_contention: bool = False
     
     # Esto es necesario para que Pydantic pueda leer los datos
     # de los objetos de SQLAlchemy.
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+# Schema para activar o desactivar el modo de alta concurrencia de un producto.
+class HighContentionUpdate(BaseModel):
+    enabled: bool
\ No newline at end of file
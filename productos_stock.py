@@ -0,0 +1,232 @@
+import os
+import time
+import logging
+
+from sqlalchemy import text
+
+# Modo de alta concurrencia para productos en promocion.
+#
+# Para los productos marcados con high_contention el consumidor no descuenta
+# products.stock fila por fila (cada UPDATE se serializa en el lock de la fila):
+# reserva las unidades en un contador de Redis con un script Lua atomico y
+# deja el pedido en processed_messages con stock_applied = false. El
+# reconciliador aplica esas filas a products en lotes.
+#
+# Invariante: contador = products.stock - (pedidos confirmados sin aplicar).
+# Si Redis se reinicia, los contadores se reconstruyen desde la base con esa formula.
+#
+# Cambio de modo: el consumidor lee high_contention con FOR KEY SHARE, un lock
+# que dura hasta confirmar el pedido. Ese lock no frena a otros consumidores
+# ni a los UPDATE de stock, pero si al SELECT ... FOR UPDATE del producto: quien
+# cambia el modo o el stock espera a que terminen los pedidos en curso (y sus
+# reservas en Redis queden en processed_messages) y los nuevos esperan a que
+# confirme. Al desactivar el modo las reservas pendientes se aplican en esa
+# misma transaccion, asi el descuento directo en la base nunca las ignora.
+
+REDIS_HOST = os.getenv("REDIS_HOST")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+
+STOCK_RECONCILE_INTERVAL = float(os.getenv("STOCK_RECONCILE_INTERVAL", "2"))
+STOCK_RECONCILE_BATCH = int(os.getenv("STOCK_RECONCILE_BATCH", "5000"))
+
+# Resultados especiales de reserve()
+INSUFFICIENT = -1
+COUNTER_MISSING = -2
+
+# Descuenta ARGV[1] del contador solo si alcanza. Devuelve el stock restante,
+# -1 si no alcanza o -2 si el contador no existe (Redis reiniciado).
+RESERVE_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if not current then
+    return -2
+end
+if tonumber(current) < tonumber(ARGV[1]) then
+    return -1
+end
+return redis.call('DECRBY', KEYS[1], ARGV[1])
+"""
+
+_redis = None
+_reserve = None
+
+
+def enabled() -> bool:
+    return REDIS_HOST is not None
+
+
+def get_redis():
+    """Cliente de Redis del proceso, creado en el primer uso."""
+    global _redis, _reserve
+    if _redis is None:
+        import redis
+        _redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+        _reserve = _redis.register_script(RESERVE_SCRIPT)
+    return _redis
+
+
+def counter_key(product_id: int) -> str:
+    return f"stock:{product_id}"
+
+
+def is_hot(db, product_id: int) -> bool:
+    """
+    Indica si el producto esta en modo de alta concurrencia. Se lee en cada
+    pedido, dentro de su transaccion, con FOR KEY SHARE (ver arriba).
+    """
+    if not enabled():
+        return False
+    return bool(db.execute(
+        text("SELECT high_contention FROM products WHERE id = :product_id FOR KEY SHARE"),
+        {"product_id": product_id}
+    ).scalar())
+
+
+def reserve(product_id: int, quantity: int) -> int:
+    get_redis()
+    return int(_reserve(keys=[counter_key(product_id)], args=[quantity]))
+
+
+def release(product_id: int, quantity: int):
+    """Devuelve unidades reservadas cuando la transaccion del pedido falla."""
+    get_redis().incrby(counter_key(product_id), quantity)
+
+
+def expected_counter(db, product_id: int):
+    """
+    Valor correcto del contador segun la base, o None si el producto no
+    existe o ya no esta en modo de alta concurrencia.
+    """
+    row = db.execute(text("""
+        SELECT p.stock - COALESCE((
+            SELECT SUM(m.quantity) FROM processed_messages m
+            WHERE m.product_id = p.id AND m.status = 'confirmed' AND NOT m.stock_applied
+        ), 0) AS available
+        FROM products p
+        WHERE p.id = :product_id AND p.high_contention
+    """), {"product_id": product_id}).first()
+    return None if row is None else int(row.available)
+
+
+def rebuild_counter(db, product_id: int, force: bool = False) -> bool:
+    """
+    Recrea el contador desde la base. Sin force solo lo crea si falta, para
+    no pisar reservas hechas mientras tanto. Devuelve False si el producto
+    no esta en modo de alta concurrencia.
+    """
+    available = expected_counter(db, product_id)
+    if available is None:
+        return False
+    get_redis().set(counter_key(product_id), available, nx=not force)
+    return True
+
+
+def ensure_counters(db) -> int:
+    """
+    Crea los contadores que falten (por ejemplo tras un reinicio de Redis).
+    Devuelve cuantos productos en modo de alta concurrencia hay.
+    """
+    product_ids = [row.id for row in db.execute(text("SELECT id FROM products WHERE high_contention"))]
+    for product_id in product_ids:
+        rebuild_counter(db, product_id)
+    return len(product_ids)
+
+
+def apply_pending(db, product_id: int) -> int:
+    """
+    Aplica a products todos los pedidos confirmados sin aplicar de un
+    producto. Se llama con la fila del producto tomada con FOR UPDATE y no confirma la
+    transaccion. Lanza ValueError si el stock quedaria negativo.
+    """
+    row = db.execute(text("""
+        WITH pending AS (
+            UPDATE processed_messages SET stock_applied = true
+            WHERE product_id = :product_id AND NOT stock_applied AND status = 'confirmed'
+            RETURNING quantity
+        ), applied AS (
+            UPDATE products SET stock = stock - (SELECT COALESCE(SUM(quantity), 0) FROM pending)
+            WHERE id = :product_id
+            RETURNING stock
+        )
+        SELECT (SELECT COUNT(*) FROM pending) AS orders, (SELECT stock FROM applied) AS stock
+    """), {"product_id": product_id}).one()
+    if row.stock is not None and row.stock < 0:
+        raise ValueError(f"Las reservas pendientes del producto {product_id} superan su stock")
+    return row.orders
+
+
+def reconcile(db) -> tuple[int, set[int]]:
+    """
+    Aplica a products los pedidos confirmados en Redis, en un solo UPDATE por
+    lote. Marcar las filas y descontar el stock ocurre en la misma sentencia,
+    asi el invariante del contador se mantiene. Devuelve las filas aplicadas
+    y los productos modificados.
+
+    Nunca espera un lock: saltea los pedidos ya tomados y los productos que
+    otra transaccion tiene tomados (un cambio de modo o de stock). Un
+    producto cuyo stock no alcanza para el lote no se descuenta y sus
+    pedidos quedan pendientes.
+    """
+    result = db.execute(text("""
+        WITH candidates AS (
+            SELECT m.order_id, m.product_id, m.quantity
+            FROM processed_messages m JOIN products p ON p.id = m.product_id
+            WHERE NOT m.stock_applied AND m.status = 'confirmed'
+            ORDER BY m.order_id
+            LIMIT :batch
+            FOR UPDATE OF m SKIP LOCKED
+            FOR NO KEY UPDATE OF p SKIP LOCKED
+        ), totals AS (
+            SELECT product_id, SUM(quantity) AS total, COUNT(*) AS orders
+            FROM candidates GROUP BY product_id
+        ), applied AS (
+            UPDATE products p SET stock = p.stock - totals.total
+            FROM totals WHERE p.id = totals.product_id AND p.stock >= totals.total
+            RETURNING p.id
+        ), marked AS (
+            UPDATE processed_messages m SET stock_applied = true
+            FROM candidates c
+            WHERE m.order_id = c.order_id AND c.product_id IN (SELECT id FROM applied)
+        )
+        SELECT t.product_id, t.orders, a.id IS NOT NULL AS applied
+        FROM totals t LEFT JOIN applied a ON a.id = t.product_id
+    """), {"batch": STOCK_RECONCILE_BATCH})
+    rows = result.all()
+    db.commit()
+    for row in rows:
+        if not row.applied:
+            logging.error(f"Stock insuficiente para aplicar {row.orders} pedidos del producto {row.product_id}; quedan pendientes.")
+    applied = [row for row in rows if row.applied]
+    return sum(row.orders for row in applied), {row.product_id for row in applied}
+
+
+def run_reconciler(session_factory, should_stop=lambda: False, on_applied=None, on_cycle=None):
+    """
+    Bucle del reconciliador: aplica los pedidos pendientes en lotes y repone
+    los contadores que falten en Redis. on_applied recibe los productos cuyo
+    stock cambio y on_cycle(db) se llama al final de cada ciclo.
+    """
+    while not should_stop():
+        db = session_factory()
+        try:
+            ensure_counters(db)
+            db.commit()
+            # Vacia la cola pendiente lote a lote antes de volver a dormir
+            while not should_stop():
+                applied, product_ids = reconcile(db)
+                if applied:
+                    logging.info(f"Reconciliados {applied} pedidos de productos en alta concurrencia.")
+                    if on_applied:
+                        on_applied(*product_ids)
+                if applied < STOCK_RECONCILE_BATCH:
+                    break
+            if on_cycle:
+                on_cycle(db)
+        except Exception as e:
+            db.rollback()
+            logging.error(f"Error en el reconciliador de stock: {e}")
+        finally:
+            db.close()
+
+        deadline = time.monotonic() + STOCK_RECONCILE_INTERVAL
+        while not should_stop() and time.monotonic() < deadline:
+            time.sleep(0.2)
\ No newline at end of file
@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Supervisor de los workers consumidores de pedidos.
+#
+# Corre separado del proceso web de productos (python worker.py). Lanza
+# CONSUMER_WORKERS procesos, cada uno dueño de un subconjunto fijo de las colas
+# particionadas por product_id, los reinicia si mueren y ante SIGTERM les pide
+# que terminen el mensaje en curso antes de salir. Si hay Redis configurado
+# tambien supervisa el reconciliador de stock (ver stock.py). Expone /health y
+# /lag por HTTP.
+
+import logging_config
+
+CONSUMER_WORKERS = int(os.getenv("CONSUMER_WORKERS", "2"))
+ORDER_QUEUE_SHARDS = int(os.getenv("ORDER_QUEUE_SHARDS", "8"))  # igual que en consumer.py
+CONSUMER_HEALTH_PORT = int(os.getenv("CONSUMER_HEALTH_PORT", "8001"))
+CONSUMER_DRAIN_TIMEOUT = float(os.getenv("CONSUMER_DRAIN_TIMEOUT", "30"))
+# Un worker sin latido durante este tiempo se reporta como no saludable
+HEARTBEAT_TIMEOUT = float(os.getenv("CONSUMER_HEARTBEAT_TIMEOUT", "30"))
+
+
+def assign_queues(workers: int, shards: int) -> list[list[str]]:
+    """
+    Reparte las colas entre los workers por turnos. El worker 0 ademas drena
+    la cola order_queue anterior al particionado.
+    """
+    assignments = [[f"order_queue.{shard}" for shard in range(shards) if shard % workers == index] for index in range(workers)]
+    assignments[0].insert(0, "order_queue")
+    return assignments
+
+
+def run_worker(index: int, queues: list[str], stop_event, heartbeats, processed):
+    """
+    Punto de entrada de cada proceso worker.
+    """
+    # El supervisor coordina el apagado: SIGINT (Ctrl+C al grupo) se ignora y
+    # SIGTERM solo marca la parada para drenar el mensaje en curso.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    # Los hijos se crean con spawn: arrancan un interprete nuevo, sin la configuracion de logs del supervisor
+    logging_config.setup("productos-worker")
+
+    # Importacion diferida: la conexion a la base se crea dentro del proceso hijo
+    import consumer
+
+    def on_message(ch, method, properties, body):
+        consumer.callback(ch, method, properties, body)
+        with processed.get_lock():
+            processed[index] += 1
+
+    def on_tick():
+        heartbeats[index] = time.time()
+
+    logging.info(f"Worker {index} (pid {os.getpid()}) consumiendo {', '.join(queues)}")
+    consumer.start_consumer(queues=queues, on_message=on_message, should_stop=stop_event.is_set, on_tick=on_tick)
+    logging.info(f"Worker {index} finalizado.")
+
+
+def run_reconciler(stop_event):
+    """
+    Punto de entrada del proceso que aplica a la base el stock reservado en
+    Redis y publica los cambios de stock en el snapshot del catalogo.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    logging_config.setup("productos-reconciler")
+
+    import consumer
+    import stock
+    import catalog
+
+    # Ademas de reconciliar, publica en el snapshot del catalogo el stock
+    # que cambiaron el consumidor y el propio reconciliador
+    logging.info(f"Reconciliador de stock iniciado (pid {os.getpid()})")
+    stock.run_reconciler(
+        consumer.SessionLocal,
+        should_stop=stop_event.is_set,
+        on_applied=catalog.mark_dirty,
+        on_cycle=catalog.publish_dirty,
+    )
+
+
+def queue_depths(queues: list[str]) -> dict:
+    """
+    Mensajes pendientes y consumidores de cada cola, via queue_declare pasivo.
+    """
+    import pika  # diferido: solo lo usa /lag
+
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=os.getenv("RABBITMQ_HOST")))
+    try:
+        channel = connection.channel()
+        depths = {}
+        for queue in queues:
+            result = channel.queue_declare(queue=queue, passive=True)
+            depths[queue] = {
+                "messages": result.method.message_count,
+                "consumers": result.method.consumer_count,
+            }
+        return depths
+    finally:
+        connection.close()
+
+
+class Supervisor:
+    def __init__(self, workers: int, shards: int):
+        if workers > shards:
+            logging.warning(f"CONSUMER_WORKERS={workers} es mayor que ORDER_QUEUE_SHARDS={shards}, se usan {shards} workers.")
+            workers = shards
+        self.workers = workers
+        self.assignments = assign_queues(workers, shards)
+        self.context = multiprocessing.get_context("spawn")
+        self.stop_event = self.context.Event()
+        self.heartbeats = self.context.Array("d", workers)
+        self.processed = self.context.Array("q", workers)
+        self.processes = [None] * workers
+        self.restarts = [0] * workers
+        self.reconciler = None
+
+    def spawn(self, index: int):
+        self.heartbeats[index] = time.time()
+        process = self.context.Process(
+            target=run_worker,
+            args=(index, self.assignments[index], self.stop_event, self.heartbeats, self.processed),
+            name=f"consumer-worker-{index}",
+        )
+        process.start()
+        self.processes[index] = process
+
+    def spawn_reconciler(self):
+        # Solo hace falta si el modo de alta concurrencia tiene Redis configurado
+        if not os.getenv("REDIS_HOST"):
+            return
+        self.reconciler = self.context.Process(target=run_reconciler, args=(self.stop_event,), name="stock-reconciler")
+        self.reconciler.start()
+
+    def status(self) -> dict:
+        now = time.time()
+        workers = []
+        for index, process in enumerate(self.processes):
+            heartbeat_age = now - self.heartbeats[index]
+            workers.append({
+                "index": index,
+                "pid": process.pid if process else None,
+                "alive": bool(process and process.is_alive()) and heartbeat_age < HEARTBEAT_TIMEOUT,
+                "queues": self.assignments[index],
+                "processed": self.processed[index],
+                "restarts": self.restarts[index],
+                "heartbeat_age": round(heartbeat_age, 2),
+            })
+        reconciler_alive = self.reconciler is None or self.reconciler.is_alive()
+        return {
+            "stopping": self.stop_event.is_set(),
+            "healthy": all(worker["alive"] for worker in workers) and reconciler_alive,
+            "workers": workers,
+            "reconciler": None if self.reconciler is None else {"pid": self.reconciler.pid, "alive": reconciler_alive},
+        }
+
+    def lag(self) -> dict:
+        queues = [queue for assigned in self.assignments for queue in assigned]
+        # Las colas <cola>.retry tienen los mensajes esperando su reintento (ver consumer.py)
+        return queue_depths(queues + [f"{queue}.retry" for queue in queues] + ["order_queue.dlq"])
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop_event.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop_event.set())
+
+        for index in range(self.workers):
+            self.spawn(index)
+        self.spawn_reconciler()
+        start_health_server(self)
+
+        # Reinicia los workers que mueren mientras el supervisor siga activo
+        while not self.stop_event.is_set():
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    self.restarts[index] += 1
+                    logging.error(f"Worker {index} terminó con código {process.exitcode}, reiniciando...")
+                    self.spawn(index)
+            if self.reconciler is not None and not self.reconciler.is_alive():
+                logging.error("El reconciliador de stock terminó, reiniciando...")
+                self.spawn_reconciler()
+            self.stop_event.wait(1)
+
+        self.drain()
+
+    def drain(self):
+        logging.info(f"Deteniendo workers, esperando hasta {CONSUMER_DRAIN_TIMEOUT} segundos...")
+        deadline = time.monotonic() + CONSUMER_DRAIN_TIMEOUT
+        processes = self.processes + ([self.reconciler] if self.reconciler else [])
+        for process in processes:
+            process.join(max(0, deadline - time.monotonic()))
+        for process in processes:
+            if process.is_alive():
+                logging.warning(f"{process.name} no terminó a tiempo, forzando la salida.")
+                process.kill()
+                process.join()
+
+
+def start_health_server(supervisor: Supervisor):
+    class HealthHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/health":
+                body = supervisor.status()
+                code = 200 if body["healthy"] and not body["stopping"] else 503
+            elif self.path == "/lag":
+                try:
+                    body, code = supervisor.lag(), 200
+                except Exception as e:
+                    body, code = {"detail": f"No se pudo consultar RabbitMQ: {e}"}, 503
+            else:
+                body, code = {"detail": "Not Found"}, 404
+
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass  # los sondeos de salud no se registran
+
+    server = ThreadingHTTPServer(("0.0.0.0", CONSUMER_HEALTH_PORT), HealthHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logging.info(f"Endpoint de salud del consumidor en el puerto {CONSUMER_HEALTH_PORT}")
+
+
+if __name__ == "__main__":
+    # Solo en el supervisor: los hijos importan este modulo y configuran sus logs con su propio nombre
+    logging_config.setup("productos-worker")
+    Supervisor(CONSUMER_WORKERS, ORDER_QUEUE_SHARDS).run()
\ No newline at end of file
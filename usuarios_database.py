@@ -22,13 +22,4 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
-
-# Función para crear las tablas
-def create_tables():
-    print("Creando tablas...")
-    Base.metadata.create_all(bind=engine)
-    print("¡Tablas creadas exitosamente!")
-
-if __name__ == "__main__":
-    create_tables()
\ No newline at end of file
+        db.close()
\ No newline at end of file
@@ -0,0 +1,140 @@
+import os
+import time
+import base64
+import secrets
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from sqlalchemy import text
+
+from database import SessionLocal
+from models import SigningKey
+
+# Claves de firma de los access tokens.
+#
+# usuarios firma con Ed25519 (EdDSA) y publica las claves publicas en
+# /.well-known/jwks.json. Los demas servicios verifican localmente con esas
+# claves (ver jwks.py en cada servicio) y ya no necesitan un secreto
+# compartido que tambien les permitiria emitir tokens.
+#
+# Las claves viven en la tabla signing_keys para que todas las replicas
+# firmen con la misma. Cuando la mas reciente tiene mas de
+# JWT_KEY_ROTATION_DAYS se genera otra; las JWKS_PUBLISHED_KEYS mas recientes
+# se siguen publicando, asi los tokens firmados antes de rotar siguen siendo
+# validos hasta vencer. Cada proceso relee la tabla cada KEYS_RELOAD_INTERVAL.
+
+JWT_KEY_ROTATION_DAYS = int(os.getenv("JWT_KEY_ROTATION_DAYS", "30"))
+JWKS_PUBLISHED_KEYS = int(os.getenv("JWKS_PUBLISHED_KEYS", "3"))
+KEYS_RELOAD_INTERVAL = float(os.getenv("KEYS_RELOAD_INTERVAL", "60"))
+# Si esta definido, las claves privadas se guardan cifradas en la base
+JWT_KEYS_PASSPHRASE = os.getenv("JWT_KEYS_PASSPHRASE")
+
+ALGORITHM = "EdDSA"
+
+# Clave del advisory lock: evita que dos replicas roten a la vez
+KEYS_LOCK_ID = 80421
+
+_keys = []  # [(kid, clave privada)], la mas reciente primero
+_loaded_at = 0.0
+_lock = threading.Lock()
+
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def serialize_private_key(private_key: Ed25519PrivateKey) -> str:
+    encryption = (
+        serialization.BestAvailableEncryption(JWT_KEYS_PASSPHRASE.encode("utf-8"))
+        if JWT_KEYS_PASSPHRASE else serialization.NoEncryption()
+    )
+    return private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, encryption).decode("ascii")
+
+
+def load_private_key(pem: str) -> Ed25519PrivateKey:
+    password = JWT_KEYS_PASSPHRASE.encode("utf-8") if JWT_KEYS_PASSPHRASE else None
+    return serialization.load_pem_private_key(pem.encode("ascii"), password=password)
+
+
+def public_jwk(kid: str, private_key: Ed25519PrivateKey) -> dict:
+    public_bytes = private_key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+    return {"kty": "OKP", "crv": "Ed25519", "x": b64url(public_bytes), "kid": kid, "alg": ALGORITHM, "use": "sig"}
+
+
+def rotation_due(db) -> bool:
+    newest = db.query(SigningKey.created_at).order_by(SigningKey.created_at.desc()).first()
+    return newest is None or newest.created_at < datetime.utcnow() - timedelta(days=JWT_KEY_ROTATION_DAYS)
+
+
+def rotate_if_due(db):
+    """Genera una clave nueva si no hay ninguna o la actual ya cumplio su periodo."""
+    if not rotation_due(db):
+        return
+    db.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": KEYS_LOCK_ID})
+    # Otra replica pudo haber rotado mientras se esperaba el lock
+    if rotation_due(db):
+        kid = secrets.token_hex(8)
+        db.add(SigningKey(kid=kid, private_key=serialize_private_key(Ed25519PrivateKey.generate())))
+        logging.info(f"Nueva clave de firma de tokens: {kid}")
+    db.commit()
+
+
+def reload_keys():
+    """Rota si corresponde y carga las claves publicadas."""
+    global _keys, _loaded_at
+    db = SessionLocal()
+    try:
+        rotate_if_due(db)
+        rows = db.query(SigningKey).order_by(SigningKey.created_at.desc()).limit(JWKS_PUBLISHED_KEYS).all()
+        _keys = [(row.kid, load_private_key(row.private_key)) for row in rows]
+        _loaded_at = time.monotonic()
+    finally:
+        db.close()
+
+
+def ensure_loaded():
+    """
+    Recarga las claves si pasaron KEYS_RELOAD_INTERVAL segundos. Si otro hilo
+    ya esta recargando se siguen usando las claves actuales.
+    """
+    global _loaded_at
+    if _keys and time.monotonic() - _loaded_at < KEYS_RELOAD_INTERVAL:
+        return
+    if not _lock.acquire(blocking=not _keys):
+        return
+    try:
+        if not _keys or time.monotonic() - _loaded_at >= KEYS_RELOAD_INTERVAL:
+            reload_keys()
+    except Exception as e:
+        if not _keys:
+            raise
+        # Se sigue firmando con las claves cargadas y se reintenta en el proximo intervalo
+        logging.error(f"No se pudieron recargar las claves de firma: {e}")
+        _loaded_at = time.monotonic()
+    finally:
+        _lock.release()
+
+
+def signing_key() -> tuple[str, Ed25519PrivateKey]:
+    """kid y clave privada con la que se firman los tokens nuevos."""
+    ensure_loaded()
+    return _keys[0]
+
+
+def jwks() -> dict:
+    ensure_loaded()
+    return {"keys": [public_jwk(kid, private_key) for kid, private_key in _keys]}
+
+
+def decode(token: str) -> dict:
+    """Verifica un access token emitido por este servicio y devuelve su payload."""
+    ensure_loaded()
+    kid = jwt.get_unverified_header(token).get("kid")
+    for key_id, private_key in _keys:
+        if key_id == kid:
+            return jwt.decode(token, private_key.public_key(), algorithms=[ALGORITHM])
+    raise jwt.InvalidTokenError(f"Clave de firma desconocida: {kid}")
\ No newline at end of file
@@ -1,29 +1,112 @@
+import time
+
+# Marca del inicio del arranque, para medir cuanto tarda el servicio en estar listo
+IMPORT_STARTED = time.perf_counter()
+
 import os
+import logging
 import bcrypt
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 import jwt
 from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response
+from sqlalchemy import exists, select, text
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import Session
 from dotenv import load_dotenv
 
-from database import create_tables, get_db
+from database import engine, get_db
 from models import User as UserModel
-from schemas import UserCreate, UserLogin, Token
-from fastapi.security import OAuth2PasswordRequestForm
+from schemas import UserCreate, UserLogin, Token, RefreshRequest, BulkRegisterResult, UsernameAvailability
+import tokens
+import keys
+import usernames
+import profiling
+import logging_config
+from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from typing import List
+
+# Logs en JSON, con request_id y escritos desde un hilo aparte (ver logging_config.py)
+logging_config.setup("usuarios")
+
+# --- Arranque ---
+# El esquema lo aplica migrations.py antes de levantar Uvicorn, aca no hay DDL.
+# El lifespan calienta el pool de conexiones; /health/ready devuelve 503
+# hasta que termina y luego informa cuanto tardo cada fase.
+startup_phases = {}
+ready = False
+
+def record_phase(name: str, started: float):
+    startup_phases[name] = round((time.perf_counter() - started) * 1000, 1)
+
+def check_database():
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global ready
+    started = time.perf_counter()
+    # Descarta conexiones heredadas si el proceso se creo con fork (gunicorn --preload):
+    # cada worker abre su propio pool
+    engine.dispose(close=False)
+    try:
+        await run_in_threadpool(check_database)
+    except Exception as e:
+        # No se aborta el arranque: /health/ready seguira respondiendo 503
+        logging.error(f"No se pudo conectar a la base de datos al iniciar: {e}")
+    record_phase("database", started)
 
-create_tables()
+    # Carga (o genera en el primer arranque) las claves de firma de tokens
+    started = time.perf_counter()
+    try:
+        await run_in_threadpool(keys.ensure_loaded)
+    except Exception as e:
+        logging.error(f"No se pudieron cargar las claves de firma: {e}")
+    record_phase("signing_keys", started)
 
-app = FastAPI()
+    # Filtro de nombres ocupados para /register/available, se arma en segundo plano
+    usernames.start()
 
-# Clave secreta para JWT
-SECRET_KEY = os.getenv("JWT_SECRET_KEY")
-ALGORITHM = "HS256"
+    record_phase("total", IMPORT_STARTED)
+    ready = True
+    logging.info(f"Servicio de usuarios listo en {startup_phases['total']} ms: {startup_phases}")
+    yield
+    ready = False
+
+app = FastAPI(lifespan=lifespan)
+
+# Perfilado opcional por request (ver profiling.py)
+profiling.install(app, keys.decode)
+profiling.instrument_engine(engine)
+logging_config.install(app)
+
+# Los tokens se firman con las claves Ed25519 de keys.py; JWT_SECRET_KEY ya
+# no se usa para firmar (los demas servicios solo lo aceptan para verificar
+# tokens HS256 emitidos antes del cambio, hasta JWT_ACCEPT_HS256_UNTIL).
+# Duracion del access token; al vencer el cliente usa /token/refresh
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
 
 # Hash de la contraseña
 def hash_password(password: str):
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
+# Pool para hashear en paralelo en /register/bulk. bcrypt libera el GIL
+# mientras calcula, asi que los hilos usan todos los cores del contenedor.
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", str(os.cpu_count() or 2)))
+BULK_REGISTER_MAX = int(os.getenv("BULK_REGISTER_MAX", "5000"))
+BULK_INSERT_CHUNK = 1000
+_bcrypt_pool = None
+
+def bcrypt_pool() -> ThreadPoolExecutor:
+    global _bcrypt_pool
+    if _bcrypt_pool is None:
+        _bcrypt_pool = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+    return _bcrypt_pool
+
 # Verificar la contraseña si coincide con el hash almacenado
 def verify_password(plain_password: str, hashed_password: str):
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
@@ -37,39 +120,123 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None): # c
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
+        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
 
     to_encode.update({"exp": expire})  # agrega la fecha de expiracion al diccionario
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    kid, private_key = keys.signing_key()
+    encoded_jwt = jwt.encode(to_encode, private_key, algorithm=keys.ALGORITHM, headers={"kid": kid})
 
     return encoded_jwt
 
+# Respuesta de login: access token corto mas un refresh token nuevo
+def issue_tokens(db: Session, db_user: UserModel) -> dict:
+    access_token = create_access_token(
+        data={"sub": db_user.username, "role": db_user.role, "user_id": db_user.id}
+    )
+    refresh_token = tokens.issue_refresh_token(db, db_user.id)
+    db.commit()
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "refresh_token": refresh_token,
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    }
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token/")
+
+# Solo para endpoints de administracion de este servicio
+def get_current_admin(token: str = Depends(oauth2_scheme)) -> dict:
+    try:
+        payload = keys.decode(token)
+    except jwt.PyJWTError:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="No se pudo validar el token")
+    if payload.get("role") != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No tienes permisos de administrador")
+    return payload
+
+def username_taken(db: Session, username: str) -> bool:
+    return db.query(exists().where(UserModel.username == username)).scalar()
+
 # --- Endpoints ---
 @app.post("/register/", response_model=Token) # response_model es el esquema de respuesta que se espera par la interfaz grafica de swagger de fastapi
 def register_user(user: UserCreate, db: Session = Depends(get_db)):
-    # 1. Verifica si el usuario ya existe
-    db_user = db.query(UserModel).filter(UserModel.username == user.username).first()
-    
-    if db_user:
+    conflict = HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="El nombre de usuario ya está registrado."
+    )
+
+    # 1. Si el filtro dice que el nombre puede estar ocupado se confirma antes de pagar bcrypt
+    if usernames.maybe_taken(user.username) and username_taken(db, user.username):
+        raise conflict
+
+    # 2. Inserta el usuario; el indice unico de username decide si ya existe,
+    #    sin una consulta previa que igual podria perder la carrera
+    db_user = db.execute(
+        insert(UserModel)
+        .values(username=user.username, hashed_password=hash_password(user.password), role=user.role)
+        .on_conflict_do_nothing(index_elements=[UserModel.username])
+        .returning(UserModel.id, UserModel.username, UserModel.role)
+    ).first()
+    if db_user is None:
+        db.rollback()
+        raise conflict
+
+    usernames.add(user.username)
+    return issue_tokens(db, db_user)  # confirma el usuario y su refresh token juntos
+
+# Alta masiva para importaciones de administradores. Los nombres repetidos en
+# el lote o ya registrados se devuelven en "skipped" sin hashear su contraseña;
+# el resto se hashea en paralelo y se inserta en lotes de BULK_INSERT_CHUNK
+# con una sola transaccion.
+@app.post("/register/bulk", response_model=BulkRegisterResult)
+def register_bulk(users: List[UserCreate], db: Session = Depends(get_db), admin: dict = Depends(get_current_admin)):
+    if len(users) > BULK_REGISTER_MAX:
         raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail="El nombre de usuario ya está registrado."
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Se permiten como máximo {BULK_REGISTER_MAX} usuarios por lote"
         )
 
-    # 2. Si no existe, procede a crear el nuevo usuario
-    db_user = UserModel(
-        username=user.username,
-        hashed_password=hash_password(user.password),
-        role=user.role
-    )
-    db.add(db_user)
+    unique = {}
+    skipped = []
+    for user in users:
+        if user.username in unique:
+            skipped.append(user.username)
+        else:
+            unique[user.username] = user
+
+    existing = set(db.scalars(select(UserModel.username).where(UserModel.username.in_(list(unique)))))
+    pending = [user for username, user in unique.items() if username not in existing]
+    skipped.extend(username for username in unique if username in existing)
+
+    hashed = bcrypt_pool().map(hash_password, [user.password for user in pending])
+    rows = [
+        {"username": user.username, "hashed_password": hashed_password, "role": user.role}
+        for user, hashed_password in zip(pending, hashed)
+    ]
+
+    created = set()
+    for start in range(0, len(rows), BULK_INSERT_CHUNK):
+        result = db.execute(
+            insert(UserModel)
+            .values(rows[start:start + BULK_INSERT_CHUNK])
+            .on_conflict_do_nothing(index_elements=[UserModel.username])
+            .returning(UserModel.username)
+        )
+        created.update(result.scalars())
     db.commit()
-    db.refresh(db_user)
 
-    access_token = create_access_token(
-        data={"sub": db_user.username, "role": db_user.role}
-    )
-    return {"access_token": access_token, "token_type": "bearer"}
+    # Los que no se insertaron los registro otra peticion mientras tanto
+    skipped.extend(user.username for user in pending if user.username not in created)
+    for username in created:
+        usernames.add(username)
+    return {"created": len(created), "skipped": skipped}
+
+# Disponibilidad de un nombre de usuario. Si no esta en el filtro de Bloom
+# esta libre y se responde sin consultar la base.
+@app.get("/register/available", response_model=UsernameAvailability)
+def username_available(username: str, db: Session = Depends(get_db)):
+    available = not usernames.maybe_taken(username) or not username_taken(db, username)
+    return {"username": username, "available": available}
 
 # OAuth2PasswordRequestForm es una clase especial de FastAPI para manejar formularios de login
 # El usuario envia su username y password en un formulario
@@ -86,7 +253,52 @@ def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db:
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Credenciales incorrectas"
         )
-    access_token = create_access_token(
-        data={"sub": db_user.username, "role": db_user.role}
-    )
-    return {"access_token": access_token, "token_type": "bearer"}
\ No newline at end of file
+    return issue_tokens(db, db_user)
+
+# Emite un access token nuevo a partir de un refresh token, sin verificar la
+# contraseña. El refresh token usado queda revocado y se entrega uno nuevo.
+@app.post("/token/refresh", response_model=Token)
+def refresh_access_token(data: RefreshRequest, db: Session = Depends(get_db)):
+    user_id = tokens.consume_refresh_token(db, data.refresh_token)
+    db_user = db.get(UserModel, user_id) if user_id is not None else None
+    if db_user is None:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Refresh token inválido o vencido"
+        )
+    return issue_tokens(db, db_user)
+
+# Logout: revoca el refresh token. El access token vigente vence solo en
+# ACCESS_TOKEN_EXPIRE_MINUTES como maximo.
+@app.post("/token/revoke", status_code=status.HTTP_204_NO_CONTENT)
+def revoke_refresh_token(data: RefreshRequest, db: Session = Depends(get_db)):
+    tokens.revoke_refresh_token(db, data.refresh_token)
+    db.commit()
+
+# Claves publicas para verificar los access tokens (RFC 7517). Los servicios
+# las cachean por kid, asi que se pueden servir con cache HTTP.
+@app.get("/.well-known/jwks.json")
+def get_jwks(response: Response):
+    response.headers["Cache-Control"] = f"public, max-age={int(keys.KEYS_RELOAD_INTERVAL)}"
+    return keys.jwks()
+
+# --- Sondeos de salud ---
+# /health/live solo indica que el proceso responde (no reiniciarlo);
+# /health/ready indica si puede recibir trafico.
+
+@app.get("/health/live")
+def liveness():
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness():
+    if not ready:
+        return JSONResponse(status_code=503, content={"status": "starting", "startup_ms": startup_phases})
+    try:
+        await run_in_threadpool(check_database)
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"status": "unavailable", "detail": f"Base de datos: {e}"})
+    return {"status": "ready", "startup_ms": startup_phases}
+
+record_phase("imports", IMPORT_STARTED)
\ No newline at end of file
@@ -0,0 +1,93 @@
+import os
+import time
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from database import engine
+from models import User, RefreshToken, SigningKey
+
+# Migraciones versionadas del esquema de usuarios.
+#
+# Se ejecutan una vez por despliegue con `python migrations.py` (lo hace
+# start.sh) y no al importar main.py, asi el proceso web arranca sin DDL.
+# Para cambiar el esquema se agrega una entrada nueva al final de MIGRATIONS.
+
+logging.basicConfig(level=logging.INFO)
+
+
+def create_users(connection):
+    User.__table__.create(bind=connection, checkfirst=True)
+
+
+def create_refresh_tokens(connection):
+    RefreshToken.__table__.create(bind=connection, checkfirst=True)
+
+
+def create_signing_keys(connection):
+    SigningKey.__table__.create(bind=connection, checkfirst=True)
+
+
+MIGRATIONS = [
+    (1, "Tabla users", create_users),
+    (2, "Tabla refresh_tokens", create_refresh_tokens),
+    (3, "Tabla signing_keys", create_signing_keys),
+]
+
+# Reintentos de conexion mientras la base arranca (reemplaza el bucle de pg_isready)
+DB_WAIT_TIMEOUT = float(os.getenv("DB_WAIT_TIMEOUT", "60"))
+
+# Clave del advisory lock: evita que dos contenedores migren a la vez
+MIGRATIONS_LOCK_ID = 80420
+
+
+def wait_for_database():
+    deadline = time.monotonic() + DB_WAIT_TIMEOUT
+    delay = 0.1
+    while True:
+        try:
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            return
+        except OperationalError as e:
+            if time.monotonic() >= deadline:
+                raise
+            logging.info(f"Esperando a la base de datos... ({e.__class__.__name__})")
+            time.sleep(delay)
+            delay = min(delay * 2, 2)
+
+
+def run_migrations():
+    """
+    Aplica en una sola transaccion las migraciones que falten y las registra
+    en schema_migrations. Todas deben ser idempotentes (IF NOT EXISTS).
+    """
+    with engine.begin() as connection:
+        connection.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": MIGRATIONS_LOCK_ID})
+        connection.execute(text("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description VARCHAR NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT now()
+            )
+        """))
+        applied = set(connection.execute(text("SELECT version FROM schema_migrations")).scalars())
+
+        for version, description, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            started = time.perf_counter()
+            migrate(connection)
+            connection.execute(
+                text("INSERT INTO schema_migrations (version, description) VALUES (:version, :description)"),
+                {"version": version, "description": description}
+            )
+            logging.info(f"Migración {version} aplicada ({description}) en {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    started = time.perf_counter()
+    wait_for_database()
+    run_migrations()
+    logging.info(f"Esquema al día en {(time.perf_counter() - started) * 1000:.0f} ms")
\ No newline at end of file
@@ -1,5 +1,6 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String
+from datetime import datetime
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
 
 Base = declarative_base()
 
@@ -8,4 +9,25 @@ class User(Base):
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, index=True)
     hashed_password = Column(String)
-    role = Column(String, default="client")
\ No newline at end of file
+    role = Column(String, default="client")
+
+# Refresh tokens emitidos en el login. Solo se guarda el SHA-256 del token:
+# es un valor aleatorio de 256 bits, asi que no hace falta un hash lento como
+# bcrypt, y token_hash tiene indice unico para buscarlo en cada /token/refresh.
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    token_hash = Column(String(64), nullable=False, unique=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+    revoked_at = Column(DateTime, nullable=True)
+
+# Claves Ed25519 con las que usuarios firma los access tokens (ver keys.py).
+# La mas reciente firma; las anteriores se siguen publicando en el JWKS
+# mientras puedan existir tokens vigentes firmados con ellas.
+class SigningKey(Base):
+    __tablename__ = "signing_keys"
+    kid = Column(String(32), primary_key=True)
+    private_key = Column(String, nullable=False)  # PEM PKCS8, cifrado si JWT_KEYS_PASSPHRASE esta definido
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
\ No newline at end of file
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 
 class UserBase(BaseModel):
     username: str
@@ -11,6 +11,13 @@ class UserCreate(UserBase):
 class UserLogin(UserBase):
     password: str
 
+class BulkRegisterResult(BaseModel):
+    created: int
+    skipped: List[str]  # nombres que ya existian o estaban repetidos en el lote
+
+class UsernameAvailability(UserBase):
+    available: bool
+
 class User(UserBase):
     id: int
     role: str
@@ -20,4 +27,9 @@ class User(UserBase):
 
 class Token(BaseModel):
     access_token: str
-    token_type: str
\ No newline at end of file
+    token_type: str
+    refresh_token: Optional[str] = None
+    expires_in: Optional[int] = None  # segundos de validez del access token
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
\ No newline at end of file
@@ -0,0 +1,134 @@
+import os
+import time
+import secrets
+import hashlib
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from models import RefreshToken
+
+# Refresh tokens de larga duracion.
+#
+# El login entrega un access token corto y un refresh token opaco. Con el
+# refresh token /token/refresh emite un access token nuevo sin volver a pedir
+# la contraseña (sin bcrypt). Cada uso rota el refresh token: el anterior
+# queda revocado en la misma sentencia que lo valida, asi dos usos
+# simultaneos del mismo token no pueden tener exito los dos.
+#
+# Los tokens revocados tambien se anotan en un conjunto de revocacion (Redis si
+# REDIS_HOST esta definido, si no un dict del proceso) que se consulta antes de
+# ir a la base. La base sigue siendo la fuente de verdad: el conjunto solo
+# evita la consulta para tokens que ya se sabe que no sirven.
+
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+
+REDIS_HOST = os.getenv("REDIS_HOST")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+
+_redis = None
+_revoked = {}  # token_hash -> time.time() en que vence la revocacion
+
+
+def get_redis():
+    """Cliente de Redis del proceso, creado en el primer uso."""
+    global _redis
+    if _redis is None:
+        import redis
+        _redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+    return _redis
+
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def revoked_key(token_hash: str) -> str:
+    return f"revoked_refresh:{token_hash}"
+
+
+def add_to_revocation_set(token_hash: str, expires_at: datetime):
+    """
+    Anota el token como revocado hasta su vencimiento; despues ya no hace
+    falta recordarlo porque la base lo rechaza por expires_at.
+    """
+    ttl = max(1, int((expires_at - datetime.utcnow()).total_seconds()))
+    if REDIS_HOST:
+        try:
+            get_redis().set(revoked_key(token_hash), 1, ex=ttl)
+            return
+        except Exception as e:
+            logging.warning(f"No se pudo anotar la revocación en Redis: {e}")
+    _revoked[token_hash] = time.time() + ttl
+
+
+def in_revocation_set(token_hash: str) -> bool:
+    if REDIS_HOST:
+        try:
+            return bool(get_redis().exists(revoked_key(token_hash)))
+        except Exception as e:
+            logging.warning(f"No se pudo consultar la revocación en Redis: {e}")
+    expires = _revoked.get(token_hash)
+    if expires is None:
+        return False
+    if expires < time.time():
+        del _revoked[token_hash]
+        return False
+    return True
+
+
+def issue_refresh_token(db, user_id: int) -> str:
+    """
+    Crea un refresh token para el usuario. Solo se guarda su hash; el valor
+    en claro se devuelve una unica vez al cliente. No confirma la transaccion.
+    """
+    token = secrets.token_urlsafe(32)
+    db.add(RefreshToken(
+        user_id=user_id,
+        token_hash=hash_token(token),
+        expires_at=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    ))
+    return token
+
+
+def consume_refresh_token(db, token: str) -> int | None:
+    """
+    Valida y revoca el refresh token en un solo UPDATE. Devuelve el user_id
+    o None si el token no existe, vencio o ya fue usado. No confirma la
+    transaccion.
+    """
+    token_hash = hash_token(token)
+    if in_revocation_set(token_hash):
+        return None
+
+    now = datetime.utcnow()
+    row = db.execute(
+        update(RefreshToken)
+        .where(
+            RefreshToken.token_hash == token_hash,
+            RefreshToken.revoked_at.is_(None),
+            RefreshToken.expires_at > now,
+        )
+        .values(revoked_at=now)
+        .returning(RefreshToken.user_id, RefreshToken.expires_at)
+    ).first()
+    if row is None:
+        return None
+    add_to_revocation_set(token_hash, row.expires_at)
+    return row.user_id
+
+
+def revoke_refresh_token(db, token: str) -> bool:
+    """Revoca el token (logout). Devuelve False si no existia o ya estaba revocado."""
+    token_hash = hash_token(token)
+    row = db.execute(
+        update(RefreshToken)
+        .where(RefreshToken.token_hash == token_hash, RefreshToken.revoked_at.is_(None))
+        .values(revoked_at=datetime.utcnow())
+        .returning(RefreshToken.expires_at)
+    ).first()
+    if row is None:
+        return False
+    add_to_revocation_set(token_hash, row.expires_at)
+    return True
\ No newline at end of file
@@ -0,0 +1,152 @@
+import os
+import math
+import time
+import hashlib
+import logging
+import threading
+
+from sqlalchemy import Integer, any_, bindparam, or_, select
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from database import SessionLocal
+from models import User
+
+# Filtro de Bloom con los nombres de usuario ocupados.
+#
+# /register/available responde "disponible" sin ir a la base cuando el nombre
+# no esta en el filtro (un filtro de Bloom no da falsos negativos). Si el
+# filtro dice que puede estar ocupado se confirma con la base, asi los falsos
+# positivos (USERNAME_BLOOM_ERROR_RATE) solo cuestan una consulta.
+#
+# Cada proceso arma su filtro al arrancar y cada USERNAME_BLOOM_REFRESH
+# segundos agrega los usuarios nuevos por id, incluidos los registrados por
+# otros workers o replicas. La respuesta es orientativa: el registro en si
+# siempre lo decide el indice unico de users.username.
+#
+# Los ids se asignan al insertar pero se ven al confirmar: una transaccion
+# larga (un /register/bulk) confirma ids menores a otros ya leidos. Por eso
+# los ids salteados se siguen buscando durante USERNAME_BLOOM_GAP_TTL segundos
+# (los de transacciones que fallaron nunca aparecen) y el filtro se rearma
+# entero cada USERNAME_BLOOM_REBUILD segundos por si alguno llego mas tarde.
+
+USERNAME_BLOOM_CAPACITY = int(os.getenv("USERNAME_BLOOM_CAPACITY", "1000000"))
+USERNAME_BLOOM_ERROR_RATE = float(os.getenv("USERNAME_BLOOM_ERROR_RATE", "0.01"))
+USERNAME_BLOOM_REFRESH = float(os.getenv("USERNAME_BLOOM_REFRESH", "5"))
+USERNAME_BLOOM_GAP_TTL = float(os.getenv("USERNAME_BLOOM_GAP_TTL", "600"))
+USERNAME_BLOOM_REBUILD = float(os.getenv("USERNAME_BLOOM_REBUILD", "3600"))
+# Como mucho se siguen los ids salteados mas recientes, para acotar la consulta
+MAX_GAPS = 10000
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, value: str):
+        # Doble hashing: k posiciones a partir de dos hashes de 64 bits
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, value: str):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(value))
+
+
+_filter = None
+_last_id = 0
+_gaps = {}  # id salteado -> momento (monotonic) en que se detecto
+_built_at = 0.0
+
+
+def load_new_usernames(db, bloom: BloomFilter, after_id: int, gaps: dict[int, float]) -> int:
+    """
+    Agrega al filtro los usuarios con id mayor a after_id y los ids salteados
+    que aparecieron. Actualiza gaps y devuelve el ultimo id cargado.
+    """
+    now = time.monotonic()
+    condition = User.id > after_id
+    if gaps:
+        condition = or_(condition, User.id == any_(bindparam("gaps", list(gaps), type_=ARRAY(Integer))))
+    rows = db.execute(select(User.id, User.username).where(condition).order_by(User.id)).yield_per(10000)
+    for user_id, username in rows:
+        bloom.add(username)
+        if user_id <= after_id:
+            gaps.pop(user_id, None)  # confirmo la transaccion que lo tenia
+            continue
+        for missing in range(max(after_id + 1, user_id - MAX_GAPS), user_id):
+            gaps[missing] = now
+        after_id = user_id
+
+    for gap_id, seen_at in list(gaps.items()):
+        if now - seen_at > USERNAME_BLOOM_GAP_TTL:
+            del gaps[gap_id]
+    if len(gaps) > MAX_GAPS:
+        for gap_id in sorted(gaps)[:-MAX_GAPS]:
+            del gaps[gap_id]
+    return after_id
+
+
+def build():
+    """
+    Arma el filtro desde la base con capacidad para el doble de los usuarios
+    actuales. Se publica recien al terminar, para no responder con uno a medio cargar.
+    """
+    global _filter, _last_id, _gaps, _built_at
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        count = db.query(User).count()
+        bloom = BloomFilter(max(USERNAME_BLOOM_CAPACITY, count * 2), USERNAME_BLOOM_ERROR_RATE)
+        gaps = {}
+        last_id = load_new_usernames(db, bloom, 0, gaps)
+    finally:
+        db.close()
+    _filter, _last_id, _gaps, _built_at = bloom, last_id, gaps, time.monotonic()
+    logging.info(f"Filtro de nombres de usuario armado: {count} usuarios en {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+def refresh_loop():
+    global _last_id
+    while _filter is None:
+        try:
+            build()
+        except Exception as e:
+            logging.error(f"No se pudo armar el filtro de nombres de usuario: {e}")
+            time.sleep(USERNAME_BLOOM_REFRESH)
+    while True:
+        time.sleep(USERNAME_BLOOM_REFRESH)
+        if time.monotonic() - _built_at > USERNAME_BLOOM_REBUILD:
+            try:
+                build()
+            except Exception as e:
+                logging.error(f"No se pudo rearmar el filtro de nombres de usuario: {e}")
+            continue
+        db = SessionLocal()
+        try:
+            _last_id = load_new_usernames(db, _filter, _last_id, _gaps)
+        except Exception as e:
+            logging.error(f"No se pudo actualizar el filtro de nombres de usuario: {e}")
+        finally:
+            db.close()
+
+
+def start():
+    """Arma el filtro en segundo plano y lo mantiene al dia. Se llama desde el lifespan."""
+    threading.Thread(target=refresh_loop, daemon=True, name="username-bloom").start()
+
+
+def add(username: str):
+    if _filter is not None:
+        _filter.add(username)
+
+
+def maybe_taken(username: str) -> bool:
+    """False si el nombre seguro esta libre; True si puede estar ocupado o el filtro aun no esta listo."""
+    return _filter is None or username in _filter
\ No newline at end of file